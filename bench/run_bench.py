@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# 性能测试：生成（或复用）合成数据，测量各个阶段的耗时，结果写入json报告，用于比较不同版本的性能
+#
+# python3 bench/run_bench.py -o bench_report.json --threads 1,2,4
+# python3 bench/run_bench.py -o new.json --baseline old.json    # 与之前的报告比较
+#
+# 测试项目：
+# parse_locus           读取POS, BED, VCF位置文件，以及位点的标准化（utils.scan_locus_file + utils.normalize_loci）
+# get_real_variants     vcf.get_real_variants_from_vcf 解析标准位点（.vcf和.vcf.gz），以及vcf.compile_real_site_index没有缓存和命中缓存时的耗时
+# get_pos_info          逐个位点调用info.get_pos_info
+# sweep_pos_info        按窗口调用info.sweep_pos_info（get_position_info.py的主要路径）
+# main                  get_position_info.py 端到端运行（包括编译标准位点索引），每个--threads值一项
+import os
+import sys
+import os.path as path
+import json
+import time
+import shutil
+import argparse
+import platform
+import contextlib
+import statistics
+import subprocess
+from dataclasses import asdict
+
+import numpy as np
+import pysam
+
+ROOT_DIR = path.dirname(path.dirname(path.realpath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import lib.utils as utils
+import lib.info as info
+import lib.vcf as vcf
+import synthetic
+
+REPORT_VERSION = 1
+MAIN_SCRIPT = path.join(ROOT_DIR, 'get_position_info.py')
+
+
+def __timeit(function, repeat_int: int, setup = None) -> tuple[list[float, ...], int]:
+   '''
+   重复运行function，返回每次的耗时（秒）和function的返回值（处理的数量）。每次运行前调用setup（不计时），function的标准输出被丢弃
+   '''
+
+   second_lst = []
+   item_int = 0
+   for _ in range(repeat_int):
+      if setup is not None:
+         setup()
+      start = time.perf_counter()
+      with open(os.devnull, 'w') as null_f, contextlib.redirect_stdout(null_f):
+         item_int = function()
+      second_lst.append(time.perf_counter() - start)
+
+   return second_lst, item_int
+
+
+def __result(name: str, second_lst: list[float, ...], item_int: int, unit: str, **extra) -> dict:
+   min_second = min(second_lst)
+   result_dict = {'name': name, 'seconds': [round(x, 6) for x in second_lst], 'min': round(min_second, 6), 'median': round(statistics.median(second_lst), 6),
+                  'items': item_int, 'unit': unit, 'items_per_second': round(item_int / min_second, 2) if min_second > 0 else None}
+   result_dict.update(extra)
+   return result_dict
+
+
+def __bench_parse_locus(dataset_dict: dict, repeat_int: int) -> list[dict, ...]:
+   result_lst = []
+   for format_str in ['POS', 'BED', 'VCF']:
+      locus_file = dataset_dict['locus_' + format_str.lower()]
+      second_lst, item_int = __timeit(lambda: sum(1 for _ in utils.parse_locus(locus_file, format_str)), repeat_int)
+      result_lst.append(__result(f'parse_locus[{format_str}]', second_lst, item_int, 'loci'))
+
+   with pysam.AlignmentFile(dataset_dict['bam']) as bam_af:
+      contig_lst = list(bam_af.references)
+   for format_str in ['POS', 'BED', 'VCF']:
+      locus_file = dataset_dict['locus_' + format_str.lower()]
+      def normalize():
+         locus_scan = utils.scan_locus_file(locus_file, format_str, contig_lst)
+         return sum(1 for _ in utils.normalize_loci(locus_file, format_str, contig_lst, locus_scan))
+      second_lst, item_int = __timeit(normalize, repeat_int)
+      result_lst.append(__result(f'normalize_loci[{format_str}]', second_lst, item_int, 'loci'))
+
+   return result_lst
+
+
+# 标准位点的缓存目录（见lib/truthcache.py），放在合成数据目录中，不使用用户的缓存目录
+def __truth_cache_dir(dataset_dict: dict) -> str:
+   return path.join(path.dirname(dataset_dict['bam']), 'truth_cache')
+
+
+# 清空标准位点的缓存目录，使下一次运行重新编译
+def __clear_truth_cache(dataset_dict: dict) -> None:
+   shutil.rmtree(__truth_cache_dir(dataset_dict), ignore_errors = True)
+   return None
+
+
+def __bench_real_variants(dataset_dict: dict, repeat_int: int) -> list[dict, ...]:
+   result_lst = []
+   for key_str, name in [('truth_vcf', 'get_real_variants[vcf]'), ('truth_vcf_gz', 'get_real_variants[vcf.gz]')]:
+      second_lst, item_int = __timeit(lambda: len(vcf.get_real_variants_from_vcf(dataset_dict[key_str])), repeat_int)
+      result_lst.append(__result(name, second_lst, item_int, 'sites'))
+
+   def compile_index():
+      vcf.compile_real_site_index(dataset_dict['truth_vcf_gz'], cache_dir = __truth_cache_dir(dataset_dict))
+      return dataset_dict['variant_number']
+
+   second_lst, item_int = __timeit(compile_index, repeat_int, setup = lambda: __clear_truth_cache(dataset_dict))
+   result_lst.append(__result('compile_real_site_index[cold]', second_lst, item_int, 'variants'))
+   second_lst, item_int = __timeit(compile_index, repeat_int)
+   result_lst.append(__result('compile_real_site_index[cached]', second_lst, item_int, 'variants'))
+   return result_lst
+
+
+def __read_pos_loci(dataset_dict: dict, max_locus_int: int) -> list[tuple[str, int], ...]:
+   locus_lst = []
+   for chrom, pos, _ in utils.parse_locus(dataset_dict['locus_pos'], 'POS'):
+      locus_lst.append((chrom, pos))
+      if len(locus_lst) >= max_locus_int:
+         break
+   return locus_lst
+
+
+def __bench_pos_info(dataset_dict: dict, repeat_int: int, max_locus_int: int) -> list[dict, ...]:
+   locus_lst = __read_pos_loci(dataset_dict, max_locus_int)
+
+   def per_locus():
+      with pysam.AlignmentFile(dataset_dict['bam'], 'rb') as bam_af:
+         for chrom, pos in locus_lst:
+            info.get_pos_info(bam_af, chrom, pos)
+      return len(locus_lst)
+
+   def per_window():
+      locus_int = 0
+      with pysam.AlignmentFile(dataset_dict['bam'], 'rb') as bam_af:
+         for chrom, window_lst in utils.group_loci_windows([(chrom, pos, '') for chrom, pos in locus_lst]):
+            for _ in info.sweep_pos_info(bam_af, chrom, [x[1] for x in window_lst]):
+               locus_int += 1
+      return locus_int
+
+   result_lst = []
+   second_lst, item_int = __timeit(per_locus, repeat_int)
+   result_lst.append(__result('get_pos_info', second_lst, item_int, 'loci'))
+   second_lst, item_int = __timeit(per_window, repeat_int)
+   result_lst.append(__result('sweep_pos_info', second_lst, item_int, 'loci'))
+   return result_lst
+
+
+def __bench_main(dataset_dict: dict, repeat_int: int, thread_lst: list[int, ...], work_dir: str) -> list[dict, ...]:
+   output_file = path.join(work_dir, 'main_output.tsv')
+   result_lst = []
+   for thread_int in thread_lst:
+      command_lst = [sys.executable, MAIN_SCRIPT, '-l', 'POS', '-r', dataset_dict['reference'], '-v', dataset_dict['truth_vcf'], '--truth-cache-dir', __truth_cache_dir(dataset_dict), '-o', output_file, '-t', str(thread_int), dataset_dict['bam'], dataset_dict['locus_pos']]
+
+      def run():
+         subprocess.run(command_lst, check = True, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+         return dataset_dict['locus_pos_number']
+
+      second_lst, item_int = __timeit(run, repeat_int, setup = lambda: __clear_truth_cache(dataset_dict))
+      result_lst.append(__result(f'main[threads={thread_int}]', second_lst, item_int, 'loci', threads = thread_int))
+
+   if path.exists(output_file):
+      os.remove(output_file)
+   return result_lst
+
+
+def __git_commit() -> str:
+   try:
+      return subprocess.run(['git', '-C', ROOT_DIR, 'rev-parse', 'HEAD'], check = True, capture_output = True, text = True).stdout.strip()
+   except (OSError, subprocess.CalledProcessError):
+      return ''
+
+
+def __environment() -> dict:
+   return {'python': platform.python_version(), 'pysam': pysam.__version__, 'numpy': np.__version__, 'platform': platform.platform(),
+           'cpu_count': os.cpu_count(), 'git_commit': __git_commit()}
+
+
+# 与之前的报告比较，输出每一项的耗时比（>1表示变慢）
+def __compare(report_dict: dict, baseline_file: str) -> None:
+   with open(baseline_file) as in_f:
+      baseline_dict = json.load(in_f)
+
+   if baseline_dict.get('parameters') != report_dict['parameters']:
+      print(f'警告: {baseline_file} 的合成数据参数与本次不同，结果不能直接比较', file = sys.stderr)
+
+   baseline_result_dict = {x['name']: x for x in baseline_dict.get('results', [])}
+   print(f'{"name":<34}{"baseline(s)":>14}{"current(s)":>14}{"ratio":>10}')
+   for result_dict in report_dict['results']:
+      baseline_result = baseline_result_dict.get(result_dict['name'])
+      if baseline_result is None:
+         print(f'{result_dict["name"]:<34}{"-":>14}{result_dict["min"]:>14.4f}{"-":>10}')
+         continue
+      ratio = result_dict['min'] / baseline_result['min'] if baseline_result['min'] > 0 else float('nan')
+      print(f'{result_dict["name"]:<34}{baseline_result["min"]:>14.4f}{result_dict["min"]:>14.4f}{ratio:>10.3f}')
+
+   return None
+
+
+def get_arguments() -> argparse.Namespace:
+   parser_ar = argparse.ArgumentParser(description = '性能测试：生成合成数据，测量读取位置文件、标准位点、get_pos_info和端到端运行的耗时，结果写入json报告')
+   parser_ar.add_argument('-o', '--output', default = 'bench_report.json', help = 'FILE. json报告，默认值为bench_report.json', dest = 'OUTPUT')
+   parser_ar.add_argument('-w', '--work-dir', default = 'bench_data', help = 'DIR. 合成数据目录，参数相同时复用已有数据，默认值为bench_data', dest = 'WORK_DIR')
+   parser_ar.add_argument('-t', '--threads', default = '1,2,4', help = 'STR. 端到端运行使用的--threads值，用,分割，默认值为1,2,4', dest = 'THREADS')
+   parser_ar.add_argument('--repeat', default = 3, type = int, help = 'INT. 每项重复次数，报告中min为最短耗时，默认值为3', dest = 'REPEAT')
+   parser_ar.add_argument('--max-loci', default = 2000, type = int, help = 'INT. get_pos_info和sweep_pos_info最多测试的位点数，默认值为2000', dest = 'MAX_LOCI')
+   parser_ar.add_argument('--skip', default = '', help = 'STR. 跳过的测试项目，用,分割（parse_locus, get_real_variants, get_pos_info, main）', dest = 'SKIP')
+   parser_ar.add_argument('--label', default = '', help = 'STR. 写入报告的标签，例如版本号', dest = 'LABEL')
+   parser_ar.add_argument('--baseline', default = '', help = 'FILE. 之前的json报告，运行结束后输出每一项的耗时比', dest = 'BASELINE')
+   parser_ar.add_argument('--clean', action = 'store_true', default = False, help = '运行结束后删除合成数据目录', dest = 'IS_CLEAN')
+   for field_name, field_value in asdict(synthetic.SyntheticParameters()).items():
+      parser_ar.add_argument('--' + field_name.replace('_', '-'), default = field_value, type = type(field_value), dest = field_name, help = f'合成数据参数，默认值为{field_value}')
+
+   return parser_ar.parse_args()
+
+
+def main() -> None:
+   arguments = get_arguments()
+   parameters = synthetic.SyntheticParameters(**{x: getattr(arguments, x) for x in asdict(synthetic.SyntheticParameters()).keys()})
+   thread_lst = [int(x) for x in arguments.THREADS.split(',') if x.strip() != '']
+   skip_set = {x.strip() for x in arguments.SKIP.split(',') if x.strip() != ''}
+
+   start = time.perf_counter()
+   dataset_dict = synthetic.generate(arguments.WORK_DIR, parameters)
+   print(f'合成数据: {arguments.WORK_DIR}，{dataset_dict["read_number"]} reads，{dataset_dict["variant_number"]} 个标准位点，{dataset_dict["locus_pos_number"]} 个POS位点（{time.perf_counter() - start:.1f}s）', file = sys.stderr)
+
+   result_lst = []
+   if 'parse_locus' not in skip_set:
+      result_lst.extend(__bench_parse_locus(dataset_dict, arguments.REPEAT))
+   if 'get_real_variants' not in skip_set:
+      result_lst.extend(__bench_real_variants(dataset_dict, arguments.REPEAT))
+   if 'get_pos_info' not in skip_set:
+      result_lst.extend(__bench_pos_info(dataset_dict, arguments.REPEAT, arguments.MAX_LOCI))
+   if 'main' not in skip_set:
+      result_lst.extend(__bench_main(dataset_dict, arguments.REPEAT, thread_lst, path.dirname(dataset_dict['bam'])))
+
+   for result_dict in result_lst:
+      print(f'{result_dict["name"]:<34}min {result_dict["min"]:.4f}s  median {result_dict["median"]:.4f}s  {result_dict["items_per_second"]} {result_dict["unit"]}/s', file = sys.stderr)
+
+   report_dict = {'version': REPORT_VERSION, 'label': arguments.LABEL, 'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'environment': __environment(),
+                  'parameters': asdict(parameters), 'dataset': {key: value for key, value in dataset_dict.items() if key.endswith('_number')}, 'repeat': arguments.REPEAT, 'results': result_lst}
+   with open(arguments.OUTPUT, 'w') as out_f:
+      json.dump(report_dict, out_f, indent = 2)
+      out_f.write('\n')
+
+   if arguments.BASELINE != '':
+      __compare(report_dict, arguments.BASELINE)
+
+   if arguments.IS_CLEAN:
+      shutil.rmtree(arguments.WORK_DIR, ignore_errors = True)
+
+   return None
+
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# 生成用于benchmark的合成数据：参考基因组（.fasta + .fai），比对文件（.bam + .bai），标准位点（.vcf, .vcf.gz + .tbi），位置文件（POS, BED, VCF）
+# 相同的参数和随机种子总是生成相同的文件，因此不同版本的benchmark结果可以直接比较
+#
+# python3 bench/synthetic.py -o /tmp/bench_data --depth 100 --read-length 150 --indel-rate 0.0005
+import os
+import sys
+import os.path as path
+import json
+import random
+import argparse
+import pysam
+from dataclasses import dataclass, asdict
+
+BASES = 'ACGT'
+
+
+# 合成数据的参数
+@dataclass
+class SyntheticParameters:
+   contig_number: int = 2  # 染色体数
+   contig_length: int = 100000  # 每条染色体的长度
+   depth: int = 30  # 平均测序深度
+   read_length: int = 150  # read长度，双端测序
+   insert_size: int = 350  # 平均插入片段长度
+   snp_rate: float = 0.001  # 每个碱基为SNP的概率
+   indel_rate: float = 0.0002  # 每个碱基为InDel的概率，insert和delete各一半，长度为1-6
+   error_rate: float = 0.005  # 测序错误率
+   duplicate_rate: float = 0.02  # 标记为duplicate的reads比例
+   locus_density: float = 5.0  # POS位置文件中每1kb的位点数
+   bed_region_number: int = 20  # BED位置文件中的区间数
+   bed_region_length: int = 500  # BED位置文件中每个区间的长度
+   seed: int = 1  # 随机种子
+
+
+def __write_reference(reference_file: str, contig_dict: dict) -> None:
+   with open(reference_file, 'w') as out_f:
+      for chrom, seq_str in contig_dict.items():
+         out_f.write(f'>{chrom}\n')
+         for i in range(0, len(seq_str), 60):
+            out_f.write(seq_str[i:i + 60] + '\n')
+
+   pysam.faidx(reference_file)
+   return None
+
+
+# 在参考基因组上随机产生变异，返回 [(chrom, pos, ref, alt, genotype), ...]，pos为1-based，已排序
+def __make_variants(contig_dict: dict, parameters: SyntheticParameters, rng: random.Random) -> list:
+   variant_lst = []
+   for chrom, seq_str in contig_dict.items():
+      pos = 20
+      while pos < len(seq_str) - 20:
+         r = rng.random()
+         if r < parameters.snp_rate:
+            ref_str = seq_str[pos - 1]
+            variant_lst.append((chrom, pos, ref_str, rng.choice([x for x in BASES if x != ref_str]), rng.choice(['0/1', '0/1', '1/1'])))
+            pos += 2
+         elif r < parameters.snp_rate + parameters.indel_rate:
+            length_int = rng.randint(1, 6)
+            if rng.random() < 0.5:  # insert
+               ref_str = seq_str[pos - 1]
+               alt_str = ref_str + ''.join(rng.choice(BASES) for _ in range(length_int))
+            else:  # delete
+               ref_str = seq_str[pos - 1:pos + length_int]
+               alt_str = seq_str[pos - 1]
+            variant_lst.append((chrom, pos, ref_str, alt_str, rng.choice(['0/1', '0/1', '1/1'])))
+            pos += length_int + 2
+         else:
+            pos += 1
+
+   return variant_lst
+
+
+# 构建一条单倍型：返回序列和每个碱基对应的参考基因组位置（0-based，插入的碱基为-1）
+def __make_haplotype(seq_str: str, variant_lst: list) -> tuple[str, list]:
+   hap_lst = []
+   ref_pos_lst = []
+   i = 0
+   for _, pos, ref_str, alt_str, _ in variant_lst:
+      start = pos - 1
+      hap_lst.append(seq_str[i:start])
+      ref_pos_lst.extend(range(i, start))
+      hap_lst.append(alt_str)
+      if len(alt_str) >= len(ref_str):  # SNP或insert
+         ref_pos_lst.append(start)
+         ref_pos_lst.extend([-1] * (len(alt_str) - 1))
+      else:  # delete，只保留第一个碱基
+         ref_pos_lst.append(start)
+      i = start + len(ref_str)
+
+   hap_lst.append(seq_str[i:])
+   ref_pos_lst.extend(range(i, len(seq_str)))
+   return ''.join(hap_lst), ref_pos_lst
+
+
+# 将单倍型上[start, start + length)的序列比对回参考基因组，返回(参考基因组起始位置, 序列, cigar)。read两端的插入碱基被去掉
+def __align(haplotype: tuple[str, list], start: int, length: int) -> tuple[int, str, str]:
+   hap_str, ref_pos_lst = haplotype
+   end = min(start + length, len(hap_str))
+   while start < end and ref_pos_lst[start] == -1:
+      start += 1
+   while end > start and ref_pos_lst[end - 1] == -1:
+      end -= 1
+
+   op_lst = []  # [[op, length], ...]
+   previous_int = None
+   for ref_pos in ref_pos_lst[start:end]:
+      if ref_pos == -1:
+         op_str = 'I'
+      else:
+         if previous_int is not None and ref_pos > previous_int + 1:
+            op_lst.append(['D', ref_pos - previous_int - 1])
+         previous_int = ref_pos
+         op_str = 'M'
+
+      if op_lst != [] and op_lst[-1][0] == op_str:
+         op_lst[-1][1] += 1
+      else:
+         op_lst.append([op_str, 1])
+
+   return ref_pos_lst[start], hap_str[start:end], ''.join(f'{n}{op}' for op, n in op_lst)
+
+
+def __add_errors(seq_str: str, error_rate: float, rng: random.Random) -> str:
+   if error_rate <= 0:
+      return seq_str
+   return ''.join([x if rng.random() >= error_rate else rng.choice('ACGTN') for x in seq_str])
+
+
+def __write_bam(bam_file: str, contig_dict: dict, variant_lst: list, parameters: SyntheticParameters, rng: random.Random) -> int:
+   header_dict = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': chrom, 'LN': len(seq_str)} for chrom, seq_str in contig_dict.items()]}
+
+   segment_lst = []
+   pair_int = 0
+   for tid, (chrom, seq_str) in enumerate(contig_dict.items()):
+      chrom_variant_lst = [x for x in variant_lst if x[0] == chrom]
+      haplotype_lst = [__make_haplotype(seq_str, [x for x in chrom_variant_lst if x[4] == '1/1']), __make_haplotype(seq_str, chrom_variant_lst)]
+
+      for _ in range(len(seq_str) * parameters.depth // (2 * parameters.read_length)):
+         haplotype = rng.choice(haplotype_lst)
+         insert_int = max(int(rng.gauss(parameters.insert_size, parameters.insert_size / 10)), parameters.read_length)
+         start = rng.randint(0, max(len(haplotype[0]) - insert_int, 0))
+         is_duplicate = rng.random() < parameters.duplicate_rate
+         pair_int += 1
+
+         mate_lst = [__align(haplotype, start, parameters.read_length), __align(haplotype, start + insert_int - parameters.read_length, parameters.read_length)]
+         for mate_i, (ref_start, read_str, cigar_str) in enumerate(mate_lst):
+            segment = pysam.AlignedSegment()
+            segment.query_name = f'read{pair_int}'
+            segment.query_sequence = __add_errors(read_str, parameters.error_rate, rng)
+            segment.flag = 0x1 | 0x2 | (0x40 if mate_i == 0 else 0x80) | (0x20 if mate_i == 0 else 0x10) | (0x400 if is_duplicate else 0)
+            segment.reference_id = tid
+            segment.reference_start = ref_start
+            segment.mapping_quality = rng.choice([60, 60, 60, 60, 40, 20, 0])
+            segment.cigarstring = cigar_str
+            segment.next_reference_id = tid
+            segment.next_reference_start = mate_lst[1 - mate_i][0]
+            segment.template_length = insert_int if mate_i == 0 else -insert_int
+            segment.query_qualities = pysam.qualitystring_to_array(''.join([chr(33 + rng.randint(2, 40)) for _ in read_str]))
+            segment_lst.append(segment)
+
+   segment_lst.sort(key = lambda x: (x.reference_id, x.reference_start))
+   with pysam.AlignmentFile(bam_file, 'wb', header = header_dict) as out_af:
+      for segment in segment_lst:
+         out_af.write(segment)
+   pysam.index(bam_file)
+
+   return len(segment_lst)
+
+
+def __write_vcf(vcf_file: str, contig_dict: dict, variant_lst: list, shift_int: int = 0) -> None:
+   with open(vcf_file, 'w') as out_f:
+      out_f.write('##fileformat=VCFv4.2\n')
+      for chrom, seq_str in contig_dict.items():
+         out_f.write(f'##contig=<ID={chrom},length={len(seq_str)}>\n')
+      out_f.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tSAMPLE\n')
+      for chrom, pos, ref_str, alt_str, genotype_str in variant_lst:
+         out_f.write(f'{chrom}\t{pos + shift_int}\t.\t{ref_str}\t{alt_str}\t50\tPASS\t.\tGT\t{genotype_str}\n')
+
+   return None
+
+
+def generate(output_dir: str, parameters: SyntheticParameters = None) -> dict:
+   '''
+   生成一套合成数据。output_dir中已经有相同参数生成的数据时直接返回，不重新生成
+
+   Parameters:
+      **output_dir**: str
+         输出目录
+
+      **parameters**: SyntheticParameters
+         可选, 合成数据的参数
+
+   Returns:
+      **dataset_dict**: dict
+         各个文件的路径和数据的规模，例如{'reference': ..., 'bam': ..., 'truth_vcf': ..., 'locus_pos': ..., 'read_number': 40000, ...}
+   '''
+
+   if parameters is None:
+      parameters = SyntheticParameters()
+
+   output_dir = path.realpath(path.expanduser(output_dir))
+   os.makedirs(output_dir, exist_ok = True)
+   dataset_file = path.join(output_dir, 'dataset.json')
+   if path.exists(dataset_file):
+      with open(dataset_file) as in_f:
+         dataset_dict = json.load(in_f)
+      if dataset_dict.get('parameters') == asdict(parameters):
+         return dataset_dict
+
+   rng = random.Random(parameters.seed)
+   contig_dict = {f'chr{i + 1}': ''.join(rng.choice(BASES) for _ in range(parameters.contig_length)) for i in range(parameters.contig_number)}
+
+   dataset_dict = {'parameters': asdict(parameters)}
+   dataset_dict['reference'] = path.join(output_dir, 'reference.fasta')
+   __write_reference(dataset_dict['reference'], contig_dict)
+
+   variant_lst = __make_variants(contig_dict, parameters, rng)
+   dataset_dict['truth_vcf'] = path.join(output_dir, 'truth.vcf')
+   __write_vcf(dataset_dict['truth_vcf'], contig_dict, variant_lst)
+   dataset_dict['truth_vcf_gz'] = pysam.tabix_index(dataset_dict['truth_vcf'], preset = 'vcf', force = True, keep_original = True)
+   dataset_dict['variant_number'] = len(variant_lst)
+
+   dataset_dict['bam'] = path.join(output_dir, 'sample.bam')
+   dataset_dict['read_number'] = __write_bam(dataset_dict['bam'], contig_dict, variant_lst, parameters, rng)
+
+   # POS：按密度随机选取的位置；BED：若干个连续区间；VCF：标准位点本身
+   dataset_dict['locus_pos'] = path.join(output_dir, 'loci.pos')
+   locus_int = 0
+   with open(dataset_dict['locus_pos'], 'w') as out_f:
+      for chrom, seq_str in contig_dict.items():
+         for pos in sorted(rng.sample(range(1, len(seq_str) + 1), min(int(len(seq_str) * parameters.locus_density / 1000), len(seq_str)))):
+            out_f.write(f'{chrom}\t{pos}\n')
+            locus_int += 1
+   dataset_dict['locus_pos_number'] = locus_int
+
+   dataset_dict['locus_bed'] = path.join(output_dir, 'loci.bed')
+   region_lst = []
+   for _ in range(parameters.bed_region_number):
+      chrom = rng.choice(list(contig_dict.keys()))
+      start = rng.randint(0, max(len(contig_dict[chrom]) - parameters.bed_region_length, 0))
+      region_lst.append((chrom, start, min(start + parameters.bed_region_length, len(contig_dict[chrom]))))
+   region_lst.sort()
+   with open(dataset_dict['locus_bed'], 'w') as out_f:
+      for chrom, start, end in region_lst:
+         out_f.write(f'{chrom}\t{start}\t{end}\n')
+   dataset_dict['locus_bed_number'] = sum([end - start for _, start, end in region_lst])
+
+   dataset_dict['locus_vcf'] = path.join(output_dir, 'loci.vcf')
+   __write_vcf(dataset_dict['locus_vcf'], contig_dict, variant_lst)
+   dataset_dict['locus_vcf_number'] = len(variant_lst)
+
+   with open(dataset_file, 'w') as out_f:
+      json.dump(dataset_dict, out_f, indent = 2)
+
+   return dataset_dict
+
+
+def get_arguments() -> argparse.Namespace:
+   parser_ar = argparse.ArgumentParser(description = '生成用于benchmark的合成数据（参考基因组，bam，标准位点vcf，位置文件）')
+   parser_ar.add_argument('-o', '--output-dir', required = True, help = '输出目录')
+   for field_name, field_value in asdict(SyntheticParameters()).items():
+      parser_ar.add_argument('--' + field_name.replace('_', '-'), default = field_value, type = type(field_value), dest = field_name, help = f'默认值为{field_value}')
+
+   return parser_ar.parse_args()
+
+
+if __name__ == '__main__':
+
+   arguments = get_arguments()
+   parameters = SyntheticParameters(**{x: getattr(arguments, x) for x in asdict(SyntheticParameters()).keys()})
+   dataset_dict = generate(arguments.output_dir, parameters)
+   json.dump(dataset_dict, sys.stdout, indent = 2)
+   print()
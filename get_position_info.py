@@ -3,26 +3,41 @@
 # v0.4
 # What's New: 重构所有代码，可以准确和快速地读取金标准vcf文件中的位点信息，不需要再按照SNP和InDel读取，更简练，更结构化
 
-# TODO:
-# 1, 输出进度时，显示总数
-# 2, 按照MAPQ过滤reads
-
 import os
 import sys
 import os.path as path
 import argparse
-import pysam
-import re
+import collections
+import threading
+import itertools
+import time
 import multiprocessing as mp
 
 import lib.utils as utils
 import lib.info as info
 import lib.vcf as vcf
+import lib.truthcache as truthcache
+import lib.realsite as realsite
+import lib.columnar as columnar
+import lib.checkpoint as checkpoint
+import lib.profiling as profiling
 
 
 ARGUMENTS_DICT = {}
-BASES = ['A', 'T', 'C', 'G']
-GC_COMPILE = re.compile(r'C|G')
+WORKER_DICT = {}  # 每个工作进程中打开的文件句柄等，由init_worker设置
+
+# 任务队列中每个基因组区块最多CHUNK_SIZE个位点。每个进程最多有PENDING_CHUNKS_PER_PROCESS个已读入但尚未完成的区块，
+# 写入进程的queue最多缓存QUEUE_BATCHES_PER_PROCESS批结果，因此内存占用与位点总数无关
+CHUNK_SIZE = 2000
+PENDING_CHUNKS_PER_PROCESS = 2
+PENDING_POLL_INTERVAL = 0.5  # 任务线程等待空闲名额时检查是否需要停止的间隔（秒）
+QUEUE_BATCHES_PER_PROCESS = 4
+
+# 工作进程每积累BATCH_SIZE行结果发送一次给写入进程，写入进程按区块写入检查点目录（见lib/checkpoint.py）
+BATCH_SIZE = 1000
+
+# 每个工作进程在共享内存数组中有自己的计数器，只由该进程写入，不需要加锁；主进程每隔PROGRESS_INTERVAL秒汇总一次并打印进度
+PROGRESS_INTERVAL = 2
 
 def get_arguments() -> None:
    '''
@@ -36,12 +51,12 @@ def get_arguments() -> None:
 
    argvList = sys.argv
    parser_ar = argparse.ArgumentParser(prog = 'PROG',
-                                       usage = '{0} [OPTION] <bam file> <locus file>'.format(argvList[0]),
+                                       usage = '{0} [OPTION] <bam file> [<bam file> ...] <locus file>'.format(argvList[0]),
                                        description ='提取指定位置的比对信息。',
                                        epilog='本脚本提取一个bam文件指定位置的比对信息，例如碱基数量，方向，错误率，上下文等。',
                                        formatter_class=argparse.RawTextHelpFormatter)
 
-   parser_ar.add_argument('BAM_FILE', help = 'FILE. 比对文件', metavar = 'bam file')
+   parser_ar.add_argument('BAM_FILE', nargs = '+', help = 'FILE. 比对文件，可以是多个比对文件，或者比对文件列表（每行为 比对文件[\\t样本名]）', metavar = 'bam file')
    parser_ar.add_argument('LOCUS_FILE', help = 'FILE. 位置文件 （VCF, BED, POS）', metavar='locus file')
 
    parser_ar.add_argument('-l', '--locus-format', default = 'VCF', help = 'STR. 位置文件的格式 （VCF, BED, POS）', dest='LOCUS_FORMAT')
@@ -51,9 +66,26 @@ def get_arguments() -> None:
    parser_ar.add_argument('-c', '--context', default=5, type=int, help= 'INT. 提取上下游的各n个碱基写入结果文件，默认值为5', metavar = '', dest='CONTEXT_FLANK')
 
    parser_ar.add_argument('-f', '--format', default='', help= 'STR. 需要额外输出的位点信息，用,分割，例如matched_snp_cycle,unmatched_snp_cycle', metavar = '', dest='FORAMT_STRING')
+   parser_ar.add_argument('--min-mapq', default=0, type=int, help= 'INT. 过滤MAPQ小于该值的reads，默认值为0', metavar = '', dest='MIN_MAPQ')
+   parser_ar.add_argument('--min-base-quality', default=0, type=int, help= 'INT. 过滤位点所在位置碱基测序质量小于该值的reads（deletion按下一个碱基的测序质量），默认值为0', metavar = '', dest='MIN_BASE_QUALITY')
+   parser_ar.add_argument('--include-flags', default='0', help= 'STR. 只保留flag包含全部这些位的reads（同samtools view -f），可以是整数或者以,分割的名称，例如PROPER_PAIR', metavar = '', dest='INCLUDE_FLAGS')
+   parser_ar.add_argument('--exclude-flags', default='0', help= 'STR. 过滤flag包含其中任何一位的reads（同samtools view -F），例如UNMAP,SECONDARY,QCFAIL,DUP或者0x704', metavar = '', dest='EXCLUDE_FLAGS')
+   parser_ar.add_argument('--ignore-overlaps', action='store_true', default=False, help= '同一对reads重叠时只计算测序质量较高的一条', dest='IGNORE_OVERLAPS')
+   parser_ar.add_argument('--max-depth', default=0, type=int, help= 'INT. 每个位点最多统计的reads数，超过时按F1/F2/R1/R2分层确定性降采样，并输出sampled_coverage列。逐条reads的统计与max_depth有关，htslib的pileup和抽样时读取flag、名称仍随深度增长。默认值为0（不降采样）', metavar = '', dest='MAX_DEPTH')
+   parser_ar.add_argument('--seed', default=0, type=int, help= 'INT. 降采样的随机种子，默认值为0', metavar = '', dest='SEED')
+   parser_ar.add_argument('--output-format', default='tsv', choices=['tsv', 'parquet', 'npz'], help= 'STR. 输出格式（tsv, parquet, npz），默认值为tsv。parquet需要安装pyarrow，格式说明见lib/columnar.py', metavar = '', dest='OUTPUT_FORMAT')
+   parser_ar.add_argument('--cohort-output', default='per-sample', choices=['per-sample', 'long'], help= 'STR. 多个比对文件时的输出方式，默认值为per-sample\nper-sample: 每个样本一个输出文件，-o为输出目录\nlong: 所有样本输出到一个文件，第一列为样本名（sample）', metavar = '', dest='COHORT_OUTPUT')
    parser_ar.add_argument('-n', '--no-header', action='store_true', default=False, help= '输出文件不需要header', dest='IS_NO_HEADER')
+   parser_ar.add_argument('--keep-locus-order', action='store_true', default=False, help= '不对位点做标准化，按位置文件中的顺序处理（重复的位点重复输出，比对文件中没有的染色体逐个报错）。默认按比对文件header中染色体的顺序和位置排序，合并重叠的区间并去掉重复的位点', dest='IS_KEEP_LOCUS_ORDER')
    parser_ar.add_argument('-u', '--locus-as-standard', action='store_true', default=False, help= '如果locus为VCF文件，则直接使用它作为标准位点', dest='LOCUS_AS_STANDARD')
+   parser_ar.add_argument('--truth-by-locus', action='store_true', default=False, help= '只读取标准位点VCF文件中与位置文件重叠的记录（有tabix索引时按区间读取），适用于小panel对比全基因组标准位点', dest='TRUTH_BY_LOCUS')
+   parser_ar.add_argument('--truth-cache-dir', default='', help= 'DIR. 标准位点编译结果（二进制索引）的缓存目录，默认为环境变量GET_POSITION_INFO_CACHE或者~/.cache/get_position_info/realsite', metavar = '', dest='TRUTH_CACHE_DIR')
+   parser_ar.add_argument('--truth-cache-size', default='10G', help= 'STR. 缓存目录的大小上限，例如500M, 10G，超过时删除最久没有使用的缓存，0为不限制。默认值为10G', metavar = '', dest='TRUTH_CACHE_SIZE')
+   parser_ar.add_argument('--truth-cache-key', default='stat', choices=['stat', 'content'], help= 'STR. 标准位点文件的标识方式，默认值为stat\nstat: 路径、大小和修改时间\ncontent: 文件内容的sha1，文件移动或复制后仍然使用缓存', metavar = '', dest='TRUTH_CACHE_KEY')
+   parser_ar.add_argument('--resume', action='store_true', default=False, help= '从上次中断的地方继续运行：跳过检查点目录（<输出文件>.chunks）中已完成的区块，只计算剩余的区块', dest='IS_RESUME')
+   parser_ar.add_argument('--profile', default='', help= 'FILE. 记录各个阶段（读取位置文件、标准位点、pileup、reads统计、输出格式化、queue等待等）的墙钟时间和CPU时间，每个进程的位点数和reads数，以及最慢的位点，运行结束后写入该json文件', metavar = '', dest='PROFILE')
    parser_ar.add_argument('-t', '--threads', default=10, type=int, help= 'INT. 进程数，默认值为10', metavar = '', dest='PROCESS')
+   parser_ar.add_argument('--io-threads', default='0', help= 'INT|auto. 每个进程打开比对文件（BAM/CRAM）时使用的htslib解压线程数，默认值为0（不使用解压线程）\nauto: 以-t和CPU数中较小的值为总线程数，每个CPU一个进程；只有任务数少于总线程数时，根据位点密度和是否为CRAM把多出的CPU作为解压线程', metavar = '', dest='IO_THREADS')
 
 
 
@@ -64,119 +96,377 @@ def get_arguments() -> None:
 
    ARGUMENTS_DICT['LOCUS_FORMAT'] = paramters.LOCUS_FORMAT
    ARGUMENTS_DICT['OUTPUT'] = paramters.OUTPUT
+   ARGUMENTS_DICT['OUTPUT_FORMAT'] = paramters.OUTPUT_FORMAT
+   ARGUMENTS_DICT['COHORT_OUTPUT'] = paramters.COHORT_OUTPUT
    ARGUMENTS_DICT['REFERENCE'] = paramters.REFERENCE_FILE
    ARGUMENTS_DICT['VCF_FILE'] = paramters.VCF_FILE
    ARGUMENTS_DICT['CONTEXT_FLANK'] = int(paramters.CONTEXT_FLANK)
 
    ARGUMENTS_DICT['FORAMT_STRING'] = paramters.FORAMT_STRING
+   ARGUMENTS_DICT['MIN_MAPQ'] = paramters.MIN_MAPQ
+   ARGUMENTS_DICT['MIN_BASE_QUALITY'] = paramters.MIN_BASE_QUALITY
+   ARGUMENTS_DICT['INCLUDE_FLAGS'] = paramters.INCLUDE_FLAGS
+   ARGUMENTS_DICT['EXCLUDE_FLAGS'] = paramters.EXCLUDE_FLAGS
+   ARGUMENTS_DICT['IGNORE_OVERLAPS'] = paramters.IGNORE_OVERLAPS
+   ARGUMENTS_DICT['MAX_DEPTH'] = paramters.MAX_DEPTH
+   ARGUMENTS_DICT['SEED'] = paramters.SEED
    ARGUMENTS_DICT['IS_NO_HEADER'] = paramters.IS_NO_HEADER
+   ARGUMENTS_DICT['IS_KEEP_LOCUS_ORDER'] = paramters.IS_KEEP_LOCUS_ORDER
    ARGUMENTS_DICT['LOCUS_AS_STANDARD'] = paramters.LOCUS_AS_STANDARD
+   ARGUMENTS_DICT['TRUTH_BY_LOCUS'] = paramters.TRUTH_BY_LOCUS
+   ARGUMENTS_DICT['TRUTH_CACHE_DIR'] = paramters.TRUTH_CACHE_DIR
+   ARGUMENTS_DICT['TRUTH_CACHE_SIZE'] = paramters.TRUTH_CACHE_SIZE
+   ARGUMENTS_DICT['TRUTH_CACHE_KEY'] = paramters.TRUTH_CACHE_KEY
    ARGUMENTS_DICT['PROCESS'] = paramters.PROCESS
+   ARGUMENTS_DICT['IO_THREADS'] = paramters.IO_THREADS
+   ARGUMENTS_DICT['IS_RESUME'] = paramters.IS_RESUME
+   ARGUMENTS_DICT['PROFILE'] = paramters.PROFILE
 
    return None
 
-# 写入结果文件, 输入'#done#'结束
-def write_file(q: mp.Queue, output_file: str):
-   """
-   持续监听queue，写入文件，在queue中输入'#done#'结束
-   continue to listen for messages on the queue and writes to file when receive one
-   if it receives a '#done#' message it will exit
-   """
-   with open(output_file, 'a', buffering = 1000) as out_f:
+# 写入进程：把结果按区块写入检查点目录，输入'#done#'结束
+def write_chunks(q: mp.Queue, checkpoint_dir_lst: list[str, ...], output_format: str):
+   '''
+   持续监听queue，queue中的每个消息是 ((输出文件序号, 区块序号), 一批结果, 区块位点数)，写入该输出文件的检查点目录中该区块的文件，在queue中输入'#done#'结束
+   一批结果在tsv输出时是多行文本，列式输出时是columnar.extract_row的返回值列表，为None时没有结果行
+   区块位点数不为None时，这是该区块的最后一个消息，区块完成并写入manifest（见checkpoint.ChunkWriter）
+   '''
+   chunk_writer_lst = [checkpoint.ChunkWriter(checkpoint_dir, output_format) for checkpoint_dir in checkpoint_dir_lst]
+   try:
       while True:
          m = q.get()
-         if m == '#done#':
+         if isinstance(m, str) and m == '#done#':
             break
-         out_f.write(m)
-         out_f.flush()
+
+         (output_i, chunk_id), payload, chunk_locus_int = m
+         if payload is not None:
+            chunk_writer_lst[output_i].write(chunk_id, payload)
+         if chunk_locus_int is not None:
+            chunk_writer_lst[output_i].commit(chunk_id, chunk_locus_int)
+   finally:
+      for chunk_writer in chunk_writer_lst:
+         chunk_writer.close()
+
+   return None
+
+# 将一批结果行发送给写入进程，并更新本进程的进度计数器
+def send_rows(chunk_key: tuple[int, int], row_lst: list[str, ...], locus_int: int, chunk_locus_int: int = None) -> None:
+   '''
+   将row_lst中的结果行合并成一个消息放入queue，然后将locus_int累加到本进程在共享内存数组中的计数器（见report_progress）
+
+   Parameters:
+      **chunk_key**: tuple[int, int]
+         结果所属的输出文件序号和区块序号
+
+      **row_lst**: list
+         结果行，tsv输出时每行为以'\\n'结尾的字符串，列式输出时每行为columnar.extract_row的返回值
+
+      **locus_int**: int
+         这批结果对应的位点数（包括出错而没有结果的位点）
+
+      **chunk_locus_int**: int
+         区块的最后一批结果时为区块的位点数，写入进程收到后提交该区块；其他时候为None
+   '''
+
+   if row_lst != []:
+      payload = ''.join(row_lst) if WORKER_DICT['ROW_EXTRACTOR'] is None else row_lst
+   else:
+      payload = None
+   if payload is not None or chunk_locus_int is not None:
+      profiler = WORKER_DICT['PROFILER']
+      if profiler is not None:
+         start = profiler.begin()
+      WORKER_DICT['QUEUE'].put((chunk_key, payload, chunk_locus_int))
+      if profiler is not None:
+         profiler.end('queue_put', start)
+
+   WORKER_DICT['PROGRESS'][WORKER_DICT['PROGRESS_SLOT']] += locus_int
+
+   return None
+
+def __format_seconds(seconds: float) -> str:
+   seconds = int(seconds)
+   return f'{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+# 主进程的进度线程：每隔PROGRESS_INTERVAL秒汇总各工作进程的计数器，打印已完成的位点数、总数、百分比、速度和预计剩余时间
+def report_progress(progress_array, base_int: int, total_lst: list, stop_event: threading.Event) -> None:
+   '''
+   打印进度，直到stop_event被设置
+
+   Parameters:
+      **progress_array**: mp.RawArray
+         每个工作进程一个计数器，见init_worker
+
+      **base_int**: int
+         续跑时已完成的位点数，不计入速度
+
+      **total_lst**: list
+         [位点总数]，来自位置文件的预扫描（见utils.scan_locus_file）或者由计数线程填入（见utils.count_loci），之前为[None]
+
+      **stop_event**: threading.Event
+         结束时设置
+   '''
+
+   start = time.perf_counter()
+   while not stop_event.wait(PROGRESS_INTERVAL):
+      done_int = sum(progress_array)
+      elapsed = time.perf_counter() - start
+      rate = done_int / elapsed if elapsed > 0 else 0
+      total_int = total_lst[0]
+      if total_int is None or total_int <= 0:
+         message = f'{done_int + base_int}  {rate:.0f} loci/s'
+      else:
+         remain_int = max(total_int - base_int - done_int, 0)
+         eta_str = __format_seconds(remain_int / rate) if rate > 0 else '-'
+         message = f'{done_int + base_int}/{total_int} ({(done_int + base_int) * 100 / total_int:.1f}%)  {rate:.0f} loci/s  ETA {eta_str}'
+      print(' '*80, end = '\r')
+      print(message, end = '\r', flush = True)
 
    return None
 
-def multiple_process_helper(bam_file: str, loci_lst: list, format_list: list, q: mp.Queue, reference_file: str = '', real_site_dict: dict = None, flank: int = 5, counter: mp.Value = None, counter_lock: mp.Lock = None) -> int:
+# 每个工作进程启动时运行一次，打开bam文件和参考基因组，保存在WORKER_DICT中，供之后的每个任务使用
+def init_worker(sample_lst: list[tuple[str, str], ...], plan: info.FormatPlan, q: mp.Queue, reference_file: str = '', real_site_index_file: str = '', flank: int = 5, progress_array = None, slot_value: mp.Value = None, output_format: str = 'tsv', io_thread_int: int = 0, read_filter: info.ReadFilter = None, is_profile: bool = False, is_keep_locus_order: bool = False) -> None:
    '''
-   多线程运行的helper，负责打开bam_file, 返回句柄，收集位点信息，写入StringIO
+   工作进程的初始化函数
 
    Parameters:
-      **bam_file**: string
-         bam file
+      **sample_lst**: list[tuple[str, str], ...]
+         样本名和比对文件，见utils.parse_bam_list。比对文件在第一次用到时才打开
 
-      **loci_lst**: list[tuple[str, int, str], ...]
-         chrom, pos, other
+      **plan**: info.FormatPlan
+         由输出属性列表编译得到的计算计划，见info.compile_format_plan
 
       **reference_file**: 参考基因组
-         indexed fasta file
+         indexed fasta file，同时用于解码CRAM文件
+
+      **real_site_index_file**: str
+         标准位点索引文件（见realsite.write_real_site_index），为''时不比较标准位点
+
+      **output_format**: str
+         'tsv'时输出文本行，否则输出columnar.extract_row的结果，由写入进程按列写入
+
+      **io_thread_int**: int
+         每个比对文件句柄的htslib解压线程数，见utils.open_alignment
+
+      **read_filter**: info.ReadFilter
+         reads的过滤条件，为None时不过滤
+
+      **progress_array, slot_value**:
+         进度计数器数组（每个进程一个）和下一个可用的序号，进程启动时领取一个序号，之后只写自己的计数器
+
+      **is_profile**: bool
+         是否记录各个阶段的时间（--profile），见lib/profiling.py
+
+      **is_keep_locus_order**: bool
+         --keep-locus-order，结果行按区块中位点的顺序输出，见multiple_process_helper
+
+      其他参数见multiple_process_helper
+   '''
+
+   WORKER_DICT['SAMPLES'] = sample_lst
+   WORKER_DICT['BAM_AF_DICT'] = {}  # {样本序号: pysam.AlignmentFile}
+   WORKER_DICT['REFERENCE_FILE'] = reference_file
+   WORKER_DICT['IO_THREADS'] = io_thread_int
+
+   # 初始化函数抛出异常时进程池会不断重新启动工作进程，所以保存异常，由第一个任务抛出，经imap_unordered返回主进程
+   WORKER_DICT['REFERENCE'] = None
+   WORKER_DICT['REAL_SITE_INDEX'] = None
+   WORKER_DICT['INIT_ERROR'] = None
+   try:
+      if reference_file != '':
+         WORKER_DICT['REFERENCE'] = utils.ReferenceGenome(reference_file)
+      if real_site_index_file != '':
+         WORKER_DICT['REAL_SITE_INDEX'] = realsite.RealSiteIndex(real_site_index_file)
+   except Exception as ex:
+      WORKER_DICT['INIT_ERROR'] = ex
+
+   WORKER_DICT['PLAN'] = plan
+   WORKER_DICT['READ_FILTER'] = read_filter
+   WORKER_DICT['ROW_EXTRACTOR'] = columnar.compile_row_extractor(columnar.column_names(plan.attributes)) if output_format != 'tsv' else None
+   WORKER_DICT['QUEUE'] = q
+   WORKER_DICT['FLANK'] = flank
+   WORKER_DICT['KEEP_LOCUS_ORDER'] = is_keep_locus_order
+   with slot_value.get_lock():  # 进程池补充的新进程（原进程异常退出）领取的序号会超出数组长度，与已退出的进程共用计数器
+      WORKER_DICT['PROGRESS_SLOT'] = slot_value.value % len(progress_array)
+      slot_value.value += 1
+   WORKER_DICT['PROGRESS'] = progress_array
+   WORKER_DICT['PROFILER'] = profiling.StageProfiler() if is_profile else None
 
+   return None
+
+# 一个位点的结果行：tsv输出时为以'\n'结尾的文本行，列式输出时为columnar.extract_row的返回值
+def __format_output_row(pos_PositionInfo: info.PositionInfo, plan: info.FormatPlan, row_extractor):
+   if row_extractor is None:
+      return info.format_row(pos_PositionInfo, plan.row_formatter) + '\n'
+   return columnar.extract_row(pos_PositionInfo, row_extractor)
+
+def multiple_process_helper(task: tuple[int, tuple[int, int], list]) -> tuple[int, dict]:
+   '''
+   多进程运行的helper，处理任务队列中的一个基因组区块，收集位点信息，写入queue
+   bam文件，参考基因组等由init_worker在进程启动时打开
+
+   Parameters:
+      **task**: tuple[int, tuple[int, int], list[tuple[str, int, str], ...]]
+         样本序号，(输出文件序号, 区块序号)，区块中的位点（chrom, pos, other，见utils.chunk_loci）。
+         多个样本共用同一个位置文件的区块，每个(样本, 区块)是一个任务
 
    Returns:
-       **value**: type
-           0 on success, other on failure
+       **value**: int
+           区块中的位点数
+
+       **profile_dict**: dict
+           使用--profile时为本进程自上一个任务以来的统计（见profiling.StageProfiler.drain），否则为None
    '''
 
+   if WORKER_DICT['INIT_ERROR'] is not None:
+      raise WORKER_DICT['INIT_ERROR']
 
-   bam_af = pysam.AlignmentFile(path.realpath(path.expanduser(bam_file)))
+   profiler = WORKER_DICT['PROFILER']
+   if profiler is not None:
+      task_start = profiler.begin()
 
-   if reference_file != '':
-      genome_reference_file_handle, index_dict = utils.read_reference(reference_file)
-   else:
-      genome_reference_file_handle = None
-      index_dict = None
+   sample_i, chunk_key, loci_lst = task
+   sample_str, bam_file = WORKER_DICT['SAMPLES'][sample_i]
+   try:
+      bam_af = WORKER_DICT['BAM_AF_DICT'][sample_i]
+   except KeyError:
+      if profiler is not None:
+         start = profiler.begin()
+      bam_af = utils.open_alignment(bam_file, WORKER_DICT['REFERENCE_FILE'], WORKER_DICT['IO_THREADS'])
+      WORKER_DICT['BAM_AF_DICT'][sample_i] = bam_af
+      if profiler is not None:
+         profiler.end('open_bam', start)
+   reference_genome = WORKER_DICT['REFERENCE']
+   plan = WORKER_DICT['PLAN']
+   read_filter = WORKER_DICT['READ_FILTER']
+   row_extractor = WORKER_DICT['ROW_EXTRACTOR']
+   real_site_index = WORKER_DICT['REAL_SITE_INDEX']
+   flank = WORKER_DICT['FLANK']
+   is_keep_locus_order = WORKER_DICT['KEEP_LOCUS_ORDER']
+
+   row_lst = []  # 尚未发送的结果行
+   locus_int = 0  # 尚未计入进度的位点数
+   pos_info_dict = {}  # --keep-locus-order时每个位置的结果 {(chrom, pos): PositionInfo}，全部窗口完成后按区块中位点的顺序输出
 
    # ==================================================
-   i = 0
+   # 按照bam文件header中染色体的顺序排序，然后将相邻的位点合并成窗口，每个窗口只做一次pileup
+   sorted_loci_lst = []
    for chrom, pos, other_str in loci_lst:
-      with counter_lock:
-         counter.value += 1
-         if counter.value % 1000 == 0:
-            print(' '*50, end = '\r')
-            print('{}\t{}\t{}'.format(counter.value, chrom, pos), end = '\r')
-
-      if genome_reference_file_handle is not None and index_dict is not None:
-         ref_base = utils.get_base_fast(genome_reference_file_handle, index_dict, chrom, pos)
-         context = utils.get_base_fast(genome_reference_file_handle, index_dict, chrom, pos - flank, end = pos + flank)
-      else:
-         ref_base = ''
-         context = ''
-
-      if real_site_dict is not None:
-         real_allele_snp = []
-         real_allele_indel = []
-         for real_allele_str in real_site_dict[(chrom, pos)]:
-            if '+' in real_allele_str or '-' in real_allele_str:
-               real_allele_indel.append(real_allele_str)
-            else:
-               real_allele_snp.append(real_allele_str)
-      else:
-         real_allele_snp = None
-         real_allele_indel = None
-
-      try:
-         # real_allele_snp 和 real_allele_indel 都是 [str, ...]
-         pos_PositionInfo = info.get_pos_info(bam_af, chrom, pos, real_allele_snp, real_allele_indel)
-         pos_PositionInfo.reference = ref_base
-         pos_PositionInfo.context = context
-         pos_PositionInfo.real_allele_snp = real_allele_snp
-         pos_PositionInfo.real_allele_indel = real_allele_indel
-         pos_PositionInfo.other = other_str
-      except Exception as ex:
-         message = 'multiple_process_helper：位置文件 Line {}: {} {} {}'.format(i, chrom, pos, ex)
+      if pos < 1:
+         if not is_keep_locus_order:  # --keep-locus-order时在最后按顺序输出时计数
+            locus_int += 1
+         message = 'multiple_process_helper：位点 {}:{} start out of range ({})'.format(chrom, pos, pos - 1)
          print(message)
          continue
 
-      _ = info.add_attributes_pos_info(pos_PositionInfo)
-      line_str = info.output_attributes_pos_info(pos_PositionInfo, format_list)
-      q.put(line_str + '\n')
+      sorted_loci_lst.append((chrom, pos, other_str))
+   sorted_loci_lst.sort(key = lambda x: (bam_af.get_tid(x[0]), x[1]))
+
+   for chrom, window_lst in utils.group_loci_windows(sorted_loci_lst):
+      other_dict = collections.defaultdict(list)  # {pos: [other_str, ...]}, 同一个位置可能出现多次
+      for _, pos, other_str in window_lst:
+         other_dict[pos].append(other_str)
+      pos_lst = list(other_dict.keys())  # 排序且不重复
+
+      real_allele_lst = []
+      for pos in pos_lst:
+         if real_site_index is not None:
+            real_allele_snp = []
+            real_allele_indel = []
+            for real_allele_str in real_site_index[(chrom, pos)]:
+               if '+' in real_allele_str or '-' in real_allele_str:
+                  real_allele_indel.append(real_allele_str)
+               else:
+                  real_allele_snp.append(real_allele_str)
+         else:
+            real_allele_snp = None
+            real_allele_indel = None
+         real_allele_lst.append((real_allele_snp, real_allele_indel))
+
+      # 一次pileup扫过整个窗口。如果某个位置出错，报告该位置后从下一个位置重新开始扫描
+      # 参考基因组的碱基和上下游序列也是整个窗口一次读取（在try中读取，染色体不在参考基因组中时逐个报告位点）
+      reference_lst = None  # 与pos_lst一一对应的(碱基, 上下游序列)
+      i = 0
+      while i < len(pos_lst):
+         try:
+            if reference_lst is None:
+               if profiler is not None:
+                  start = profiler.begin()
+               if reference_genome is not None:
+                  reference_lst = reference_genome.fetch_loci(chrom, pos_lst, flank, 'reference' in plan.attributes, 'context' in plan.attributes)
+               else:
+                  reference_lst = [('', '')] * len(pos_lst)
+               if profiler is not None:
+                  profiler.end('reference', start)
+
+            if profiler is not None:
+               locus_start = profiler.begin()
+            for pos_PositionInfo in info.sweep_pos_info(bam_af, chrom, pos_lst[i:], real_allele_lst[i:], plan, read_filter, profiler):
+               pos = pos_PositionInfo.pos
+               pos_PositionInfo.reference, pos_PositionInfo.context = reference_lst[i]
+               pos_PositionInfo.sample = sample_str
+               if profiler is not None:
+                  start = profiler.begin()
+               _ = info.add_attributes_pos_info(pos_PositionInfo, plan)
+               if profiler is not None:
+                  profiler.end('attributes', start)
+                  start = profiler.begin()
+
+               if is_keep_locus_order:
+                  pos_info_dict[(chrom, pos)] = pos_PositionInfo
+               else:
+                  for other_str in other_dict[pos]:
+                     pos_PositionInfo.other = other_str
+                     row_lst.append(__format_output_row(pos_PositionInfo, plan, row_extractor))
+                     locus_int += 1
+
+               if profiler is not None:
+                  profiler.end('format', start)
+                  profiler.add_locus(sample_str, chrom, pos, pos_PositionInfo.coverage, locus_start)
+
+               i += 1
+               if len(row_lst) >= BATCH_SIZE:
+                  send_rows(chunk_key, row_lst, locus_int)
+                  row_lst = []
+                  locus_int = 0
+
+               if profiler is not None:  # 下一个位点的时间从这里开始，包括pileup经过的没有查询的位置
+                  locus_start = profiler.begin()
+
+         except Exception as ex:
+            if not is_keep_locus_order:
+               locus_int += len(other_dict[pos_lst[i]])
+            message = 'multiple_process_helper：位点 {}:{} {}'.format(chrom, pos_lst[i], ex)
+            print(message)
+            i += 1
+
+   # --keep-locus-order：按区块中位点的顺序输出，重复的位点重复输出，出错的位点没有结果行
+   if is_keep_locus_order:
+      if profiler is not None:
+         start = profiler.begin()
+      for chrom, pos, other_str in loci_lst:
+         locus_int += 1
+         pos_PositionInfo = pos_info_dict.get((chrom, pos))
+         if pos_PositionInfo is None:
+            continue
+         pos_PositionInfo.other = other_str
+         row_lst.append(__format_output_row(pos_PositionInfo, plan, row_extractor))
+         if len(row_lst) >= BATCH_SIZE:
+            send_rows(chunk_key, row_lst, locus_int)
+            row_lst = []
+            locus_int = 0
+      if profiler is not None:
+         profiler.end('format', start)
 
-   try:
-      bam_af.close()
-   except:
-      pass
+   # 最后一批结果同时提交区块（utils.chunk_loci不会产生空区块），没有结果行时也要发送
+   send_rows(chunk_key, row_lst, locus_int, len(loci_lst))
 
-   try:
-      genome_reference_file_handle.close()
-   except:
-      pass
+   if profiler is not None:
+      profiler.task_int += 1
+      profiler.end('task', task_start)
+      return len(loci_lst), profiler.drain()
 
-   return 0
+   return len(loci_lst), None
 
 def main(argvList = sys.argv, argv_int = len(sys.argv)):
 
@@ -186,12 +476,31 @@ def main(argvList = sys.argv, argv_int = len(sys.argv)):
 
    # = = = = = = = = = = = = = = = = = = optional parameters = = = = = = = = = = = = = = = = = =
    OUTPUT = ARGUMENTS_DICT['OUTPUT']
-   if OUTPUT == '':
-      locus_basename_str = path.splitext(path.split(LOCUS_FILE)[-1])[0]  # LOCUS_FILE 如果是'~/locus/locus.vcf'，locus_basename_str就是locus
-      bam_basename_str = path.splitext(path.split(BAM_FILE)[-1])[0]  # BAM_FILE的文件名
-      output_str = bam_basename_str + '_' + locus_basename_str + '.tsv'
+   OUTPUT_FORMAT = ARGUMENTS_DICT['OUTPUT_FORMAT']
+   try:
+      columnar.check_output_format(OUTPUT_FORMAT)
+   except ValueError as ex:
+      sys.exit(str(ex))
+
+   try:
+      sample_lst = utils.parse_bam_list(BAM_FILE)  # [(样本名, 比对文件), ...]
+   except (ValueError, OSError) as ex:
+      sys.exit(str(ex))
+   sample_int = len(sample_lst)
+   IS_LONG = ARGUMENTS_DICT['COHORT_OUTPUT'] == 'long' and sample_int > 1
+
+   # 每个输出文件对应一组样本：per-sample时每个样本一个输出文件，long时全部样本一个输出文件
+   locus_basename_str = path.splitext(path.split(LOCUS_FILE)[-1])[0]  # LOCUS_FILE 如果是'~/locus/locus.vcf'，locus_basename_str就是locus
+   suffix_str = columnar.SUFFIX_DICT[OUTPUT_FORMAT]
+   if IS_LONG:
+      output_lst = [path.realpath(path.expanduser(OUTPUT)) if OUTPUT != '' else 'cohort_' + locus_basename_str + suffix_str]
+   elif sample_int == 1 and OUTPUT != '':
+      output_lst = [path.realpath(path.expanduser(OUTPUT))]
    else:
-      output_str = path.realpath(path.expanduser(OUTPUT))
+      output_dir_str = path.realpath(path.expanduser(OUTPUT)) if OUTPUT != '' else ''  # 多个样本时-o为输出目录
+      if output_dir_str != '':
+         os.makedirs(output_dir_str, exist_ok = True)
+      output_lst = [path.join(output_dir_str, sample_str + '_' + locus_basename_str + suffix_str) for sample_str, _ in sample_lst]
 
    REFERENCE_FILE = ARGUMENTS_DICT['REFERENCE'] # /share/data/reference/human/b37/Homo_sapiens_assembly19.fasta
    GOLDEN_FILE = ARGUMENTS_DICT['VCF_FILE']
@@ -202,69 +511,259 @@ def main(argvList = sys.argv, argv_int = len(sys.argv)):
 
    FORAMT_STRING = ARGUMENTS_DICT['FORAMT_STRING']
    IS_NO_HEADER = ARGUMENTS_DICT['IS_NO_HEADER']
+   IS_KEEP_LOCUS_ORDER = ARGUMENTS_DICT['IS_KEEP_LOCUS_ORDER']
    LOCUS_AS_STANDARD = ARGUMENTS_DICT['LOCUS_AS_STANDARD']
+   TRUTH_BY_LOCUS = ARGUMENTS_DICT['TRUTH_BY_LOCUS']
+   TRUTH_CACHE_DIR = ARGUMENTS_DICT['TRUTH_CACHE_DIR']
+   try:
+      TRUTH_CACHE_SIZE = truthcache.parse_size(ARGUMENTS_DICT['TRUTH_CACHE_SIZE'])
+   except ValueError as ex:
+      sys.exit(str(ex))
+   TRUTH_CACHE_KEY = ARGUMENTS_DICT['TRUTH_CACHE_KEY']
    PROCESS = ARGUMENTS_DICT['PROCESS']
+   IO_THREADS = ARGUMENTS_DICT['IO_THREADS']
+   try:
+      read_filter = info.ReadFilter(min_mapq = ARGUMENTS_DICT['MIN_MAPQ'], min_base_quality = ARGUMENTS_DICT['MIN_BASE_QUALITY'], include_flags = utils.parse_flags(ARGUMENTS_DICT['INCLUDE_FLAGS']),
+                                    exclude_flags = utils.parse_flags(ARGUMENTS_DICT['EXCLUDE_FLAGS']), ignore_overlaps = ARGUMENTS_DICT['IGNORE_OVERLAPS'],
+                                    max_depth = max(ARGUMENTS_DICT['MAX_DEPTH'], 0), seed = ARGUMENTS_DICT['SEED'])
+   except ValueError as ex:
+      sys.exit(str(ex))
+   IS_RESUME = ARGUMENTS_DICT['IS_RESUME']
+   PROFILE = ARGUMENTS_DICT['PROFILE']
 
    # = = = = = = = = = = = = = = = = = = analysis = = = = = = = = = = = = = = = = = =
-   manager = mp.Manager()
-   q = manager.Queue()
-   try:
-      os.remove(output_str)
-   except:
-      pass
+   # 主进程的几个阶段只计时几次，总是记录；工作进程只在--profile时记录（见lib/profiling.py）
+   main_profiler = profiling.StageProfiler()
+   run_start = main_profiler.begin()
 
+   is_cram = any([bam_file.endswith('.cram') for _, bam_file in sample_lst])
+   if is_cram and REFERENCE_FILE == '':
+      print('CRAM文件没有指定-r参考基因组，htslib将根据header中的UR/M5和REF_PATH, REF_CACHE环境变量查找参考基因组')
+
+   # 在建立任务之前检查每个比对文件都能打开并且有索引，否则要等到工作进程打开它时才出错
+   for sample_i, (sample_str, bam_file) in enumerate(sample_lst):
+      try:
+         with utils.open_alignment(bam_file, REFERENCE_FILE) as bam_af:
+            if not bam_af.has_index():
+               raise ValueError('没有索引文件（.bai, .csi或.crai），请先使用samtools index')
+            if sample_i == 0:
+               contig_lst = list(bam_af.references)  # 位点按第一个比对文件header中染色体的顺序排序
+      except (ValueError, OSError) as ex:
+         sys.exit(f'样本 {sample_str} 的比对文件 {bam_file} 不可用：{ex}')
+
+   # 位点的标准化（见utils.normalize_loci）：按第一个比对文件header中染色体的顺序和位置排序，合并重叠的区间，去掉重复的位点
+   # 先扫描一遍位置文件（见utils.scan_locus_file），header中没有的染色体在开始pileup之前报告并跳过。
+   # 预扫描同时得到进度的总数和--truth-by-locus需要的区间，之后只在分发任务时再读一遍位置文件
+   if not IS_KEEP_LOCUS_ORDER:
+      with main_profiler.stage('parse_locus'):
+         locus_scan = utils.scan_locus_file(LOCUS_FILE, ARGUMENTS_DICT['LOCUS_FORMAT'], contig_lst, is_region = TRUTH_BY_LOCUS)
+      if locus_scan.unknown_dict != {}:
+         print(f'位置文件中以下染色体不在比对文件 {sample_lst[0][1]} 的header中，跳过{sum(locus_scan.unknown_dict.values())}个位点：' + ', '.join([f'{chrom}({locus_int})' for chrom, locus_int in locus_scan.unknown_dict.items()]))
+
+   def locus_iter(drop_callback = None):
+      if IS_KEEP_LOCUS_ORDER:
+         return utils.parse_locus(LOCUS_FILE, ARGUMENTS_DICT['LOCUS_FORMAT'])
+      return utils.normalize_loci(LOCUS_FILE, ARGUMENTS_DICT['LOCUS_FORMAT'], contig_lst, locus_scan, drop_callback)
+
+   # 进程数 × 每个比对文件句柄的htslib解压线程数
+   if IO_THREADS == 'auto':
+      # 用第一个区块估计位点密度；最多读取总线程数个区块，区块更少时任务数少于线程数，多出的CPU才作为解压线程
+      thread_int = min(PROCESS, os.cpu_count() or 1)
+      head_chunk_lst = list(itertools.islice(utils.chunk_loci(locus_iter(), CHUNK_SIZE), thread_int))
+      PROCESS, io_thread_int = utils.split_threads(thread_int, utils.loci_per_window(head_chunk_lst[0] if head_chunk_lst != [] else []), is_cram, len(head_chunk_lst) * sample_int)
+      print(f'--io-threads auto: {PROCESS}个进程，每个进程{io_thread_int}个解压线程')
+   else:
+      try:
+         io_thread_int = max(int(IO_THREADS), 0)
+      except ValueError:
+         sys.exit(f'--io-threads 必须是整数或者auto，输入为{IO_THREADS}')
+
+   q = mp.Queue(maxsize = PROCESS * QUEUE_BATCHES_PER_PROCESS)
 
    print('读取位点...')
    if LOCUS_AS_STANDARD and (LOCUS_FILE.endswith('.vcf.gz') or LOCUS_FILE.endswith('.vcf')):
       GOLDEN_FILE = LOCUS_FILE
 
+   truth_start = main_profiler.begin()
    if GOLDEN_FILE != '':
       format_list = ['chrom', 'pos', 'reference', 'context', 'coverage', 'A_count', 'T_count', 'C_count', 'G_count', 'N_count', 'miss_count', 'background_count', 'query_snp_counter', 'real_allele_snp', 'matched_snp_count', 'unmatched_snp_count', 'query_indel_counter', 'real_allele_indel', 'matched_indel_count', 'unmatched_indel_count']
-      if GOLDEN_FILE.endswith('.realsite') or os.access(GOLDEN_FILE.split('.gz')[0] + '.realsite', os.R_OK):
-         real_site_dict = vcf.get_real_variants_from_realsite(GOLDEN_FILE)
-      elif GOLDEN_FILE.endswith('.vcf') or GOLDEN_FILE.endswith('.vcf.gz'):
-         real_site_dict = vcf.get_real_variants_from_vcf(GOLDEN_FILE)
-      else:
+      if not (GOLDEN_FILE.endswith('.vcf') or GOLDEN_FILE.endswith('.vcf.gz') or GOLDEN_FILE.endswith('.realsite') or GOLDEN_FILE.endswith(realsite.SUFFIX)):
          message = f'标准位点必须是vcf文件或者是realsite文件，输入为{GOLDEN_FILE}'
          sys.exit(message)
+
+      # 标准位点编译为只读的二进制索引文件，工作进程通过mmap共享查询，不需要各自复制一份字典
+      if TRUTH_BY_LOCUS and (GOLDEN_FILE.endswith('.vcf') or GOLDEN_FILE.endswith('.vcf.gz')):
+         if IS_KEEP_LOCUS_ORDER:
+            region_dict = utils.merge_regions((chrom, pos, pos) for chrom, pos, _ in utils.parse_locus(LOCUS_FILE, ARGUMENTS_DICT['LOCUS_FORMAT']))
+         else:
+            region_dict = locus_scan.region_dict
+         real_site_dict = vcf.get_real_variants_for_regions(GOLDEN_FILE, region_dict)
+         real_site_index_file, is_temporary_index = realsite.make_temporary_index(real_site_dict), True
+         del real_site_dict
+      else:
+         real_site_index_file, is_temporary_index = vcf.compile_real_site_index(GOLDEN_FILE, processes = max(PROCESS, 1), cache_dir = TRUTH_CACHE_DIR, max_cache_size = TRUTH_CACHE_SIZE, key_mode = TRUTH_CACHE_KEY)
    else:
-      real_site_dict = None
+      real_site_index_file = ''
+      is_temporary_index = False
       format_list = ['chrom', 'pos', 'reference', 'context', 'coverage', 'A_count', 'T_count', 'C_count', 'G_count', 'N_count', 'miss_count', 'background_count', 'query_snp_counter', 'query_indel_counter']
+   main_profiler.end('truth', truth_start)
+
+   # 降采样时X_count等统计只包括抽中的reads，同时输出全部reads数（coverage）和参与统计的reads数（sampled_coverage）
+   if read_filter.max_depth > 0:
+      format_list.insert(format_list.index('coverage') + 1, 'sampled_coverage')
 
    if FORAMT_STRING != '':
       format_list.extend(FORAMT_STRING.split(','))
 
-   print('读取位置...')
-   locus_iter = utils.parse_locus(LOCUS_FILE, ARGUMENTS_DICT['LOCUS_FORMAT'])  #
-   locus_lst = list(locus_iter)  # [[chrom, int, other], [chrom, int, other], ...]
-   chunk_int = min([len(locus_lst), PROCESS])
-   item_lst = utils.slice_list(locus_lst, chunk_int)
-
-   file_pool = mp.Pool(1)
-   file_pool.apply_async(write_file, (q, output_str, ))
-
+   if IS_LONG:
+      format_list.insert(0, 'sample')
 
-   header_str = '\t'.join(format_list)
-   if not IS_NO_HEADER:
-      q.put(header_str + '\n')
-
-   pool = mp.Pool(chunk_int)
-   counter = manager.Value('i', 0)
-   counter_lock = manager.Lock()
-   jobs = []
-   for loci_lst in item_lst:
-      # real_site_dict
-      job = pool.apply_async(multiple_process_helper, (BAM_FILE, loci_lst, format_list, q, REFERENCE_FILE, real_site_dict, CONTEXT_FLANK, counter, counter_lock, ))
-      jobs.append(job)
-
-   for job in jobs:
-      job.get()
-
-   q.put('#done#')  # all workers are done, we close the output file
-   pool.close()
-   pool.join()
+   # 将输出属性编译为计算计划，工作进程只计算计划中需要的数值
+   try:
+      plan = info.compile_format_plan(format_list)
+   except ValueError as ex:
+      if is_temporary_index:
+         os.remove(real_site_index_file)
+      sys.exit(str(ex))
 
-   print(counter.value, 'loci Done', output_str)
+   # 工作进程在初始化时打开参考基因组和标准位点索引，先在主进程中打开一次，文件有问题时在启动进程池之前退出
+   try:
+      if REFERENCE_FILE != '':
+         utils.ReferenceGenome(REFERENCE_FILE, is_quiet = False).close()
+      if real_site_index_file != '':
+         realsite.RealSiteIndex(real_site_index_file).close()
+   except (ValueError, OSError) as ex:
+      if is_temporary_index:
+         os.remove(real_site_index_file)
+      sys.exit(str(ex))
+
+   # 结果按区块写入检查点目录，全部完成后再合并成输出文件。运行参数相同时，--resume跳过已完成的区块
+   # 进程数不影响区块的划分，所以续跑时可以使用不同的进程数
+   checkpoint_dir_lst = []
+   finished_lst = []  # 每个输出文件已完成的区块 {区块序号: 位点数}
+   for output_i, output_str in enumerate(output_lst):
+      output_sample_lst = sample_lst if IS_LONG else sample_lst[output_i:output_i + 1]
+      checkpoint_dir = checkpoint.checkpoint_dir_for(output_str)
+      fingerprint_str = checkpoint.run_fingerprint({'bam': [(sample_str, checkpoint.file_signature(bam_file)) for sample_str, bam_file in output_sample_lst],
+                                                    'locus': checkpoint.file_signature(LOCUS_FILE), 'locus_format': ARGUMENTS_DICT['LOCUS_FORMAT'],
+                                                    'reference': checkpoint.file_signature(REFERENCE_FILE), 'golden': checkpoint.file_signature(GOLDEN_FILE), 'truth_by_locus': TRUTH_BY_LOCUS,
+                                                    'flank': CONTEXT_FLANK, 'format': format_list, 'output_format': OUTPUT_FORMAT, 'chunk_size': CHUNK_SIZE, 'read_filter': read_filter.header_str(),
+                                                    'keep_locus_order': IS_KEEP_LOCUS_ORDER})
+      try:
+         finished_dict = checkpoint.open_checkpoint(checkpoint_dir, fingerprint_str, IS_RESUME)
+      except ValueError as ex:
+         if is_temporary_index:
+            os.remove(real_site_index_file)
+         sys.exit(str(ex))
+      if finished_dict != {}:
+         print(f'续跑：{output_str} 跳过{len(finished_dict)}个已完成的区块')
+
+      checkpoint_dir_lst.append(checkpoint_dir)
+      finished_lst.append(finished_dict)
+
+   process_int = max(PROCESS, 1)
+
+   file_process = mp.Process(target = write_chunks, args = (q, checkpoint_dir_lst, OUTPUT_FORMAT, ))
+   file_process.start()
+
+   # 进度：每个工作进程一个共享内存计数器，每批结果更新一次，不加锁；主进程的线程定时汇总并打印（见report_progress）
+   progress_array = mp.RawArray('q', process_int)
+   slot_value = mp.Value('i', 0)
+   base_int = sum([sum(finished_dict.values()) for finished_dict in finished_lst])  # 续跑时已完成的位点数
+   # 标准化时总数来自预扫描，重复的位点被合并掉时再从总数中减去（见drop_loci）；--keep-locus-order时由另一个线程统计
+   total_lst = [None]
+   def count_total():
+      total_lst[0] = utils.count_loci(LOCUS_FILE, ARGUMENTS_DICT['LOCUS_FORMAT']) * sample_int
+   def drop_loci(drop_int: int) -> None:
+      total_lst[0] -= drop_int * sample_int
+   if IS_KEEP_LOCUS_ORDER:
+      threading.Thread(target = count_total, daemon = True).start()
+   else:
+      total_lst[0] = sum(locus_scan.locus_dict.values()) * sample_int
+   stop_event = threading.Event()
+   progress_thread = threading.Thread(target = report_progress, args = (progress_array, base_int, total_lst, stop_event), daemon = True)
+   progress_thread.start()
+   # 边读取位置文件边分割成基因组区块，每个进程空闲时从任务队列中领取下一个任务。位置文件只读取一次，每个区块对每个样本各产生一个任务
+   # 进程池的任务线程从task_iter中取任务，已读入但尚未完成的任务达到上限时阻塞，直到有任务完成
+   # 任务出错或者被中断时没有任务会再完成，所以阻塞时定时检查task_stop_event，设置后task_iter结束，pool.terminate()才能等到任务线程退出
+   print('读取位置...')
+   pending_semaphore = threading.BoundedSemaphore(process_int * PENDING_CHUNKS_PER_PROCESS)
+   task_stop_event = threading.Event()
+   chunk_int = 0  # 位置文件的区块总数，区块序号即区块在位置文件中的顺序
+   def task_iter():
+      nonlocal chunk_int
+      for chunk_id, chunk_lst in enumerate(main_profiler.timed_iter('parse_locus', utils.chunk_loci(locus_iter(drop_loci), CHUNK_SIZE))):
+         chunk_int = chunk_id + 1
+         for sample_i in range(sample_int):
+            # long输出时同一个区块的各个样本依次排列：区块序号 * 样本数 + 样本序号
+            output_i, part_id = (0, chunk_id * sample_int + sample_i) if IS_LONG else (sample_i, chunk_id)
+            if part_id in finished_lst[output_i]:
+               continue
+            while not pending_semaphore.acquire(timeout = PENDING_POLL_INTERVAL):
+               if task_stop_event.is_set():
+                  return None
+            if task_stop_event.is_set():
+               return None
+            yield sample_i, (output_i, part_id), chunk_lst
+
+   worker_profiler_dict = {}  # {进程号: profiling.StageProfiler}
+   pool = None
+   try:
+      pool_start = main_profiler.begin()
+      pool = mp.Pool(process_int, initializer = init_worker, initargs = (sample_lst, plan, q, REFERENCE_FILE, real_site_index_file, CONTEXT_FLANK, progress_array, slot_value, OUTPUT_FORMAT, io_thread_int, read_filter, PROFILE != '', IS_KEEP_LOCUS_ORDER, ))
+      for _, profile_dict in pool.imap_unordered(multiple_process_helper, task_iter()):
+         pending_semaphore.release()
+         if profile_dict is not None:
+            worker_profiler_dict.setdefault(profile_dict['pid'], profiling.StageProfiler()).merge(profile_dict)
+
+      # 工作进程退出时才会把queue中缓冲的结果全部送出，所以先等待进程池结束，再通知写入进程
+      pool.close()
+      pool.join()
+      q.put('#done#')  # all workers are done, we close the output file
+      file_process.join()
+      main_profiler.end('pool', pool_start)
+   except BaseException as ex:
+      # 任务出错或者被中断时终止进程池和写入进程，否则写入进程一直等待'#done#'，主进程无法退出
+      # 写入进程被终止时未完成的区块不在manifest中（见lib/checkpoint.py），已完成的区块可以用--resume续跑
+      task_stop_event.set()
+      try:
+         pending_semaphore.release()
+      except ValueError:  # 没有被占用的名额
+         pass
+      if pool is not None:
+         pool.terminate()
+         pool.join()
+      file_process.terminate()
+      file_process.join()
+      if not isinstance(ex, Exception):
+         raise
+      sys.exit(f'运行出错，已终止：{type(ex).__name__}: {ex}\n已完成的区块保存在检查点目录中，修正后可以使用--resume继续运行')
+   finally:
+      stop_event.set()
+      progress_thread.join()
+      if is_temporary_index:
+         os.remove(real_site_index_file)
+
+   # 按区块序号合并，与区块的完成顺序和是否续跑无关
+   # 使用了reads过滤条件时，记录在header中：tsv为以##开头的一行，列式文件为元数据
+   metadata_dict = {'read_filter': read_filter.header_str()} if read_filter.is_active else {}
+   header_str = ''
+   if not IS_NO_HEADER and OUTPUT_FORMAT == 'tsv':  # 列式文件自带列名
+      header_str = ''.join([f'##{key_str}={value_str}\n' for key_str, value_str in metadata_dict.items()]) + '\t'.join(format_list) + '\n'
+   try:
+      with main_profiler.stage('assemble'):
+         for output_str, checkpoint_dir in zip(output_lst, checkpoint_dir_lst):
+            checkpoint.assemble(checkpoint_dir, chunk_int * sample_int if IS_LONG else chunk_int, output_str, OUTPUT_FORMAT, columnar.column_names(plan.attributes), header_str, metadata_dict)
+   except ValueError as ex:
+      sys.exit(str(ex))
+
+   print(' '*80, end = '\r')
+   print(base_int + sum(progress_array), 'loci Done', ', '.join(output_lst))
+
+   if PROFILE != '':
+      report_dict = profiling.write_report(PROFILE, main_profiler, worker_profiler_dict, time.perf_counter() - run_start[0], time.process_time() - run_start[1],
+                                           {'command': argvList, 'process': process_int, 'io_threads': io_thread_int, 'samples': sample_int, 'output': output_lst})
+      print(f'profile: {PROFILE}，{report_dict["loci_per_second"]} loci/s，{report_dict["reads_per_second"]} reads/s')
    return
 
 
@@ -0,0 +1,237 @@
+# 断点续跑：工作进程的结果按基因组区块写入检查点目录（<输出文件>.chunks），每个区块完成后写入manifest
+# 中断后使用--resume重新运行，manifest中已完成的区块直接跳过，只计算剩余的区块
+# 全部区块完成后按区块序号（即位置文件中的顺序）合并成输出文件，因此续跑和一次跑完的输出文件完全相同
+#
+# 检查点目录的结构：
+# manifest.tsv       第一行为 #fingerprint\t<运行参数的sha1>，之后每个已完成的区块一行：区块序号\t位点数
+# chunk_<序号>.part  一个区块的结果。tsv输出时为文本行，列式输出时为连续pickle的多批结果（每批为columnar.extract_row的返回值列表）
+# 区块先写入chunk_<序号>.part.tmp，完成后fsync并改名，然后才写入manifest，所以manifest中的区块一定是完整的
+import os
+import os.path as path
+import json
+import shutil
+import pickle
+import hashlib
+
+try:
+   from . import columnar
+except ImportError:
+   import columnar
+
+SUFFIX = '.chunks'
+MANIFEST_FILE = 'manifest.tsv'
+PART_FILE = 'chunk_{:08d}.part'
+FINGERPRINT_PREFIX = '#fingerprint\t'
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+def checkpoint_dir_for(output_file: str) -> str:
+   return output_file + SUFFIX
+
+
+# 文件的路径、大小和修改时间，用于运行参数的指纹。文件为''时返回None
+def file_signature(file_str: str):
+   if file_str == '':
+      return None
+
+   file_str = path.realpath(path.expanduser(file_str))
+   try:
+      stat = os.stat(file_str)
+   except OSError:
+      return [file_str, None, None]
+
+   return [file_str, stat.st_size, stat.st_mtime_ns]
+
+
+# 运行参数的指纹，参数不同的检查点不能用于续跑
+def run_fingerprint(param_dict: dict) -> str:
+   return hashlib.sha1(json.dumps(param_dict, sort_keys = True).encode()).hexdigest()
+
+
+def __read_manifest(manifest_file: str) -> tuple[str, dict]:
+   fingerprint_str = ''
+   finished_dict = {}  # {区块序号: 位点数}
+   with open(manifest_file) as in_f:
+      for line_str in in_f:
+         if not line_str.endswith('\n'):  # 中断时最后一行可能没有写完
+            break
+         if line_str.startswith(FINGERPRINT_PREFIX):
+            fingerprint_str = line_str[len(FINGERPRINT_PREFIX):].strip()
+            continue
+
+         field_lst = line_str.rstrip('\n').split('\t')
+         if len(field_lst) == 2:
+            finished_dict[int(field_lst[0])] = int(field_lst[1])
+
+   return fingerprint_str, finished_dict
+
+
+# 重写manifest：先写临时文件，fsync后改名
+def __write_manifest(manifest_file: str, fingerprint_str: str, finished_dict: dict) -> None:
+   with open(manifest_file + '.tmp', 'w') as out_f:
+      out_f.write(FINGERPRINT_PREFIX + fingerprint_str + '\n')
+      out_f.writelines([f'{chunk_id}\t{locus_int}\n' for chunk_id, locus_int in finished_dict.items()])
+      out_f.flush()
+      os.fsync(out_f.fileno())
+   os.replace(manifest_file + '.tmp', manifest_file)
+   return None
+
+
+def open_checkpoint(checkpoint_dir: str, fingerprint_str: str, is_resume: bool = False) -> dict:
+   '''
+   准备检查点目录。不续跑或者目录中没有manifest时，清空目录重新开始；续跑时读取manifest中已完成的区块
+
+   Parameters:
+      **checkpoint_dir**: str
+         检查点目录，见checkpoint_dir_for
+
+      **fingerprint_str**: str
+         运行参数的指纹，见run_fingerprint
+
+      **is_resume**: bool
+         是否续跑
+
+   Returns:
+      **finished_dict**: dict
+         {区块序号: 位点数}，已完成的区块
+
+   Raises:
+      ValueError: 续跑时检查点的运行参数与本次运行不同
+   '''
+
+   manifest_file = path.join(checkpoint_dir, MANIFEST_FILE)
+   if is_resume and path.exists(manifest_file):
+      manifest_fingerprint_str, finished_dict = __read_manifest(manifest_file)
+      if manifest_fingerprint_str != fingerprint_str:
+         message = f'open_checkpoint: {checkpoint_dir} 的运行参数（bam文件、位置文件、输出属性等）与本次运行不同，不能续跑。去掉--resume重新运行'
+         raise ValueError(message)
+
+      # 只保留区块文件存在的记录。中断时没有写完的最后一行也在这里去掉，否则之后追加的记录会接在它后面而无法读取
+      finished_dict = {chunk_id: locus_int for chunk_id, locus_int in finished_dict.items() if path.exists(path.join(checkpoint_dir, PART_FILE.format(chunk_id)))}
+      __write_manifest(manifest_file, fingerprint_str, finished_dict)
+      return finished_dict
+
+   shutil.rmtree(checkpoint_dir, ignore_errors = True)
+   os.makedirs(checkpoint_dir)
+   __write_manifest(manifest_file, fingerprint_str, {})
+
+   return {}
+
+
+class ChunkWriter:
+   '''
+   写入进程使用：把同一个区块的多批结果追加到该区块的临时文件中，区块完成时（commit）改名并写入manifest
+
+   chunk_writer = ChunkWriter(checkpoint_dir, 'tsv')
+   chunk_writer.write(3, 'chr1\t100\t...\n')
+   chunk_writer.commit(3, 2000)
+   chunk_writer.close()
+   '''
+
+   def __init__(self, checkpoint_dir: str, output_format: str):
+
+      self.__checkpoint_dir = checkpoint_dir
+      self.__is_text = output_format == 'tsv'
+      self.__file_dict = {}  # {区块序号: 未完成区块的临时文件}
+      self.__manifest_f = open(path.join(checkpoint_dir, MANIFEST_FILE), 'a')
+
+   def __open(self, chunk_id: int):
+      try:
+         return self.__file_dict[chunk_id]
+      except KeyError:
+         out_f = open(path.join(self.__checkpoint_dir, PART_FILE.format(chunk_id)) + '.tmp', 'wb', buffering = WRITE_BUFFER_SIZE)
+         self.__file_dict[chunk_id] = out_f
+         return out_f
+
+   def write(self, chunk_id: int, payload) -> None:
+      out_f = self.__open(chunk_id)
+      if self.__is_text:
+         out_f.write(payload.encode())
+      else:
+         pickle.dump(payload, out_f, protocol = pickle.HIGHEST_PROTOCOL)
+      return None
+
+   def commit(self, chunk_id: int, locus_int: int) -> None:
+      out_f = self.__open(chunk_id)  # 没有结果行的区块也要有一个空文件
+      out_f.flush()
+      os.fsync(out_f.fileno())
+      out_f.close()
+      del self.__file_dict[chunk_id]
+
+      part_file = path.join(self.__checkpoint_dir, PART_FILE.format(chunk_id))
+      os.replace(part_file + '.tmp', part_file)
+
+      self.__manifest_f.write(f'{chunk_id}\t{locus_int}\n')
+      self.__manifest_f.flush()
+      os.fsync(self.__manifest_f.fileno())
+      return None
+
+   # 未完成的区块保留临时文件，续跑时会被覆盖
+   def close(self) -> None:
+      for out_f in self.__file_dict.values():
+         out_f.close()
+      self.__file_dict = {}
+      self.__manifest_f.close()
+      return None
+
+
+def assemble(checkpoint_dir: str, chunk_int: int, output_file: str, output_format: str, attributes: tuple[str, ...], header_str: str = '', metadata: dict = None) -> None:
+   '''
+   按区块序号合并检查点目录中的全部区块，写成输出文件，然后删除检查点目录
+
+   Parameters:
+      **checkpoint_dir**: str
+         检查点目录
+
+      **chunk_int**: int
+         区块总数
+
+      **output_file**: str
+         输出文件，先写入<输出文件>.part，完成后改名
+
+      **output_format**: str
+         'tsv', 'parquet'或者'npz'
+
+      **attributes**: tuple[str, ...]
+         列式输出的属性（见columnar.column_names）
+
+      **header_str**: str
+         tsv输出的header行（包括'\\n'），为''时不写header
+
+      **metadata**: dict
+         列式输出的元数据，见columnar.open_writer
+
+   Raises:
+      ValueError: 有区块没有完成
+   '''
+
+   _, finished_dict = __read_manifest(path.join(checkpoint_dir, MANIFEST_FILE))
+   missing_lst = [chunk_id for chunk_id in range(chunk_int) if chunk_id not in finished_dict]
+   if missing_lst != []:
+      message = f'assemble: {len(missing_lst)}个区块没有完成（例如区块{missing_lst[0]}），使用--resume继续运行'
+      raise ValueError(message)
+
+   temp_file = output_file + '.part'
+   if output_format == 'tsv':
+      with open(temp_file, 'wb') as out_f:
+         out_f.write(header_str.encode())
+         for chunk_id in range(chunk_int):
+            with open(path.join(checkpoint_dir, PART_FILE.format(chunk_id)), 'rb') as in_f:
+               shutil.copyfileobj(in_f, out_f, WRITE_BUFFER_SIZE)
+   else:
+      writer = columnar.open_writer(temp_file, output_format, attributes, metadata)
+      try:
+         for chunk_id in range(chunk_int):
+            with open(path.join(checkpoint_dir, PART_FILE.format(chunk_id)), 'rb') as in_f:
+               while True:
+                  try:
+                     row_lst = pickle.load(in_f)
+                  except EOFError:
+                     break
+                  writer.write_batch(row_lst)
+      finally:
+         writer.close()
+
+   os.replace(temp_file, output_file)
+   shutil.rmtree(checkpoint_dir, ignore_errors = True)
+   return None
@@ -0,0 +1,316 @@
+# 列式输出（--output-format parquet 或 npz）
+# 工作进程用compile_row_extractor编译好的函数把每个PositionInfo对象转换成一行有类型的数值，写入进程再按列写入文件
+# parquet需要安装pyarrow，npz只需要numpy
+#
+# 各种属性（见info.column_kind）的列类型：
+#                parquet                      npz
+# count          fixed_size_list<int64>[4]    int64, shape (n, 4)
+# int            int64                        int64, 没有数值时为-1
+# float          float64                      float64, 没有数值时为nan
+# str            string                       变长列
+# int_list       list<int64>                  变长列
+# str_list       list<string>                 变长列，每行为以','连接的字符串
+# counter        map<string 或 int64, int64>  两个变长列 <name>.keys 和 <name>.counts，按数量从多到少排列。
+#                                             indel_length_counter的keys为int64，其他为以','连接的字符串
+#
+# npz中的变长列由两个数组组成：<name>保存全部行的数值（字符串为utf-8编码的uint8），<name>.offsets(int64, 长度为行数 + 1)，
+# 第i行为 <name>[offsets[i]:offsets[i + 1]]。字符串列可以用decode_strings解码
+#
+# 运行参数等元数据（例如reads的过滤条件read_filter）：parquet保存在schema的metadata中，npz保存为名为'##<key>'的字符串数组
+import os
+import shutil
+import operator
+import numpy as np
+
+try:
+   from . import info
+except ImportError:
+   import info
+
+try:
+   import pyarrow as pa
+   import pyarrow.parquet as pq
+except ImportError:
+   pa = None
+   pq = None
+
+OUTPUT_FORMATS = ('tsv', 'parquet', 'npz')
+SUFFIX_DICT = {'tsv': '.tsv', 'parquet': '.parquet', 'npz': '.npz'}
+
+
+# 检查输出格式是否可用，不可用时抛出ValueError
+def check_output_format(output_format: str) -> None:
+
+   if output_format not in OUTPUT_FORMATS:
+      message = f'check_output_format: 不支持的输出格式 {output_format}，可选 {", ".join(OUTPUT_FORMATS)}'
+      raise ValueError(message)
+
+   if output_format == 'parquet' and pa is None:
+      message = 'check_output_format: parquet输出需要安装pyarrow（pip install pyarrow），或者使用 --output-format npz'
+      raise ValueError(message)
+
+   return None
+
+
+# 列式文件中不能有重复的列名，重复的属性只保留第一次出现
+def column_names(attributes: tuple[str, ...]) -> tuple[str, ...]:
+   return tuple(dict.fromkeys(attributes))
+
+
+# = = = = = = = = = = = = = = 工作进程：PositionInfo -> 一行有类型的数值 = = = = = = = = = = = = = =
+def __count_value(value):
+   return tuple(value) if value else (0, 0, 0, 0)
+
+
+def __int_list_value(value):
+   if isinstance(value, info.Accumulator):
+      value = value.values
+   return value if value else []
+
+
+def __str_list_value(value):
+   return sorted(set(value)) if value else []
+
+
+def __counter_value(value):
+   return value.most_common() if value else []
+
+
+def __float_value(value):
+   return float(value) if value is not None else None
+
+
+def __identity_value(value):
+   return value
+
+
+VALUE_FUNCTION_DICT = {'count': __count_value, 'int_list': __int_list_value, 'str_list': __str_list_value, 'counter': __counter_value, 'float': __float_value, 'int': __identity_value, 'str': __identity_value}
+
+
+def compile_row_extractor(attributes: tuple[str, ...]) -> tuple:
+   '''
+   将输出属性编译为每列一个的取值函数，extract_row使用这些函数把PositionInfo对象转换成一行有类型的数值
+
+   Parameters:
+      **attributes**: tuple[str, ...]
+         输出属性，不能重复（见column_names）
+
+   Returns:
+      **row_extractor**: tuple
+         每个输出属性对应的取值函数
+   '''
+
+   row_extractor = []
+   for attr_str in attributes:
+      value_function = VALUE_FUNCTION_DICT[info.column_kind(attr_str)]
+      getter = operator.attrgetter(attr_str)
+      row_extractor.append(lambda pos_info, value_function = value_function, getter = getter: value_function(getter(pos_info)))
+
+   return tuple(row_extractor)
+
+
+def extract_row(pos_info: info.PositionInfo, row_extractor: tuple) -> tuple:
+   return tuple([value_function(pos_info) for value_function in row_extractor])
+
+
+# = = = = = = = = = = = = = = 写入进程：按列写入文件 = = = = = = = = = = = = = =
+def open_writer(output_file: str, output_format: str, attributes: tuple[str, ...], metadata: dict = None):
+   '''
+   打开一个列式文件写入对象，之后每批结果调用write_batch(row_lst)，最后调用close()
+
+   Parameters:
+      **output_file**: str
+         输出文件
+
+      **output_format**: str
+         'parquet'或者'npz'
+
+      **attributes**: tuple[str, ...]
+         输出属性，不能重复（见column_names）
+
+      **metadata**: dict
+         可选, {str: str}，写入文件的元数据
+   '''
+
+   check_output_format(output_format)
+   if output_format == 'parquet':
+      return ParquetWriter(output_file, attributes, metadata)
+   if output_format == 'npz':
+      return NpzWriter(output_file, attributes, metadata)
+
+   message = f'open_writer: {output_format} 不是列式输出格式'
+   raise ValueError(message)
+
+
+class ParquetWriter:
+   '''
+   将结果写入parquet文件，每批结果写成一个row group
+   '''
+
+   def __init__(self, output_file: str, attributes: tuple[str, ...], metadata: dict = None):
+
+      field_lst = []
+      for attr_str in attributes:
+         field_lst.append(pa.field(attr_str, self.__arrow_type(attr_str)))
+      self.__schema = pa.schema(field_lst, metadata = metadata if metadata else None)
+      self.__writer = pq.ParquetWriter(output_file, self.__schema)
+
+   @staticmethod
+   def __arrow_type(attr_str: str):
+      kind_str = info.column_kind(attr_str)
+      if kind_str == 'count':
+         return pa.list_(pa.int64(), 4)
+      if kind_str == 'int_list':
+         return pa.list_(pa.int64())
+      if kind_str == 'str_list':
+         return pa.list_(pa.string())
+      if kind_str == 'counter':
+         return pa.map_(pa.int64() if attr_str == 'indel_length_counter' else pa.string(), pa.int64())
+      if kind_str == 'int':
+         return pa.int64()
+      if kind_str == 'float':
+         return pa.float64()
+      return pa.string()
+
+   def write_batch(self, row_lst: list[tuple, ...]) -> None:
+      if row_lst == []:
+         return None
+
+      column_lst = list(zip(*row_lst))
+      array_lst = [pa.array(column, type = field.type) for column, field in zip(column_lst, self.__schema)]
+      self.__writer.write_table(pa.Table.from_arrays(array_lst, schema = self.__schema))
+      return None
+
+   def close(self) -> None:
+      self.__writer.close()
+      return None
+
+
+class NpzWriter:
+   '''
+   将结果写入npz文件。每批结果先按列追加到临时目录中的二进制文件，close时再合并成一个npz文件，写入过程中内存占用与行数无关
+   '''
+
+   def __init__(self, output_file: str, attributes: tuple[str, ...], metadata: dict = None):
+
+      self.__output_file = output_file
+      self.__metadata = metadata if metadata is not None else {}
+      self.__temp_dir = output_file + '.tmp'
+      shutil.rmtree(self.__temp_dir, ignore_errors = True)
+      os.makedirs(self.__temp_dir)
+
+      self.__attributes = attributes
+      self.__dtype_dict = {}  # {数组名: dtype}
+      self.__offset_dict = {}  # {变长列的数组名: 已写入的数值个数}
+
+      for attr_str in attributes:
+         kind_str = info.column_kind(attr_str)
+         if kind_str == 'count' or kind_str == 'int':
+            self.__dtype_dict[attr_str] = np.int64
+         elif kind_str == 'float':
+            self.__dtype_dict[attr_str] = np.float64
+         elif kind_str == 'int_list':
+            self.__add_ragged(attr_str, np.int64)
+         elif kind_str == 'str' or kind_str == 'str_list':
+            self.__add_ragged(attr_str, np.uint8)
+         elif kind_str == 'counter':
+            self.__add_ragged(attr_str + '.keys', np.int64 if attr_str == 'indel_length_counter' else np.uint8)
+            self.__add_ragged(attr_str + '.counts', np.int64)
+
+   def __add_ragged(self, name: str, dtype) -> None:
+      self.__dtype_dict[name] = dtype
+      self.__dtype_dict[name + '.offsets'] = np.int64
+      self.__offset_dict[name] = 0
+      self.__append(name + '.offsets', [0])
+      return None
+
+   def __append(self, name: str, value_lst) -> None:
+      with open(os.path.join(self.__temp_dir, name), 'ab') as out_f:
+         np.asarray(value_lst, dtype = self.__dtype_dict[name]).tofile(out_f)
+      return None
+
+   # 追加一个变长列，value_lst中的每个元素为一行的数值列表；uint8列的每个元素为一行的字符串
+   def __append_ragged(self, name: str, value_lst: list) -> None:
+      if self.__dtype_dict[name] is np.uint8:
+         bytes_lst = [x.encode() for x in value_lst]
+         data = np.frombuffer(b''.join(bytes_lst), dtype = np.uint8)
+         length_lst = [len(x) for x in bytes_lst]
+      else:
+         data = [x for row in value_lst for x in row]
+         length_lst = [len(row) for row in value_lst]
+
+      offset_array = self.__offset_dict[name] + np.cumsum(length_lst, dtype = np.int64)
+      self.__append(name, data)
+      self.__append(name + '.offsets', offset_array)
+      if len(offset_array) > 0:
+         self.__offset_dict[name] = int(offset_array[-1])
+
+      return None
+
+   def write_batch(self, row_lst: list[tuple, ...]) -> None:
+      if row_lst == []:
+         return None
+
+      for attr_str, column in zip(self.__attributes, zip(*row_lst)):
+         kind_str = info.column_kind(attr_str)
+         if kind_str == 'count':
+            self.__append(attr_str, column)
+         elif kind_str == 'int':
+            self.__append(attr_str, [x if x is not None else -1 for x in column])
+         elif kind_str == 'float':
+            self.__append(attr_str, [x if x is not None else np.nan for x in column])
+         elif kind_str == 'int_list':
+            self.__append_ragged(attr_str, column)
+         elif kind_str == 'str':
+            self.__append_ragged(attr_str, [x if x is not None else '' for x in column])
+         elif kind_str == 'str_list':
+            self.__append_ragged(attr_str, [','.join(x) for x in column])
+         elif kind_str == 'counter':
+            if attr_str == 'indel_length_counter':
+               self.__append_ragged(attr_str + '.keys', [[key for key, _ in x] for x in column])
+            else:
+               self.__append_ragged(attr_str + '.keys', [','.join([key for key, _ in x]) for x in column])
+            self.__append_ragged(attr_str + '.counts', [[count for _, count in x] for x in column])
+
+      return None
+
+   def close(self) -> None:
+      array_dict = {}
+      for name, dtype in self.__dtype_dict.items():
+         array_dict[name] = np.fromfile(os.path.join(self.__temp_dir, name), dtype = dtype)
+
+      for attr_str in self.__attributes:
+         if info.column_kind(attr_str) == 'count':
+            array_dict[attr_str] = array_dict[attr_str].reshape(-1, 4)
+
+      for key_str, value_str in self.__metadata.items():
+         array_dict['##' + key_str] = np.array(value_str)
+
+      with open(self.__output_file, 'wb') as out_f:  # 传入文件对象，np.savez不会自动添加.npz后缀
+         np.savez(out_f, **array_dict)
+
+      shutil.rmtree(self.__temp_dir, ignore_errors = True)
+      return None
+
+
+# 解码npz中的字符串变长列
+# chrom_array = decode_strings(npz['chrom'], npz['chrom.offsets'])
+def decode_strings(value_array: np.ndarray, offset_array: np.ndarray) -> np.ndarray:
+   '''
+   将npz文件中uint8编码的字符串变长列解码为字符串数组
+
+   Parameters:
+      **value_array**: np.ndarray
+         uint8数组，全部行的utf-8编码
+
+      **offset_array**: np.ndarray
+         int64数组，长度为行数 + 1
+
+   Returns:
+      **string_array**: np.ndarray
+         字符串数组，长度为行数
+   '''
+
+   value_bytes = value_array.tobytes()
+   offset_lst = offset_array.tolist()
+   return np.array([value_bytes[offset_lst[i]:offset_lst[i + 1]].decode() for i in range(len(offset_lst) - 1)], dtype = str)
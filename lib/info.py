@@ -1,16 +1,101 @@
 # 点位信息获取和输出的相关函数
 import pysam
+import numpy as np
 from dataclasses import dataclass, field
-import statistics
 import collections
-import sys
+import functools
+import zlib
+import operator
+from collections.abc import Iterator
 from . import utils
 
 
 BASES = ['A', 'T', 'C', 'G']
 
+# get_query_sequences返回的碱基字符在计数数组中的序号，'*'表示当前位置位于deletion内部（miss）
+BASE_CODE_DICT = {'A': 0, 'a': 0, 'T': 1, 't': 1, 'C': 2, 'c': 2, 'G': 3, 'g': 3, 'N': 4, 'n': 4, '*': 5}
+BASE_CODE_NAMES = ['A', 'T', 'C', 'G', 'N', 'miss']  # 序号对应的属性名前缀
+QUERY_SNP_LST = ['A', 'T', 'C', 'G', 'N', '*']  # 序号对应的query_snp
+
+
+# 一组整数（测序质量、MAPQ或者cycle）的累加统计，内存占用与深度无关
+# values只在需要输出原始数值时才保存，否则为None
+# histogram只在需要输出分位数时才保存，否则为None。histogram[i]为数值i的个数：
+# histogram_size大于0时长度固定，超出范围的数值计入两端；为0时随最大值增长（cycle不超过最大的read长度）
+class Accumulator:
+   __slots__ = ('count', 'sum', 'square_sum', 'min', 'max', 'values', 'histogram', 'histogram_size')
+
+   def __init__(self, keep_values: bool = False, keep_histogram: bool = False, histogram_size: int = 0):
+      self.count = 0
+      self.sum = 0
+      self.square_sum = 0
+      self.min = None
+      self.max = None
+      self.values = [] if keep_values else None
+      self.histogram = np.zeros(histogram_size, dtype = np.int64) if keep_histogram else None
+      self.histogram_size = histogram_size
+
+   def add(self, value_array: np.ndarray) -> None:
+      if value_array.size == 0:
+         return None
+
+      min_int = int(value_array.min())
+      max_int = int(value_array.max())
+      self.count += int(value_array.size)
+      self.sum += int(value_array.sum())
+      self.square_sum += int((value_array * value_array).sum())
+      self.min = min_int if self.min is None else min(self.min, min_int)
+      self.max = max_int if self.max is None else max(self.max, max_int)
+      if self.values is not None:
+         self.values.extend(value_array.tolist())
+
+      if self.histogram is not None:
+         if self.histogram_size > 0:
+            self.histogram += np.bincount(np.clip(value_array, 0, self.histogram_size - 1), minlength = self.histogram_size)
+         else:
+            if max_int >= len(self.histogram):
+               self.histogram = np.concatenate((self.histogram, np.zeros(max_int + 1 - len(self.histogram), dtype = np.int64)))
+            self.histogram += np.bincount(np.clip(value_array, 0, None), minlength = len(self.histogram))
+
+      return None
+
+   # 第rank个（1-based，从小到大）数值
+   def __value_at_rank(self, rank: int) -> int:
+      return int(np.searchsorted(np.cumsum(self.histogram), rank))
+
+   # 数值个数为偶数时为中间两个数值的平均，与mean一样，结果为整数时返回int。没有数值或者没有histogram时返回None
+   @property
+   def median(self):
+      if self.count == 0 or self.histogram is None:
+         return None
+
+      low_int = self.__value_at_rank((self.count + 1) // 2)
+      high_int = self.__value_at_rank(self.count // 2 + 1)
+      return low_int if low_int == high_int else (low_int + high_int) / 2
+
+   # 第percent百分位数（nearest-rank：从小到大第ceil(percent * count / 100)个数值）
+   def percentile(self, percent: int):
+      if self.count == 0 or self.histogram is None:
+         return None
+
+      return self.__value_at_rank(max(-(-percent * self.count // 100), 1))
 
-@dataclass
+   # 与statistics.mean相同：能整除时返回int，否则返回float。没有数值时返回None
+   @property
+   def mean(self):
+      if self.count == 0:
+         return None
+
+      if self.sum % self.count == 0:
+         return self.sum // self.count
+
+      return self.sum / self.count
+
+   def __repr__(self) -> str:
+      return f'Accumulator(count={self.count}, sum={self.sum}, square_sum={self.square_sum}, min={self.min}, max={self.max})'
+
+
+@dataclass(slots = True)
 class PositionInfo:
 
    # =====================count=====================
@@ -31,57 +116,63 @@ class PositionInfo:
    background_count : list = field(default_factory=list)
 
    # =====================seq_quality=====================
-   A_seq_quality: list = field(default_factory=list) # A 的测序质量，长度等于A的数量
-   T_seq_quality: list = field(default_factory=list)
-   C_seq_quality: list = field(default_factory=list)
-   G_seq_quality: list = field(default_factory=list)
-   N_seq_quality: list = field(default_factory=list)
-   ins_seq_quality: list = field(default_factory=list) # 记录全部插入序列碱基的测序质量
-
-   matched_snp_seq_quality : list = field(default_factory=list)
-   unmatched_snp_seq_quality : list = field(default_factory=list)
-   matched_ins_seq_quality : list = field(default_factory=list)
-   unmatched_ins_seq_quality : list = field(default_factory=list)
+   A_seq_quality: Accumulator = None # A 的测序质量的累加统计，count等于A的数量
+   T_seq_quality: Accumulator = None
+   C_seq_quality: Accumulator = None
+   G_seq_quality: Accumulator = None
+   N_seq_quality: Accumulator = None
+   ins_seq_quality: Accumulator = None # 记录全部插入序列碱基的测序质量
+
+   matched_snp_seq_quality : Accumulator = None
+   unmatched_snp_seq_quality : Accumulator = None
+   matched_ins_seq_quality : Accumulator = None
+   unmatched_ins_seq_quality : Accumulator = None
 
    # =====================MAPQ=====================
-   A_MAPQ: list = field(default_factory=list) # A所在read的MAPQ质量，长度等于A的数量
-   T_MAPQ: list = field(default_factory=list)
-   C_MAPQ: list = field(default_factory=list)
-   G_MAPQ: list = field(default_factory=list)
-   N_MAPQ: list = field(default_factory=list)
-   miss_MAPQ: list = field(default_factory=list)
-   del_MAPQ: list = field(default_factory=list)
-   ins_MAPQ: list = field(default_factory=list)
+   A_MAPQ: Accumulator = None # A所在read的MAPQ质量的累加统计，count等于A的数量
+   T_MAPQ: Accumulator = None
+   C_MAPQ: Accumulator = None
+   G_MAPQ: Accumulator = None
+   N_MAPQ: Accumulator = None
+   miss_MAPQ: Accumulator = None
+   del_MAPQ: Accumulator = None
+   ins_MAPQ: Accumulator = None
 
-   matched_snp_MAPQ : list = field(default_factory=list)
-   unmatched_snp_MAPQ : list = field(default_factory=list)
-   matched_indel_MAPQ : list = field(default_factory=list)
-   unmatched_indel_MAPQ : list = field(default_factory=list)
+   matched_snp_MAPQ : Accumulator = None
+   unmatched_snp_MAPQ : Accumulator = None
+   matched_indel_MAPQ : Accumulator = None
+   unmatched_indel_MAPQ : Accumulator = None
 
 
    # =====================Cycle=====================
-   A_cycle: list = field(default_factory=list)  # A所在read的cycle, 长度等于A的数量
-   T_cycle: list = field(default_factory=list)
-   C_cycle: list = field(default_factory=list)
-   G_cycle: list = field(default_factory=list)
-   N_cycle: list = field(default_factory=list)
-   miss_cycle: list = field(default_factory=list)
-   del_cycle: list = field(default_factory=list) # 只记录发生InDel的起始位置的碱基的cycle
-   ins_cycle: list = field(default_factory=list)
-
-   matched_snp_cycle: list = field(default_factory=list)
-   unmatched_snp_cycle: list = field(default_factory=list)
-   matched_indel_cycle: list = field(default_factory=list)
-   unmatched_indel_cycle: list = field(default_factory=list)
+   A_cycle: Accumulator = None  # A所在read的cycle的累加统计, count等于A的数量
+   T_cycle: Accumulator = None
+   C_cycle: Accumulator = None
+   G_cycle: Accumulator = None
+   N_cycle: Accumulator = None
+   miss_cycle: Accumulator = None
+   del_cycle: Accumulator = None # 只记录发生InDel的起始位置的碱基的cycle
+   ins_cycle: Accumulator = None
+
+   matched_snp_cycle: Accumulator = None
+   unmatched_snp_cycle: Accumulator = None
+   matched_indel_cycle: Accumulator = None
+   unmatched_indel_cycle: Accumulator = None
 
    # =====================其他=====================
    chrom: str = None
    pos: int = None
    coverage: int = None  # 覆盖度，deletion计算在内
+   sampled_coverage: int = None  # 参与统计的reads数。使用--max-depth降采样时不超过max_depth，否则等于coverage
+
+   # 以下三个原始列表只在输出时需要（见FormatPlan.keep_raw）才保存，否则为None
+   indel_length: list = None # read在该位点后面的indel长度, 计数结果。来之[pileup_read.indel for pileup_read in pileupcolumn.pileups]
+   query_snp: list = None # 该位点所在位置的序列的种类和数量， 包括ATCG*,其中*表示缺失
+   query_indel: list = None # 该位点所在位置后接InDel的序列的种类和数量，以samtools的格式表示，例如‘+2AC’, '-3NNN'等
 
-   indel_length: list = field(default_factory=list) # read在该位点后面的indel长度, 计数结果。来之[pileup_read.indel for pileup_read in pileupcolumn.pileups]
-   query_snp: list = field(default_factory=list) # 该位点所在位置的序列的种类和数量， 包括ATCG*,其中*表示缺失
-   query_indel: list = field(default_factory=list) # 该位点所在位置后接InDel的序列的种类和数量，以samtools的格式表示，例如‘+2AC’, '-3NNN'等
+   indel_length_counter: collections.Counter = None
+   query_snp_counter: collections.Counter = None
+   query_indel_counter: collections.Counter = None
 
    # List中的每个元素是一个allele
    real_allele_snp: list = field(default_factory=list)   # 原位allele，例如ATCG或者*
@@ -90,66 +181,430 @@ class PositionInfo:
    reference: str = None   # 该位置的ref碱基
    context: str = None # 该位置上下游的base
    other: str = None  # 其他信息
+   sample: str = None  # 样本名，多个bam文件时用于区分结果
+
+   # =====================均值，见add_attributes_pos_info=====================
+   A_mean_seq_quality: float = None
+   T_mean_seq_quality: float = None
+   C_mean_seq_quality: float = None
+   G_mean_seq_quality: float = None
+   N_mean_seq_quality: float = None
+   matched_snp_mean_seq_quality: float = None
+   unmatched_snp_mean_seq_quality: float = None
+   ins_mean_seq_quality: float = None
+   matched_ins_mean_seq_quality: float = None
+   unmatched_ins_mean_seq_quality: float = None
+
+   A_mean_MAPQ: float = None
+   T_mean_MAPQ: float = None
+   C_mean_MAPQ: float = None
+   G_mean_MAPQ: float = None
+   N_mean_MAPQ: float = None
+   miss_mean_MAPQ: float = None
+   del_mean_MAPQ: float = None
+   ins_mean_MAPQ: float = None
+   matched_snp_mean_MAPQ: float = None
+   unmatched_snp_mean_MAPQ: float = None
+   matched_indel_mean_MAPQ: float = None
+   unmatched_indel_mean_MAPQ: float = None
+
+   A_mean_cycle: float = None
+   T_mean_cycle: float = None
+   C_mean_cycle: float = None
+   G_mean_cycle: float = None
+   N_mean_cycle: float = None
+   miss_mean_cycle: float = None
+   del_mean_cycle: float = None
+   ins_mean_cycle: float = None
+   matched_snp_mean_cycle: float = None
+   unmatched_snp_mean_cycle: float = None
+   matched_indel_mean_cycle: float = None
+   unmatched_indel_mean_cycle: float = None
+
+   # =====================分位数，由histogram计算，见add_attributes_pos_info=====================
+   # 中位数
+   A_median_seq_quality: float = None
+   T_median_seq_quality: float = None
+   C_median_seq_quality: float = None
+   G_median_seq_quality: float = None
+   N_median_seq_quality: float = None
+   matched_snp_median_seq_quality: float = None
+   unmatched_snp_median_seq_quality: float = None
+   ins_median_seq_quality: float = None
+   matched_ins_median_seq_quality: float = None
+   unmatched_ins_median_seq_quality: float = None
+
+   A_median_MAPQ: float = None
+   T_median_MAPQ: float = None
+   C_median_MAPQ: float = None
+   G_median_MAPQ: float = None
+   N_median_MAPQ: float = None
+   miss_median_MAPQ: float = None
+   del_median_MAPQ: float = None
+   ins_median_MAPQ: float = None
+   matched_snp_median_MAPQ: float = None
+   unmatched_snp_median_MAPQ: float = None
+   matched_indel_median_MAPQ: float = None
+   unmatched_indel_median_MAPQ: float = None
+
+   A_median_cycle: float = None
+   T_median_cycle: float = None
+   C_median_cycle: float = None
+   G_median_cycle: float = None
+   N_median_cycle: float = None
+   miss_median_cycle: float = None
+   del_median_cycle: float = None
+   ins_median_cycle: float = None
+   matched_snp_median_cycle: float = None
+   unmatched_snp_median_cycle: float = None
+   matched_indel_median_cycle: float = None
+   unmatched_indel_median_cycle: float = None
+
+   # 第10百分位数
+   A_p10_seq_quality: float = None
+   T_p10_seq_quality: float = None
+   C_p10_seq_quality: float = None
+   G_p10_seq_quality: float = None
+   N_p10_seq_quality: float = None
+   matched_snp_p10_seq_quality: float = None
+   unmatched_snp_p10_seq_quality: float = None
+   ins_p10_seq_quality: float = None
+   matched_ins_p10_seq_quality: float = None
+   unmatched_ins_p10_seq_quality: float = None
+
+   A_p10_MAPQ: float = None
+   T_p10_MAPQ: float = None
+   C_p10_MAPQ: float = None
+   G_p10_MAPQ: float = None
+   N_p10_MAPQ: float = None
+   miss_p10_MAPQ: float = None
+   del_p10_MAPQ: float = None
+   ins_p10_MAPQ: float = None
+   matched_snp_p10_MAPQ: float = None
+   unmatched_snp_p10_MAPQ: float = None
+   matched_indel_p10_MAPQ: float = None
+   unmatched_indel_p10_MAPQ: float = None
+
+   A_p10_cycle: float = None
+   T_p10_cycle: float = None
+   C_p10_cycle: float = None
+   G_p10_cycle: float = None
+   N_p10_cycle: float = None
+   miss_p10_cycle: float = None
+   del_p10_cycle: float = None
+   ins_p10_cycle: float = None
+   matched_snp_p10_cycle: float = None
+   unmatched_snp_p10_cycle: float = None
+   matched_indel_p10_cycle: float = None
+   unmatched_indel_p10_cycle: float = None
+
+   # 第90百分位数
+   A_p90_seq_quality: float = None
+   T_p90_seq_quality: float = None
+   C_p90_seq_quality: float = None
+   G_p90_seq_quality: float = None
+   N_p90_seq_quality: float = None
+   matched_snp_p90_seq_quality: float = None
+   unmatched_snp_p90_seq_quality: float = None
+   ins_p90_seq_quality: float = None
+   matched_ins_p90_seq_quality: float = None
+   unmatched_ins_p90_seq_quality: float = None
+
+   A_p90_MAPQ: float = None
+   T_p90_MAPQ: float = None
+   C_p90_MAPQ: float = None
+   G_p90_MAPQ: float = None
+   N_p90_MAPQ: float = None
+   miss_p90_MAPQ: float = None
+   del_p90_MAPQ: float = None
+   ins_p90_MAPQ: float = None
+   matched_snp_p90_MAPQ: float = None
+   unmatched_snp_p90_MAPQ: float = None
+   matched_indel_p90_MAPQ: float = None
+   unmatched_indel_p90_MAPQ: float = None
+
+   A_p90_cycle: float = None
+   T_p90_cycle: float = None
+   C_p90_cycle: float = None
+   G_p90_cycle: float = None
+   N_p90_cycle: float = None
+   miss_p90_cycle: float = None
+   del_p90_cycle: float = None
+   ins_p90_cycle: float = None
+   matched_snp_p90_cycle: float = None
+   unmatched_snp_p90_cycle: float = None
+   matched_indel_p90_cycle: float = None
+   unmatched_indel_p90_cycle: float = None
+
+
+
+# 以Accumulator保存的属性
+ACCUMULATOR_FIELDS = [name for name, type_ in PositionInfo.__annotations__.items() if type_ is Accumulator]
+# 需要保存每个read的原始数值才能输出的属性
+RAW_FIELDS = frozenset(ACCUMULATOR_FIELDS + ['indel_length', 'query_snp', 'query_indel'])
+# 逐read收集的三类数值
+STAT_GROUPS = ('seq_quality', 'MAPQ', 'cycle')
+# {Accumulator属性: 数值的种类}，例如{'A_MAPQ': 'MAPQ'}
+STAT_GROUP_DICT = {attr_str: group_str for attr_str in ACCUMULATOR_FIELDS for group_str in STAT_GROUPS if attr_str.endswith('_' + group_str)}
+# {均值属性: 对应的Accumulator属性}，例如{'A_mean_MAPQ': 'A_MAPQ'}
+MEAN_FIELDS = {attr_str[:-len(group_str)] + 'mean_' + group_str: attr_str for attr_str in ACCUMULATOR_FIELDS for group_str in STAT_GROUPS if attr_str.endswith('_' + group_str)}
+# {分位数属性: (对应的Accumulator属性, 百分位)}，例如{'A_p90_MAPQ': ('A_MAPQ', 90)}，百分位为50的是中位数（median）
+PERCENTILE_FIELDS = {attr_str[:-len(group_str)] + stat_str + '_' + group_str: (attr_str, percent_int) for stat_str, percent_int in (('median', 50), ('p10', 10), ('p90', 90))
+                     for attr_str in ACCUMULATOR_FIELDS for group_str in STAT_GROUPS if attr_str.endswith('_' + group_str)}
+# 各类数值的histogram长度：测序质量Phred 0-93，MAPQ 0-255，cycle为0，随最大的read长度增长
+HISTOGRAM_SIZE_DICT = {'seq_quality': 94, 'MAPQ': 256, 'cycle': 0}
+COUNTER_FIELDS = ('indel_length_counter', 'query_snp_counter', 'query_indel_counter')
+
+
+# 由输出属性列表（-f）编译得到的计算计划，get_pos_info只收集和汇总计划中需要的数值
+@dataclass(frozen = True)
+class FormatPlan:
+   attributes: tuple = ()  # 输出的属性，已去除首尾空白
+   keep_raw: frozenset = frozenset()  # 需要保存每个read原始数值的属性
+   accumulators: frozenset = frozenset()  # 需要累加统计的Accumulator属性
+   stat_groups: frozenset = frozenset()  # 需要逐read收集的数值，STAT_GROUPS的子集
+   mean_fields: tuple = ()  # 需要计算的均值属性
+   histograms: frozenset = frozenset()  # 需要保存histogram的Accumulator属性
+   percentile_fields: tuple = ()  # 需要计算的分位数属性
+   counters: frozenset = frozenset()  # 需要计算的计数器属性
+   snp_match: bool = False  # 是否需要计算matched_snp和unmatched_snp相关属性
+   indel_match: bool = False  # 是否需要计算matched_indel和unmatched_indel相关属性
+   row_formatter: tuple = ()  # 每个输出属性的格式化函数，见compile_row_formatter
+
+
+def compile_format_plan(format_list: list[str, ...]) -> FormatPlan:
+   '''
+   将输出属性列表编译为计算计划
 
+   Parameters:
+      **format_list**: list[str, ...]
+         输出属性列表，每一个item是一个PositionInfo的属性名
 
+   Returns:
+      **plan**: FormatPlan
+         计算计划，传给get_pos_info, sweep_pos_info和add_attributes_pos_info
 
-# 输入一个PositionInfo对象和它的一个属性，首先将这个属性的字符串转化为人类易懂的格式，然后输出
-def __output_attr(pos_info:PositionInfo, attribute: str) -> str:
-
+   Raises:
+      ValueError: 属性列表中有PositionInfo不存在的属性
    '''
-   提取一个PositionInfo对象的一个属性，转换为适用于打印的字符串
 
-   Parameters:
-   **pos_info**: PositionInfo类
-      一个PositionInfo类对象
+   attribute_lst = [x.strip() for x in format_list]
+   for attr_str in attribute_lst:
+      if attr_str not in PositionInfo.__dataclass_fields__:
+         message = f'compile_format_plan: PositionInfo 对象不存在 {attr_str} 属性'
+         raise ValueError(message)
+
+   attribute_set = set(attribute_lst)
+   histogram_set = {PERCENTILE_FIELDS[x][0] for x in attribute_set if x in PERCENTILE_FIELDS}
+   accumulator_set = (attribute_set & set(ACCUMULATOR_FIELDS)) | {MEAN_FIELDS[x] for x in attribute_set if x in MEAN_FIELDS} | histogram_set
+
+   plan = FormatPlan(
+      attributes = tuple(attribute_lst),
+      keep_raw = frozenset(attribute_set & RAW_FIELDS),
+      accumulators = frozenset(accumulator_set),
+      stat_groups = frozenset(x for x in STAT_GROUPS if any(y.endswith('_' + x) for y in accumulator_set)),
+      mean_fields = tuple(x for x in MEAN_FIELDS if x in attribute_set),
+      histograms = frozenset(histogram_set),
+      percentile_fields = tuple(x for x in PERCENTILE_FIELDS if x in attribute_set),
+      counters = frozenset(x for x in COUNTER_FIELDS if x in attribute_set),
+      snp_match = any(x.startswith(('matched_snp', 'unmatched_snp')) for x in attribute_set),
+      indel_match = any(x.startswith(('matched_indel', 'unmatched_indel', 'matched_ins', 'unmatched_ins')) for x in attribute_set),
+      row_formatter = compile_row_formatter(tuple(attribute_lst)),
+   )
+
+   return plan
+
+
+# reads的过滤条件，在pileup中直接过滤（htslib读取reads时），被过滤的reads不参与任何统计，包括coverage
+# 默认不过滤任何reads，与之前的结果相同
+@dataclass(frozen = True)
+class ReadFilter:
+   min_mapq: int = 0  # 过滤MAPQ小于min_mapq的reads
+   min_base_quality: int = 0  # 过滤该位置碱基测序质量小于min_base_quality的reads，deletion按下一个碱基（query_position_or_next）的测序质量过滤
+   include_flags: int = 0  # 只保留flag包含全部这些位的reads
+   exclude_flags: int = 0  # 过滤flag包含其中任何一位的reads
+   ignore_overlaps: bool = False  # 同一对reads重叠时，只计算测序质量较高的一条（htslib将另一条的测序质量设为0）
+   max_depth: int = 0  # 每个位点最多统计max_depth条reads，超过时按F1/F2/R1/R2分层降采样（见__sample_reads），0为不限制
+   seed: int = 0  # 降采样的随机种子
+
+   @property
+   def is_active(self) -> bool:
+      return self != ReadFilter()
+
+   # 是否有需要htslib过滤的条件（降采样在pileup之后进行）
+   @property
+   def is_pileup_filter(self) -> bool:
+      return (self.min_mapq, self.min_base_quality, self.include_flags, self.exclude_flags, self.ignore_overlaps) != (0, 0, 0, 0, False)
+
+   def pileup_kwargs(self) -> dict:
+      '''
+      bam_af.pileup的过滤参数。不过滤时使用'nofilter' stepper；
+      有任何过滤条件时使用'samtools' stepper，由htslib按flag和MAPQ过滤reads，并关闭BAQ等会修改测序质量的处理
+      '''
+
+      if not self.is_pileup_filter:
+         return {'stepper': 'nofilter', 'ignore_overlaps': False, 'min_base_quality': 0}
+
+      return {'stepper': 'samtools', 'flag_filter': self.exclude_flags, 'flag_require': self.include_flags, 'min_mapping_quality': self.min_mapq,
+              'ignore_overlaps': self.ignore_overlaps, 'min_base_quality': max(self.min_base_quality, 1) if self.ignore_overlaps else self.min_base_quality,  # 测序质量为0的重叠碱基不计算
+              'compute_baq': False, 'redo_baq': False, 'adjust_capq_threshold': 0}
+
+   # 写入输出文件header的字符串
+   def header_str(self) -> str:
+      return f'min_mapq={self.min_mapq};min_base_quality={self.min_base_quality};include_flags={self.include_flags:#x};exclude_flags={self.exclude_flags:#x};ignore_overlaps={str(self.ignore_overlaps).lower()};max_depth={self.max_depth};seed={self.seed}'
+
+
+# = = = = = = = = = = = = = = 输出格式化 = = = = = = = = = = = = = =
+# 每个输出属性编译为一个专门的格式化函数 pos_info -> 字符串，输出属性列表只在compile_row_formatter中解析一次
+ZERO_COUNT = [0, 0, 0, 0]
+
+
+# 四个整数的计数列表 [12, 4, 2, 9] -> '12, 4, 2, 9'，全为0时输出''
+def __count_formatter(getter):
+   def format_column(pos_info: PositionInfo) -> str:
+      value = getter(pos_info)
+      if not value or value == ZERO_COUNT:
+         return ''
+      return '%d, %d, %d, %d' % tuple(value) if len(value) == 4 else ', '.join(map(str, value))
+   return format_column
 
-   **attribute**: str
-      属性字符串
 
-   Returns:
-       **output**: string
-       适用于打印的字符串
+# Accumulator只有保存了原始数值时才能输出 -> '30, 32, 37'
+def __accumulator_formatter(getter):
+   def format_column(pos_info: PositionInfo) -> str:
+      value = getter(pos_info)
+      if value is None or not value.values:
+         return ''
+      return ', '.join(map(str, value.values))
+   return format_column
 
-   '''
-   try:
-      value = getattr(pos_info, attribute)
-   except AttributeError:
-      message = f'__output_attr： PositionInfo 对象不存在 {attribute} 属性'
-      print(message)
-      sys.exit(message)
-
-   if isinstance(value, list):
-      if value == []:
+
+# 整数列表 [0, 0, 2, -3] -> '0, 0, 2, -3'
+def __int_list_formatter(getter):
+   def format_column(pos_info: PositionInfo) -> str:
+      value = getter(pos_info)
+      if not value:
          return ''
+      return ', '.join(map(str, value))
+   return format_column
+
+
+# 字符串列表只输出出现过的种类，排序后输出 ['A', 'A', '+2AC'] -> '+2AC, A'
+def __set_formatter(getter):
+   def format_column(pos_info: PositionInfo) -> str:
+      value = getter(pos_info)
+      if not value:
+         return ''
+      return ', '.join(sorted(set(value)))
+   return format_column
 
-      if isinstance(value[0], int): # [12,4,2,9]
-         if value == [0, 0, 0, 0]:
-            return ''
-         else:
-            return str(value)[1:-1]
-      else:   #  ['A', 'A', '+2AC']
-         value = list(set(value))
-         return str(value)[1:-1].replace("'", "")
 
-   if isinstance(value, int):
+# Counter按数量从多到少输出 -> 'A: 10, *: 2'
+def __counter_formatter(getter):
+   def format_column(pos_info: PositionInfo) -> str:
+      value = getter(pos_info)
+      if not value:
+         return ''
+      return ', '.join([f'{key}: {count}' for key, count in value.most_common()])
+   return format_column
+
+
+# 整数直接输出，浮点数保留一位小数
+def __number_formatter(getter):
+   def format_column(pos_info: PositionInfo) -> str:
+      value = getter(pos_info)
+      if value is None:
+         return ''
+      if value.__class__ is float:
+         return str(round(value, 1))
       return str(value)
+   return format_column
+
+
+def __str_formatter(getter):
+   def format_column(pos_info: PositionInfo) -> str:
+      value = getter(pos_info)
+      if value.__class__ is str:
+         return value
+      return '' if value is None else str(value)
+   return format_column
+
+
+# 属性的种类，决定输出格式
+# 'count': 四个整数的计数列表；'int_list': 整数列表（Accumulator的原始数值和indel_length）；'str_list': 字符串列表；
+# 'counter': collections.Counter；'int', 'float', 'str': 单个数值或字符串
+def column_kind(attr_str: str) -> str:
+
+   type_ = PositionInfo.__annotations__[attr_str]
+   if attr_str in COUNTER_FIELDS:
+      return 'counter'
+   if type_ is Accumulator or attr_str == 'indel_length':
+      return 'int_list'
+   if attr_str.endswith('_count'):
+      return 'count'
+   if type_ is list:  # query_snp, query_indel, real_allele_snp, real_allele_indel
+      return 'str_list'
+   if type_ is int:
+      return 'int'
+   if type_ is float:
+      return 'float'
+   return 'str'
+
+
+# 根据属性的种类选择格式化函数
+def __column_formatter(attr_str: str):
+
+   kind_str = column_kind(attr_str)
+   getter = operator.attrgetter(attr_str)
+   if kind_str == 'counter':
+      return __counter_formatter(getter)
+   if kind_str == 'int_list':
+      return __accumulator_formatter(getter) if PositionInfo.__annotations__[attr_str] is Accumulator else __int_list_formatter(getter)
+   if kind_str == 'count':
+      return __count_formatter(getter)
+   if kind_str == 'str_list':
+      return __set_formatter(getter)
+   if kind_str == 'int' or kind_str == 'float':
+      return __number_formatter(getter)
+   return __str_formatter(getter)
+
+
+@functools.lru_cache(maxsize = 64)
+def compile_row_formatter(attributes: tuple[str, ...]) -> tuple:
+   '''
+   将输出属性列表编译为每列一个的格式化函数，之后用format_row输出
+
+   Parameters:
+      **attributes**: tuple[str, ...]
+         输出属性，每一个item是一个PositionInfo的属性名
 
-   if isinstance(value, float):
-      return str(round(value, 1))
+   Returns:
+      **row_formatter**: tuple
+         每个输出属性对应的格式化函数
+
+   Raises:
+      ValueError: 属性列表中有PositionInfo不存在的属性
+   '''
 
-   if isinstance(value, collections.Counter):
-      return str(value)[9:-2].replace("'", '')
+   row_formatter = []
+   for attr_str in attributes:
+      if not isinstance(attr_str, str) or attr_str.strip() not in PositionInfo.__dataclass_fields__:
+         message = f'compile_row_formatter: PositionInfo 对象不存在 {attr_str} 属性'
+         raise ValueError(message)
+      row_formatter.append(__column_formatter(attr_str.strip()))
 
-   if value is None:
-      return ''
+   return tuple(row_formatter)
 
-   return str(value)
+
+# 使用compile_row_formatter编译好的格式化函数输出一个PositionInfo对象
+def format_row(pos_info: PositionInfo, row_formatter: tuple) -> str:
+   return '\t'.join([format_function(pos_info) for format_function in row_formatter]).strip()
 
 
 # 输入一个PositionInfo对象和它的一个属性列表，然后输出
 def output_attributes_pos_info(pos_info:PositionInfo, attributes: list[str, ...]) -> str:
    '''
-   输入一个PositionInfo对象和它的一个属性列表，然后输出
+   输入一个PositionInfo对象和它的一个属性列表，然后输出。需要输出大量位点时，请使用FormatPlan.row_formatter和format_row
 
    Parameters:
       **pos_info**: PositionInfo
@@ -162,20 +617,19 @@ def output_attributes_pos_info(pos_info:PositionInfo, attributes: list[str, ...]
        **output_str**: str
          输出的字符串
    '''
-   output_str = ''
-   for attr_str in attributes:
-      if not isinstance(attr_str, str):
-         message = f'output_attributes_pos_info: attribute {attr} ({type(attr)}) is not a string.'
-         sys.exit(message)
 
-      attr_str = attr_str.strip()
-      output_str += '\t' + __output_attr(pos_info, attr_str)
+   return format_row(pos_info, compile_row_formatter(tuple(attributes)))
+
 
-   return output_str.strip()
+# 不过滤reads时的pileup参数
+NO_FILTER_KWARGS = ReadFilter().pileup_kwargs()
+
+# 计算除原始数值列表外的全部属性，get_pos_info等函数不指定plan时使用
+FULL_PLAN = compile_format_plan([x for x in PositionInfo.__dataclass_fields__ if x not in RAW_FIELDS])
 
 # 输入一个PositionInfo对象，利用副作用，设置PositionInfo对象内部的一些其他属性
 # 设置了以下属性：
-# X_mean_seq_quality    # X in 'A T C G N miss
+# X_mean_seq_quality    # X in 'A T C G N'
 # ins_mean_seq_quality
 # matched_snp_mean_seq_quality
 # unmatched_snp_mean_seq_quality
@@ -201,33 +655,40 @@ def output_attributes_pos_info(pos_info:PositionInfo, attributes: list[str, ...]
 # indel_length_counter
 # query_snp_counter
 # query_indel_counter
-def add_attributes_pos_info(pos_info:PositionInfo) -> int:
+def add_attributes_pos_info(pos_info:PositionInfo, plan: FormatPlan = None) -> int:
    '''
    输入一个PositionInfo对象，利用副作用，设置PositionInfo对象内部的一些其他属性
-   '''
 
-   for base in ['A', 'T', 'C', 'G', 'N', 'miss', 'matched_snp', 'unmatched_snp', 'matched_ins', 'unmatched_ins', 'matched_indel', 'unmatched_indel']:
-      for attr in ['seq_quality', 'MAPQ', 'cycle']:
-         try:
-            origial_attr_lst = getattr(pos_info, f'{base}_{attr}')
-         except AttributeError:
-            continue
-         except Exception as ex:
-            print('add_attributes_pos_info:', ex, pos_info)
-            return(pos_info)
-
-         if origial_attr_lst == []:
-            setattr(pos_info, f'{base}_mean_{attr}', None)
-         else:
-            try:
-               setattr(pos_info, f'{base}_mean_{attr}', statistics.mean(origial_attr_lst))
-            except Exception as ex:
-               setattr(pos_info, f'{base}_mean_{attr}', None)
-               print('add_attributes_pos_info:', ex, f'{base}_mean_{attr}', origial_attr_lst)
+   Parameters:
+      **pos_info**: PositionInfo
+         一个PositionInfo对象
 
-   pos_info.indel_length_counter = collections.Counter(pos_info.indel_length) if pos_info.indel_length != [] else None
-   pos_info.query_snp_counter = collections.Counter(pos_info.query_snp) if pos_info.query_snp != [] else None
-   pos_info.query_indel_counter = collections.Counter(pos_info.query_indel) if pos_info.query_indel != [] else None
+      **plan**: FormatPlan
+         可选, 计算计划（见compile_format_plan），只计算其中的均值和分位数属性。默认为FULL_PLAN
+   '''
+
+   if plan is None:
+      plan = FULL_PLAN
+
+   for mean_attr_str in plan.mean_fields:
+      accumulator = getattr(pos_info, MEAN_FIELDS[mean_attr_str])
+      setattr(pos_info, mean_attr_str, accumulator.mean if accumulator is not None else None)
+
+   for percentile_attr_str in plan.percentile_fields:
+      accumulator_attr_str, percent_int = PERCENTILE_FIELDS[percentile_attr_str]
+      accumulator = getattr(pos_info, accumulator_attr_str)
+      if accumulator is None:
+         value = None
+      elif percent_int == 50:
+         value = accumulator.median
+      else:
+         value = accumulator.percentile(percent_int)
+      setattr(pos_info, percentile_attr_str, value)
+
+   # 计数器在get_pos_info中边读边累加，这里只把空计数器换成None
+   for attr in COUNTER_FIELDS:
+      if not getattr(pos_info, attr):
+         setattr(pos_info, attr, None)
 
    return 0
 
@@ -242,6 +703,11 @@ def add_attributes_pos_info(pos_info:PositionInfo) -> int:
 # query_snp: List[str, ...]
 # query_indel: List[str, ...]
 
+# 只计算plan（见compile_format_plan）中需要的属性，不需要的Accumulator属性和counter为None
+# 以下的List[int, ...]属性均以Accumulator对象保存，只有属性名在plan.keep_raw中时才保存原始数值(Accumulator.values)，
+# 只有在plan.histograms中时才保存histogram(Accumulator.histogram)
+# indel_length, query_snp和query_indel也只有在plan.keep_raw中时才保存，否则为None
+
 # X_count: List[int, int, int, int]   # X in 'A T C G N miss'
 # X_seq_quality: List[int, ...]   # X in 'A T C G N'
 # X_MAPQ: List[int, ...]   # X in 'A T C G N miss'
@@ -279,7 +745,7 @@ def add_attributes_pos_info(pos_info:PositionInfo) -> int:
 
 # matched_indel_cycle: List[int, ...]
 # unmatched_indel_cycle: List[int, ...]
-def get_pos_info(bam_af: pysam.AlignmentFile, chrom: str, pos: int, real_allele_snp: tuple[str, ...] = None, real_allele_indel: tuple[str, ...] = None) -> PositionInfo:
+def get_pos_info(bam_af: pysam.AlignmentFile, chrom: str, pos: int, real_allele_snp: tuple[str, ...] = None, real_allele_indel: tuple[str, ...] = None, plan: FormatPlan = None, read_filter: ReadFilter = None, profiler = None) -> PositionInfo:
    '''
    提取位点信息，包括位点深度，四种碱基read数（百分比），四种碱基平均测序质量，四种碱基的正反向数量，四种碱基orientation数量等
 
@@ -299,171 +765,363 @@ def get_pos_info(bam_af: pysam.AlignmentFile, chrom: str, pos: int, real_allele_
          real_allele_snp表示该位点所在位置的序列的种类和数量，碱基用ATCG， miss用*表示。
          real_allele_indel表示该位点所在位置后接InDel的序列的种类和数量，以samtools的格式表示，例如‘+2AC’, '-3NNN'等等。
 
+      **plan**: FormatPlan
+         可选, 计算计划（见compile_format_plan），只收集和汇总输出需要的数值。默认为FULL_PLAN，计算除原始数值列表外的全部属性
+
+      **read_filter**: ReadFilter
+         可选, reads的过滤条件和降采样的深度上限，默认不过滤任何reads
+
+      **profiler**: profiling.StageProfiler
+         可选, 记录pileup和read_loop两个阶段的时间（见lib/profiling.py），默认不记录
+
    Returns:
        **PositionInfo**: class
          PositionInfo类
    '''
 
-   result_pos = PositionInfo()
+   if plan is None:
+      plan = FULL_PLAN
 
+   result_pos = __new_pos_info(chrom, pos, plan, real_allele_snp, real_allele_indel)
+   pileup_iter = __pileup(bam_af, chrom, pos - 1, pos, read_filter)
+   if profiler is not None:
+      pileup_iter = profiler.timed_iter('pileup', pileup_iter)
 
-   result_pos.A_count = [0, 0, 0, 0]
-   result_pos.T_count = [0, 0, 0, 0]
-   result_pos.C_count = [0, 0, 0, 0]
-   result_pos.G_count = [0, 0, 0, 0]
-   result_pos.N_count = [0, 0, 0, 0]
-   result_pos.miss_count = [0, 0, 0, 0]
-   result_pos.del_count = [0, 0, 0, 0]
-   result_pos.ins_count = [0, 0, 0, 0]
+   for pileupcolumn in pileup_iter:
+      if profiler is None:
+         __add_pileup_column(result_pos, pileupcolumn, plan, real_allele_snp, real_allele_indel, read_filter)
+      else:
+         start = profiler.begin()
+         __add_pileup_column(result_pos, pileupcolumn, plan, real_allele_snp, real_allele_indel, read_filter)
+         profiler.end('read_loop', start)
 
-   result_pos.matched_snp_count = [0, 0, 0, 0]
-   result_pos.unmatched_snp_count = [0, 0, 0, 0]
-   result_pos.matched_indel_count = [0, 0, 0, 0]
-   result_pos.unmatched_indel_count = [0, 0, 0, 0]
-   result_pos.background_count = [0, 0, 0, 0]
+   return result_pos
 
 
-   result_pos.chrom = chrom
-   result_pos.pos = pos
-   result_pos.real_allele_indel = real_allele_indel
-   result_pos.real_allele_snp = real_allele_snp
+# 在一个窗口内只做一次pileup，依次返回窗口内每个查询位置的PositionInfo对象
+# 与对每个位置分别调用get_pos_info的结果相同，但窗口内的reads只需要解码一次
+# for pos_info in sweep_pos_info(bam_af, 'chr1', [1000, 1001, 1005]):
+def sweep_pos_info(bam_af: pysam.AlignmentFile, chrom: str, pos_lst: list[int, ...], real_allele_lst: list[tuple, ...] = None, plan: FormatPlan = None, read_filter: ReadFilter = None, profiler = None) -> Iterator[PositionInfo]:
+   '''
+   对一个窗口做一次pileup，当pileup经过pos_lst中的位置时，生成该位置的PositionInfo对象
 
-   for pileupcolumn in bam_af.pileup(contig = chrom, start = pos - 1, stop = pos, truncate = True, max_depth = 999999999, stepper = 'nofilter', ignore_overlaps=False, ignore_orphans = False, min_base_quality=0):
+   Parameters:
+      **bam_af**: pysam.AlignmentFile
+         一个pysam.AlignmentFile对象
 
-      result_pos.coverage = pileupcolumn.get_num_aligned()
-      query_indel_lst = [x.upper()[1:] for x in pileupcolumn.get_query_sequences(add_indels = True)] # 用来在后面获取InDel read的query string ['', '', '', '', '+2AC', '-4NNN']
-      # query_snp_lst = [x.upper()[0] for x in pileupcolumn.get_query_sequences(add_indels = True)]
+      **chrom**: str
+         染色体
+
+      **pos_lst**: list[int, ...]
+         排序且不重复的位置（1-based）, 窗口为pos_lst[0]至pos_lst[-1]
 
-      #temp = []
-      #for x in query_indel_lst:
-         #if x != '':
-            #temp.append(x)
-      #print(collections.Counter(query_snp_lst))
-      #print(collections.Counter(temp))
+      **real_allele_lst**: list[tuple, ...]
+         可选, 长度与pos_lst相同，每个元素为(real_allele_snp, real_allele_indel)，含义同get_pos_info
 
+      **plan, read_filter, profiler**:
+         可选, 含义同get_pos_info
 
-      for i, pileup_read in enumerate(pileupcolumn.pileups):
-         segment = pileup_read.alignment
-         if pileup_read.is_refskip:
-            message = 'get_pos_info：read {} is_refskip 为真(flag {})，忽略此read（is_forward:{}, is_reverse:{}, is_read1:{}, is_read2:{}'.format(segment.query_name, segment.flag, segment.is_forward, segment.is_reverse, segment.is_read1, segment.is_read2)
-            print(message)
-            continue
+   Returns:
+       **Iterator[PositionInfo]**
+         按pos_lst的顺序，每个位置生成一个PositionInfo对象，没有reads覆盖的位置同样生成
+   '''
 
-         flag_index_int = utils.get_index(segment)
-         if flag_index_int is None:
-            message = 'get_pos_info：无法判断read {} 方向(flag {})，忽略此read（is_forward:{}, is_reverse:{}, is_read1:{}, is_read2:{}'.format(segment.query_name, segment.flag, segment.is_forward, segment.is_reverse, segment.is_read1, segment.is_read2)
-            print(message)
-            continue
+   if pos_lst == []:
+      return None
 
+   if real_allele_lst is None:
+      real_allele_lst = [(None, None)] * len(pos_lst)
 
-         result_pos.background_count[flag_index_int] += 1
-         result_pos.indel_length.append(pileup_read.indel) #  indel length (- 0 +)for the position following the current pileup site.
+   if plan is None:
+      plan = FULL_PLAN
 
-         mapq_int = segment.mapping_quality
+   pileup_iter = __pileup(bam_af, chrom, pos_lst[0] - 1, pos_lst[-1], read_filter)
+   if profiler is not None:
+      pileup_iter = profiler.timed_iter('pileup', pileup_iter)
 
-         if segment.is_forward:
-            cycle_int = pileup_read.query_position_or_next + 1 # 当前位置在read上面的cycle数，如果是miss，是下一个碱基的cycle。+1 为了将0-based转换成1-based
-         else:
-            cycle_int = segment.infer_read_length() - pileup_read.query_position_or_next
-
-         # = = = = = = = = = = = = = = 获取并设置当前位置（snp）的信息 = = = = = = = = = = = = = =
-         if pileup_read.query_position is not None: #  当前位置不是miss
-            base = segment.query_sequence[pileup_read.query_position]
-            result_pos.query_snp.append(base)
-            seq_quality_int = segment.get_forward_qualities()[pileup_read.query_position]
-         else:   #  当前位置为miss
-            base = 'miss'
-            result_pos.query_snp.append('*')
-            # seq_quality_int = -1
-
-         # set count
-         attr_str = base + '_count'
-         temp_lst = getattr(result_pos, attr_str)
-         temp_lst[flag_index_int] += 1
-         setattr(result_pos, attr_str, temp_lst)
-
-         # set seq quality
-         attr_str = base + '_seq_quality'
-         if base != 'miss':  #  只设置 非miss reads的测序质量
-            temp_lst = getattr(result_pos, attr_str)
-            temp_lst.append(seq_quality_int)
-            setattr(result_pos, attr_str, temp_lst)
-
-         # set map quality
-         attr_str = base + '_MAPQ'
-         temp_lst = getattr(result_pos, attr_str)
-         temp_lst.append(mapq_int)
-         setattr(result_pos, attr_str, temp_lst)
-
-         # set cycle
-         attr_str = base + '_cycle'
-         temp_lst = getattr(result_pos, attr_str)
-         temp_lst.append(cycle_int)
-         setattr(result_pos, attr_str, temp_lst)
-
-         # set matched and unmatched
-         if real_allele_snp is not None and base in real_allele_snp: #  matched
-            result_pos.matched_snp_count[flag_index_int] += 1
-            result_pos.matched_snp_MAPQ.append(mapq_int)
-            result_pos.matched_snp_cycle.append(cycle_int)
-            if base != 'miss':  # 只设置非miss的matched_snp_seq_quality
-               result_pos.matched_snp_seq_quality.append(seq_quality_int)
-         elif real_allele_snp is not None and base not in real_allele_snp: #  matched:
-            result_pos.unmatched_snp_count[flag_index_int] += 1
-            result_pos.unmatched_snp_MAPQ.append(mapq_int)
-            result_pos.unmatched_snp_cycle.append(cycle_int)
-            if base != 'miss':  # 只设置非miss的unmatched_snp_seq_quality
-               result_pos.unmatched_snp_seq_quality.append(seq_quality_int)
+   i = 0
+   for pileupcolumn in pileup_iter:
+      column_pos = pileupcolumn.reference_pos + 1
+
+      # 没有reads覆盖的位置
+      while i < len(pos_lst) and pos_lst[i] < column_pos:
+         yield __new_pos_info(chrom, pos_lst[i], plan, *real_allele_lst[i])
+         i += 1
+
+      if i < len(pos_lst) and pos_lst[i] == column_pos:
+         result_pos = __new_pos_info(chrom, pos_lst[i], plan, *real_allele_lst[i])
+         if profiler is None:
+            __add_pileup_column(result_pos, pileupcolumn, plan, *real_allele_lst[i], read_filter = read_filter)
          else:
-            pass
+            start = profiler.begin()
+            __add_pileup_column(result_pos, pileupcolumn, plan, *real_allele_lst[i], read_filter = read_filter)
+            profiler.end('read_loop', start)
+         yield result_pos
+         i += 1
+
+   while i < len(pos_lst):
+      yield __new_pos_info(chrom, pos_lst[i], plan, *real_allele_lst[i])
+      i += 1
+
+   return None
 
 
-         # = = = = = = = = = = = = = = 获取并设置当前位置后接InDel的信息 = = = = = = = = = = = = = =
-         if pileup_read.indel != 0:  # 如果后接位置存在InDel
-            indel_alt_str = query_indel_lst[i]
-            result_pos.query_indel.append(indel_alt_str)
+# 对[start, stop)区间（0-based）做pileup, read_filter为None时不过滤任何reads
+# 直接使用bam_af的文件句柄（multiple_iterators = False），不为每次pileup重新打开文件，打开时设置的htslib解压线程和CRAM参考基因组对pileup同样有效
+def __pileup(bam_af: pysam.AlignmentFile, chrom: str, start: int, stop: int, read_filter: ReadFilter = None) -> Iterator[pysam.PileupColumn]:
+   filter_dict = read_filter.pileup_kwargs() if read_filter is not None else NO_FILTER_KWARGS
+   return bam_af.pileup(contig = chrom, start = start, stop = stop, truncate = True, max_depth = 999999999, ignore_orphans = False, multiple_iterators = False, **filter_dict)
 
-            if pileup_read.indel > 0: # 后方有插入
-               result_pos.ins_count[flag_index_int] += 1 #  count
-               seq_quality_lst = list(segment.query_qualities)[pileup_read.query_position + 1:pileup_read.query_position + pileup_read.indel + 1]
-               result_pos.ins_seq_quality.extend(seq_quality_lst)
-               result_pos.ins_MAPQ.append(mapq_int)
-               result_pos.ins_cycle.append(cycle_int)
 
-               # indel_alt_str = segment.query_sequence[pileup_read.query_position + 1: pileup_read.query_position + pileup_read.indel + 1]
-               # indel_alt_str = '+' + str(len(indel_alt_str)) + indel_alt_str
+# 新建一个PositionInfo对象，并初始化各个计数
+def __new_pos_info(chrom: str, pos: int, plan: FormatPlan, real_allele_snp: tuple[str, ...] = None, real_allele_indel: tuple[str, ...] = None) -> PositionInfo:
 
-            if pileup_read.indel < 0: # 后方有缺失
-               result_pos.del_count[flag_index_int] += 1
-               seq_quality_lst = []
-               result_pos.del_MAPQ.append(mapq_int)
-               result_pos.del_cycle.append(cycle_int)
+   result_pos = PositionInfo()
+
+   result_pos.A_count = [0, 0, 0, 0]
+   result_pos.T_count = [0, 0, 0, 0]
+   result_pos.C_count = [0, 0, 0, 0]
+   result_pos.G_count = [0, 0, 0, 0]
+   result_pos.N_count = [0, 0, 0, 0]
+   result_pos.miss_count = [0, 0, 0, 0]
+   result_pos.del_count = [0, 0, 0, 0]
+   result_pos.ins_count = [0, 0, 0, 0]
 
-               # indel_alt_str = str(pileup_read.indel) + 'N' * abs(pileup_read.indel)
+   result_pos.matched_snp_count = [0, 0, 0, 0]
+   result_pos.unmatched_snp_count = [0, 0, 0, 0]
+   result_pos.matched_indel_count = [0, 0, 0, 0]
+   result_pos.unmatched_indel_count = [0, 0, 0, 0]
+   result_pos.background_count = [0, 0, 0, 0]
 
-            # set matched and unmatched
-            if real_allele_indel is not None and indel_alt_str in real_allele_indel:
-               result_pos.matched_indel_count[flag_index_int] += 1
-               result_pos.matched_ins_seq_quality.extend(seq_quality_lst)
-               result_pos.matched_indel_MAPQ.append(mapq_int)
-               result_pos.matched_indel_cycle.append(cycle_int)
+   for attr_str in plan.accumulators:
+      setattr(result_pos, attr_str, Accumulator(attr_str in plan.keep_raw, attr_str in plan.histograms, HISTOGRAM_SIZE_DICT[STAT_GROUP_DICT[attr_str]]))
 
-            elif real_allele_indel is not None and indel_alt_str not in real_allele_indel:
-               result_pos.unmatched_indel_count[flag_index_int] += 1
-               result_pos.unmatched_ins_seq_quality.extend(seq_quality_lst)
-               result_pos.unmatched_indel_MAPQ.append(mapq_int)
-               result_pos.unmatched_indel_cycle.append(cycle_int)
+   result_pos.indel_length = [] if 'indel_length' in plan.keep_raw else None
+   result_pos.query_snp = [] if 'query_snp' in plan.keep_raw else None
+   result_pos.query_indel = [] if 'query_indel' in plan.keep_raw else None
+   for attr_str in plan.counters:
+      setattr(result_pos, attr_str, collections.Counter())
 
-            else:
-               pass
+   result_pos.chrom = chrom
+   result_pos.pos = pos
+   result_pos.real_allele_indel = real_allele_indel
+   result_pos.real_allele_snp = real_allele_snp
 
    return result_pos
 
 
+# 从一个位点的reads中确定性地选出max_depth条，按flag序号（F1/F2/R1/R2，见utils.get_index）分层，各层按reads数的比例分配名额（最大余数法）
+# 每层内选择优先级最小的reads，优先级为read名称的crc32（以seed为初值），相当于以固定随机种子做reservoir sampling：
+# 结果与reads的顺序和进程数无关，同一条read在相邻位点上的去留相同
+# 每条read只读取flag和名称（get_query_names在C中完成），碱基、测序质量等只对选中的reads读取，见__add_pileup_column
+def __sample_reads(pileupcolumn: pysam.PileupColumn, pileup_lst: list, max_depth: int, seed: int = 0) -> list[int, ...]:
+
+   seed &= 0xFFFFFFFF
+   flag_lst = [pileup_read.alignment.flag for pileup_read in pileup_lst]
+   priority_lst = [zlib.crc32(name_str.encode(), seed) for name_str in pileupcolumn.get_query_names()]
+
+   flag_array = np.array(flag_lst, dtype = np.int64)
+   stratum_array = ((flag_array >> 4) & 1) * 2 + (((flag_array >> 7) & 1) & (1 - ((flag_array >> 6) & 1)))
+   priority_array = np.array(priority_lst, dtype = np.int64)
+
+   read_int = len(flag_lst)
+   stratum_count_array = np.bincount(stratum_array, minlength = 4)
+   quota_array = stratum_count_array * max_depth // read_int
+   remainder_array = stratum_count_array * max_depth - quota_array * read_int
+   order_array = np.lexsort((np.arange(4), -remainder_array))  # 余数从大到小，相同时按层的序号
+   quota_array[order_array[:max_depth - quota_array.sum()]] += 1
+
+   index_lst = []
+   for stratum_int in range(4):
+      index_array = np.flatnonzero(stratum_array == stratum_int)
+      if quota_array[stratum_int] < len(index_array):
+         index_array = index_array[np.lexsort((index_array, priority_array[index_array]))[:quota_array[stratum_int]]]
+      index_lst.append(index_array)
+
+   return np.sort(np.concatenate(index_lst)).tolist()
+
+
+# 一条read在pileupcolumn.get_query_sequences(add_indels = True)中对应的字符串（不区分大小写）：碱基或'*'，后接InDel时加上'+2AC'或'-4NNNN'
+def __query_string(pileup_read: pysam.PileupRead, segment: pysam.AlignedSegment) -> str:
+   query_position = pileup_read.query_position
+   query_str = '*' if query_position is None else segment.query_sequence[query_position]
+   indel_int = pileup_read.indel
+   if indel_int > 0:
+      start = pileup_read.query_position_or_next + 1
+      query_str += f'+{indel_int}' + segment.query_sequence[start:start + indel_int]
+   elif indel_int < 0:
+      query_str += f'-{-indel_int}' + 'N' * -indel_int
+
+   return query_str
+
+
+# 将一个pileupcolumn中全部reads的信息累加到result_pos中
+# 先逐个read收集flag、碱基、测序质量、MAPQ、cycle和indel长度到数组中，再用numpy按碱基和flag序号统一汇总
+# 只收集plan中需要的数值，例如没有请求cycle相关的属性时不计算cycle
+# 覆盖度超过read_filter.max_depth时，只统计__sample_reads选出的reads，coverage仍为全部reads数
+def __add_pileup_column(result_pos: PositionInfo, pileupcolumn: pysam.PileupColumn, plan: FormatPlan, real_allele_snp: tuple[str, ...] = None, real_allele_indel: tuple[str, ...] = None, read_filter: ReadFilter = None) -> None:
+
+   need_quality_bool = 'seq_quality' in plan.stat_groups
+   need_mapq_bool = 'MAPQ' in plan.stat_groups
+   need_cycle_bool = 'cycle' in plan.stat_groups
+
+   result_pos.coverage = pileupcolumn.get_num_aligned()
+   pileup_lst = pileupcolumn.pileups
+   if read_filter is not None and 0 < read_filter.max_depth < len(pileup_lst):
+      # 降采样时碱基、测序质量和MAPQ只对选中的reads逐个读取（见__query_string），不为整列生成
+      read_index_lst = __sample_reads(pileupcolumn, pileup_lst, read_filter.max_depth, read_filter.seed)
+      query_seq_lst = query_quality_lst = mapq_lst = None
+   else:
+      read_index_lst = range(len(pileup_lst))
+      query_seq_lst = pileupcolumn.get_query_sequences(add_indels = True)  # ['A', 'c', '*', 'A+2AC', 'G-4NNNN']，与pileups一一对应
+      query_quality_lst = pileupcolumn.get_query_qualities() if need_quality_bool else None
+      mapq_lst = pileupcolumn.get_mapping_qualities() if need_mapq_bool else None
+   result_pos.sampled_coverage = len(read_index_lst)
+
+   flag_lst, base_code_lst, quality_lst, mapq_int_lst, cycle_lst, indel_lst = [], [], [], [], [], []
+   query_indel_lst = []  # 后接InDel的reads的query string ['+2AC', '-4NNNN']
+   ins_seq_quality_lst = []  # 后接插入的reads的插入碱基测序质量 [[30, 32], [37]]
+   for i in read_index_lst:
+      pileup_read = pileup_lst[i]
+      segment = pileup_read.alignment
+      if pileup_read.is_refskip:
+         message = 'get_pos_info：read {} is_refskip 为真(flag {})，忽略此read（is_forward:{}, is_reverse:{}, is_read1:{}, is_read2:{}'.format(segment.query_name, segment.flag, segment.is_forward, segment.is_reverse, segment.is_read1, segment.is_read2)
+         print(message)
+         continue
+
+      query_str = query_seq_lst[i] if query_seq_lst is not None else __query_string(pileup_read, segment)
+      base_str = query_str[0]
+      try:
+         base_code_lst.append(BASE_CODE_DICT[base_str])
+      except KeyError:
+         raise AttributeError(f"'PositionInfo' object has no attribute '{base_str.upper()}_count'")
+
+      flag_int = segment.flag
+      flag_lst.append(flag_int)
+      indel_lst.append(pileup_read.indel) #  indel length (- 0 +)for the position following the current pileup site.
+      if need_mapq_bool:
+         mapq_int_lst.append(mapq_lst[i] if mapq_lst is not None else segment.mapping_quality)
+
+      query_position = pileup_read.query_position
+      if flag_int & 0x10 == 0:
+         if need_cycle_bool:
+            cycle_lst.append(pileup_read.query_position_or_next + 1) # 当前位置在read上面的cycle数，如果是miss，是下一个碱基的cycle。+1 为了将0-based转换成1-based
+         if need_quality_bool:
+            quality_lst.append(query_quality_lst[i] if query_quality_lst is not None else segment.query_qualities[pileup_read.query_position_or_next])
+      else:
+         if need_cycle_bool:
+            cycle_lst.append(segment.infer_read_length() - pileup_read.query_position_or_next)
+         if need_quality_bool:
+            # 与get_forward_qualities()[query_position]保持一致
+            quality_lst.append(segment.query_qualities[-1 - query_position] if query_position is not None else 0)
+
+      if pileup_read.indel != 0:
+         query_indel_lst.append(query_str.upper()[1:])
+         if pileup_read.indel > 0 and need_quality_bool:
+            ins_seq_quality_lst.append(list(segment.query_qualities)[query_position + 1:query_position + pileup_read.indel + 1])
+
+   if flag_lst == []:
+      return None
+
+   flag_array = np.array(flag_lst, dtype = np.int64)
+   index_array = ((flag_array >> 4) & 1) * 2 + (((flag_array >> 7) & 1) & (1 - ((flag_array >> 6) & 1)))  # 见utils.get_index
+   base_array = np.array(base_code_lst, dtype = np.int64)
+   quality_array = np.array(quality_lst, dtype = np.int64) if need_quality_bool else None
+   mapq_array = np.array(mapq_int_lst, dtype = np.int64) if need_mapq_bool else None
+   cycle_array = np.array(cycle_lst, dtype = np.int64) if need_cycle_bool else None
+   indel_array = np.array(indel_lst, dtype = np.int64)
+
+   result_pos.background_count = __add_count(result_pos.background_count, index_array)
+   if result_pos.indel_length_counter is not None:
+      result_pos.indel_length_counter.update(indel_lst)
+   if result_pos.indel_length is not None:
+      result_pos.indel_length.extend(indel_lst)
+
+   # = = = = = = = = = = = = = = 当前位置（snp）的信息 = = = = = = = = = = = = = =
+   if result_pos.query_snp_counter is not None or result_pos.query_snp is not None:
+      query_snp_lst = [QUERY_SNP_LST[x] for x in base_code_lst]
+      if result_pos.query_snp_counter is not None:
+         result_pos.query_snp_counter.update(query_snp_lst)
+      if result_pos.query_snp is not None:
+         result_pos.query_snp.extend(query_snp_lst)
+
+   count_array = np.bincount(base_array * 4 + index_array, minlength = len(BASE_CODE_NAMES) * 4).reshape(-1, 4)
+   not_miss_array = base_array != BASE_CODE_DICT['*']
+   for code_int, base in enumerate(BASE_CODE_NAMES):
+      if count_array[code_int].any():
+         setattr(result_pos, base + '_count', [x + y for x, y in zip(getattr(result_pos, base + '_count'), count_array[code_int].tolist())])
+         if plan.stat_groups:
+            mask_array = base_array == code_int
+            if base != 'miss':  #  只设置 非miss reads的测序质量
+               __accumulate(result_pos, base + '_seq_quality', quality_array, mask_array)
+            __accumulate(result_pos, base + '_MAPQ', mapq_array, mask_array)
+            __accumulate(result_pos, base + '_cycle', cycle_array, mask_array)
+
+   if real_allele_snp is not None and plan.snp_match:
+      matched_array = np.isin(base_array, [code_int for code_int, base in enumerate(BASE_CODE_NAMES) if base in real_allele_snp])
+      for prefix, mask_array in (('matched_snp', matched_array), ('unmatched_snp', ~matched_array)):
+         setattr(result_pos, prefix + '_count', __add_count(getattr(result_pos, prefix + '_count'), index_array[mask_array]))
+         __accumulate(result_pos, prefix + '_MAPQ', mapq_array, mask_array)
+         __accumulate(result_pos, prefix + '_cycle', cycle_array, mask_array)
+         __accumulate(result_pos, prefix + '_seq_quality', quality_array, mask_array & not_miss_array)  # 只设置非miss的测序质量
+
+   # = = = = = = = = = = = = = = 当前位置后接InDel的信息 = = = = = = = = = = = = = =
+   if query_indel_lst == []:
+      return None
+
+   if result_pos.query_indel_counter is not None:
+      result_pos.query_indel_counter.update(query_indel_lst)
+   if result_pos.query_indel is not None:
+      result_pos.query_indel.extend(query_indel_lst)
+
+   ins_array = indel_array > 0
+   del_array = indel_array < 0
+   result_pos.ins_count = __add_count(result_pos.ins_count, index_array[ins_array])
+   result_pos.del_count = __add_count(result_pos.del_count, index_array[del_array])
+   if plan.stat_groups:
+      if result_pos.ins_seq_quality is not None:
+         result_pos.ins_seq_quality.add(np.array([x for seq_quality_lst in ins_seq_quality_lst for x in seq_quality_lst], dtype = np.int64))
+      __accumulate(result_pos, 'ins_MAPQ', mapq_array, ins_array)
+      __accumulate(result_pos, 'ins_cycle', cycle_array, ins_array)
+      __accumulate(result_pos, 'del_MAPQ', mapq_array, del_array)
+      __accumulate(result_pos, 'del_cycle', cycle_array, del_array)
+
+   if real_allele_indel is not None and plan.indel_match:
+      indel_read_array = indel_array != 0
+      matched_lst = [x in real_allele_indel for x in query_indel_lst]  # 与indel_read_array为True的reads一一对应
+      matched_array = np.zeros(len(indel_lst), dtype = bool)
+      matched_array[indel_read_array] = matched_lst
+      ins_matched_lst = [x for x, y in zip(matched_lst, indel_array[indel_read_array].tolist()) if y > 0]  # 与ins_seq_quality_lst一一对应
+      for prefix, mask_array, matched_bool in (('matched', matched_array, True), ('unmatched', indel_read_array & ~matched_array, False)):
+         setattr(result_pos, prefix + '_indel_count', __add_count(getattr(result_pos, prefix + '_indel_count'), index_array[mask_array]))
+         accumulator = getattr(result_pos, prefix + '_ins_seq_quality')
+         if accumulator is not None:
+            accumulator.add(np.array([x for seq_quality_lst, ins_matched_bool in zip(ins_seq_quality_lst, ins_matched_lst) if ins_matched_bool == matched_bool for x in seq_quality_lst], dtype = np.int64))
+         __accumulate(result_pos, prefix + '_indel_MAPQ', mapq_array, mask_array)
+         __accumulate(result_pos, prefix + '_indel_cycle', cycle_array, mask_array)
+
+   return None
+
+
+# 如果result_pos的attr_str属性需要累加统计（不为None），将value_array中mask_array为True的数值累加上去
+def __accumulate(result_pos: PositionInfo, attr_str: str, value_array: np.ndarray, mask_array: np.ndarray) -> None:
+   accumulator = getattr(result_pos, attr_str)
+   if accumulator is not None:
+      accumulator.add(value_array[mask_array])
+
+   return None
+
+
+# 将flag序号数组按序号计数后累加到count_lst上
+def __add_count(count_lst: list[int], index_array: np.ndarray) -> list[int]:
+   return [x + y for x, y in zip(count_lst, np.bincount(index_array, minlength = 4).tolist())]
+
+
 if __name__ == '__main__':
 
    import os.path as path
    import copy
+   import dataclasses
 
    bam_file = '~/server/result/sequencer/for_partner/zgbio/snvindelLOD_20240717/qua25_unqua10_len50/bam/sample_03/sample_03.filter.bam'
    bam_file = '~/server/result/sequencer/salus/giab/hg003_na24149_father/wgs/pro63_modelopt_20240705/qua25_unqua10_len50/rmdup/hg003_na24149_modelopt/hg003_na24149_modelopt.rmdup.sorted.bam'
@@ -496,12 +1154,7 @@ if __name__ == '__main__':
    result_copy = copy.copy(result)
    r = add_attributes_pos_info(result_copy)
 
-   for attr in list(result_copy.__dict__.keys()):
-      print(attr, result_copy.__dict__[attr])
-
-   i = 1
-   # print(result)
-   # print(result.coverage)
-   # print(collections.Counter(result.query_snp))
-   # print(collections.Counter(result.query_indel))
+   # PositionInfo使用slots，没有__dict__
+   for attr_field in dataclasses.fields(result_copy):
+      print(attr_field.name, getattr(result_copy, attr_field.name))
 
@@ -0,0 +1,188 @@
+# 分阶段性能统计（--profile）：记录各个阶段的墙钟时间和CPU时间、处理的位点数和reads数，以及最慢的位点
+# 不使用--profile时各处的profiler为None，热点路径上只多一次 is None 判断
+#
+# 工作进程每个任务结束时把本进程的统计（drain）随任务结果返回，主进程按进程号合并，运行结束后写成json报告（write_report）
+#
+# 阶段：
+# 主进程    truth         读取/编译标准位点
+#           parse_locus   预扫描位置文件（见utils.scan_locus_file），读取位置文件并分割成区块（在进程池的任务线程中运行）
+#           pool          进程池从启动到全部任务完成
+#           assemble      合并检查点目录中的区块，写成输出文件
+# 工作进程  task          一个任务（样本 × 区块）的全部时间
+#           open_bam      打开比对文件
+#           reference     读取参考基因组碱基和上下游序列
+#           pileup        bam_af.pileup取下一个pileup column（htslib读取和解码reads）
+#           read_loop     统计一个位点的reads（info.__add_pileup_column）
+#           attributes    info.add_attributes_pos_info
+#           format        格式化结果行（tsv）或者转换为列式的一行
+#           queue_put     把一批结果放入写入进程的queue，包括queue满时的等待
+#
+# CPU时间为time.process_time，包括进程中全部线程（例如htslib的解压线程）
+import os
+import json
+import time
+import heapq
+import contextlib
+
+SLOWEST_LOCI = 20  # 报告中保留的最慢位点数
+
+
+class StageProfiler:
+   '''
+   一个进程中的分阶段统计
+
+   profiler = StageProfiler()
+   start = profiler.begin()
+   ...
+   profiler.end('reference', start)
+
+   with profiler.stage('assemble'):
+      ...
+   '''
+
+   def __init__(self, slowest_int: int = SLOWEST_LOCI):
+
+      self.slowest_int = slowest_int
+      self.reset()
+
+   def reset(self) -> None:
+      self.stage_dict = {}  # {阶段: [墙钟时间, CPU时间, 次数]}
+      self.task_int = 0
+      self.locus_int = 0
+      self.read_int = 0
+      self.slowest_lst = []  # 最小堆 [(秒, 样本名, chrom, pos, 深度), ...]
+      return None
+
+   @staticmethod
+   def begin() -> tuple[float, float]:
+      return time.perf_counter(), time.process_time()
+
+   def end(self, name: str, start: tuple[float, float]) -> None:
+      wall = time.perf_counter() - start[0]
+      cpu = time.process_time() - start[1]
+      try:
+         stage_lst = self.stage_dict[name]
+      except KeyError:
+         stage_lst = self.stage_dict[name] = [0.0, 0.0, 0]
+      stage_lst[0] += wall
+      stage_lst[1] += cpu
+      stage_lst[2] += 1
+      return None
+
+   @contextlib.contextmanager
+   def stage(self, name: str):
+      start = self.begin()
+      try:
+         yield self
+      finally:
+         self.end(name, start)
+
+   # 包装一个迭代器，每次取下一个元素的时间计入name阶段
+   def timed_iter(self, name: str, iterator):
+      iterator = iter(iterator)
+      while True:
+         start = self.begin()
+         try:
+            item = next(iterator)
+         except StopIteration:
+            self.end(name, start)
+            return None
+         self.end(name, start)
+         yield item
+
+   # 记录一个位点：start为该位点开始处理时begin的返回值，depth为覆盖度（计入reads数）
+   def add_locus(self, sample_str: str, chrom: str, pos: int, depth: int, start: tuple[float, float]) -> None:
+      seconds = time.perf_counter() - start[0]
+      self.locus_int += 1
+      self.read_int += depth if depth is not None else 0
+      item = (seconds, sample_str, chrom, pos, depth)
+      if len(self.slowest_lst) < self.slowest_int:
+         heapq.heappush(self.slowest_lst, item)
+      elif item > self.slowest_lst[0]:
+         heapq.heapreplace(self.slowest_lst, item)
+      return None
+
+   def to_dict(self) -> dict:
+      return {'pid': os.getpid(), 'stages': {name: list(stage_lst) for name, stage_lst in self.stage_dict.items()}, 'tasks': self.task_int,
+              'loci': self.locus_int, 'reads': self.read_int, 'slowest_loci': list(self.slowest_lst)}
+
+   # 返回当前的统计并清零，工作进程每个任务结束时调用，返回值随任务结果送回主进程
+   def drain(self) -> dict:
+      profile_dict = self.to_dict()
+      self.reset()
+      return profile_dict
+
+   # 合并另一个进程的统计（to_dict或drain的返回值）
+   def merge(self, profile_dict: dict) -> None:
+      for name, (wall, cpu, call_int) in profile_dict['stages'].items():
+         stage_lst = self.stage_dict.setdefault(name, [0.0, 0.0, 0])
+         stage_lst[0] += wall
+         stage_lst[1] += cpu
+         stage_lst[2] += call_int
+      self.task_int += profile_dict['tasks']
+      self.locus_int += profile_dict['loci']
+      self.read_int += profile_dict['reads']
+      for item in profile_dict['slowest_loci']:
+         item = tuple(item)
+         if len(self.slowest_lst) < self.slowest_int:
+            heapq.heappush(self.slowest_lst, item)
+         elif item > self.slowest_lst[0]:
+            heapq.heapreplace(self.slowest_lst, item)
+      return None
+
+
+def __stages_report(stage_dict: dict) -> dict:
+   return {name: {'wall_seconds': round(wall, 6), 'cpu_seconds': round(cpu, 6), 'calls': call_int} for name, (wall, cpu, call_int) in sorted(stage_dict.items(), key = lambda x: -x[1][0])}
+
+
+def __rate(item_int: int, seconds: float):
+   return round(item_int / seconds, 2) if seconds > 0 else None
+
+
+def write_report(report_file: str, main_profiler: StageProfiler, worker_profiler_dict: dict, wall_seconds: float, cpu_seconds: float, extra_dict: dict = None) -> dict:
+   '''
+   汇总主进程和各个工作进程的统计，写成json报告
+
+   Parameters:
+      **report_file**: str
+         json报告文件
+
+      **main_profiler**: StageProfiler
+         主进程的统计
+
+      **worker_profiler_dict**: dict
+         {进程号: StageProfiler}，各个工作进程合并后的统计
+
+      **wall_seconds, cpu_seconds**: float
+         整个运行的墙钟时间和主进程的CPU时间
+
+      **extra_dict**: dict
+         可选, 写入报告的其他信息，例如运行参数
+
+   Returns:
+      **report_dict**: dict
+         写入文件的报告
+   '''
+
+   total_profiler = StageProfiler(main_profiler.slowest_int)
+   worker_lst = []
+   for pid, worker_profiler in sorted(worker_profiler_dict.items()):
+      total_profiler.merge(worker_profiler.to_dict())
+      worker_wall = worker_profiler.stage_dict.get('task', [0.0])[0]
+      worker_lst.append({'pid': pid, 'tasks': worker_profiler.task_int, 'loci': worker_profiler.locus_int, 'reads': worker_profiler.read_int,
+                         'loci_per_second': __rate(worker_profiler.locus_int, worker_wall), 'reads_per_second': __rate(worker_profiler.read_int, worker_wall),
+                         'stages': __stages_report(worker_profiler.stage_dict)})
+
+   report_dict = dict(extra_dict) if extra_dict is not None else {}
+   report_dict.update({'wall_seconds': round(wall_seconds, 6), 'cpu_seconds': round(cpu_seconds, 6), 'workers_cpu_seconds': round(total_profiler.stage_dict.get('task', [0.0, 0.0])[1], 6),
+                       'loci': total_profiler.locus_int, 'reads': total_profiler.read_int,
+                       'loci_per_second': __rate(total_profiler.locus_int, wall_seconds), 'reads_per_second': __rate(total_profiler.read_int, wall_seconds),
+                       'stages': __stages_report(main_profiler.stage_dict), 'worker_stages': __stages_report(total_profiler.stage_dict), 'workers': worker_lst,
+                       'slowest_loci': [{'sample': sample_str, 'chrom': chrom, 'pos': pos, 'depth': depth, 'seconds': round(seconds, 6)}
+                                        for seconds, sample_str, chrom, pos, depth in sorted(total_profiler.slowest_lst, reverse = True)]})
+
+   with open(report_file, 'w') as out_f:
+      json.dump(report_dict, out_f, indent = 2)
+      out_f.write('\n')
+
+   return report_dict
@@ -0,0 +1,208 @@
+# 标准位点（real site）的紧凑二进制索引（.realsite.bin文件）
+# 索引文件通过mmap只读打开，打开时只读取header和contig表，查询时二分查找，启动时间和内存占用与标准位点数量无关
+# 多个进程打开同一个文件时共享同一份物理内存，不需要复制或pickle标准位点字典
+import os
+import os.path as path
+import mmap
+import array
+import bisect
+import struct
+import tempfile
+
+# 文件结构（所有整数均为本机字节序）：
+# header:     magic(4s) version(I) contig数(I) allele组合数(I) site数(Q) allele字符串总长度(Q)
+# contig表:   每个contig为 名称长度(H) 名称 起始site序号(Q) site数(Q)，contig ID即为其在表中的序号，整个表补齐至8字节对齐
+# pos:        site数个uint32, 在每个contig内排序
+# allele_id:  site数个uint32, 该site的allele组合在allele表中的序号，补齐至8字节对齐
+# allele表:   allele组合数 + 1 个uint64, 第j个组合的字符串为 allele[offset[j]:offset[j + 1]]
+# allele:     utf-8编码，同一组合的各个allele以'\t'分隔。相同的allele组合（例如['A', 'G']）只保存一次
+MAGIC = b'RSIX'
+VERSION = 2
+HEADER_STRUCT = struct.Struct('=4sIIIQQ')
+SUFFIX = '.realsite.bin'
+TEMP_SUFFIX = '.tmp'  # 写入中的临时文件，见write_real_site_index
+
+
+def __pad8(length: int) -> int:
+   return (8 - length % 8) % 8
+
+
+# 将 {(chrom, pos): [variant_1, variant_2, ....]} 字典写入索引文件
+def write_real_site_index(real_site_dict: dict, index_file: str) -> int:
+   '''
+   将标准位点字典写成二进制索引文件，之后用RealSiteIndex打开
+
+   Parameters:
+      **real_site_dict**: dict
+         {(chrom, pos):[variant_1, variant_2, ....]}，见vcf.get_real_variants_from_vcf
+
+      **index_file**: str
+         输出的索引文件
+
+   Returns:
+      **site_int**: int
+         写入的位点数
+   '''
+
+   chrom_dict = {}  # {chrom: [pos, ...]}
+   for chrom, pos in real_site_dict.keys():
+      chrom_dict.setdefault(chrom, []).append(pos)
+
+   contig_bytes = b''
+   pos_array = array.array('I')
+   allele_id_array = array.array('I')
+   allele_id_dict = {}  # {allele组合字符串: allele组合序号}
+   for chrom, pos_lst in chrom_dict.items():
+      pos_lst.sort()
+      name_bytes = chrom.encode()
+      contig_bytes += struct.pack('=H', len(name_bytes)) + name_bytes + struct.pack('=QQ', len(pos_array), len(pos_lst))
+
+      for pos in pos_lst:
+         allele_str = '\t'.join(real_site_dict[(chrom, pos)])
+         pos_array.append(pos)
+         allele_id_array.append(allele_id_dict.setdefault(allele_str, len(allele_id_dict)))
+
+   offset_array = array.array('Q', [0])
+   allele_lst = []
+   for allele_str in allele_id_dict.keys():  # 字典保持插入顺序，即allele组合序号的顺序
+      allele_bytes = allele_str.encode()
+      allele_lst.append(allele_bytes)
+      offset_array.append(offset_array[-1] + len(allele_bytes))
+
+   # 先写入同一目录中本次写入独有的临时文件，fsync后再改名：中断时不会留下不完整的索引文件，
+   # 多个进程同时写入同一个索引文件时各自写自己的临时文件，改名是原子的，读取者只会看到某一个完整的文件
+   index_file_str = path.realpath(path.expanduser(index_file))
+   site_bytes_int = len(pos_array) * pos_array.itemsize
+   handle, temp_file_str = tempfile.mkstemp(dir = path.dirname(index_file_str), prefix = path.basename(index_file_str) + '.', suffix = TEMP_SUFFIX)
+   try:
+      with os.fdopen(handle, 'wb') as out_f:
+         out_f.write(HEADER_STRUCT.pack(MAGIC, VERSION, len(chrom_dict), len(allele_id_dict), len(pos_array), offset_array[-1]))
+         out_f.write(contig_bytes + b'\0' * __pad8(len(contig_bytes)))
+         out_f.write(pos_array.tobytes() + b'\0' * __pad8(site_bytes_int))
+         out_f.write(allele_id_array.tobytes() + b'\0' * __pad8(site_bytes_int))
+         out_f.write(offset_array.tobytes())
+         out_f.write(b''.join(allele_lst))
+         out_f.flush()
+         os.fsync(out_f.fileno())
+      os.chmod(temp_file_str, 0o644)  # mkstemp创建的文件只有本用户可读，缓存目录可能由多个用户共享
+      os.replace(temp_file_str, index_file_str)
+   except BaseException:
+      try:
+         os.remove(temp_file_str)
+      except FileNotFoundError:
+         pass
+      raise
+
+   return len(pos_array)
+
+
+# 将标准位点字典写入一个临时索引文件，返回文件名。调用者负责在使用完毕后删除该文件
+def make_temporary_index(real_site_dict: dict) -> str:
+
+   handle, index_file = tempfile.mkstemp(suffix = SUFFIX)
+   os.close(handle)
+   write_real_site_index(real_site_dict, index_file)
+
+   return index_file
+
+
+class RealSiteIndex:
+   '''
+   只读打开一个标准位点索引文件（见write_real_site_index），按染色体和位置二分查找
+
+   real_site_index = RealSiteIndex('xxx.vcf.realsite.bin')
+   real_site_index[('chr1', 1314235)]  # ['A', 'T', '-3NNN']，不存在的位点返回[]
+   '''
+
+   def __init__(self, index_file: str):
+
+      index_file_str = path.realpath(path.expanduser(index_file))
+      with open(index_file_str, 'rb') as in_f:
+         try:
+            self.__mmap = mmap.mmap(in_f.fileno(), 0, access = mmap.ACCESS_READ)
+         except ValueError:  # 空文件
+            message = f'RealSiteIndex: {index_file_str} 是空文件，请使用vcf.py重新生成'
+            raise ValueError(message)
+
+      # 不完整的文件（例如写入时被中断）在这里报错，而不是在查询时读到错误的数据
+      try:
+         magic, version, contig_int, allele_set_int, site_int, allele_length_int = HEADER_STRUCT.unpack_from(self.__mmap, 0)
+         if magic != MAGIC or version != VERSION:
+            message = f'RealSiteIndex: {index_file_str} 不是标准位点索引文件或版本不兼容，请使用vcf.py重新生成'
+            self.__mmap.close()
+            raise ValueError(message)
+
+         offset_int = HEADER_STRUCT.size
+         self.__contig_dict = {}  # {chrom: (起始site序号, site数)}
+         for _ in range(contig_int):
+            (name_length_int,) = struct.unpack_from('=H', self.__mmap, offset_int)
+            offset_int += 2
+            chrom = self.__mmap[offset_int:offset_int + name_length_int].decode()
+            offset_int += name_length_int
+            self.__contig_dict[chrom] = struct.unpack_from('=QQ', self.__mmap, offset_int)
+            offset_int += 16
+         offset_int += (8 - offset_int % 8) % 8  # header的长度是8的倍数
+
+         site_bytes_int = site_int * 4 + (8 - site_int * 4 % 8) % 8
+         if offset_int + site_bytes_int * 2 + (allele_set_int + 1) * 8 + allele_length_int != len(self.__mmap):
+            message = f'RealSiteIndex: {index_file_str} 文件大小与header不符（文件不完整），请使用vcf.py重新生成'
+            self.__mmap.close()
+            raise ValueError(message)
+      except (struct.error, UnicodeDecodeError):
+         self.__mmap.close()
+         message = f'RealSiteIndex: {index_file_str} 文件不完整，请使用vcf.py重新生成'
+         raise ValueError(message)
+
+      self.__memory_view = memoryview(self.__mmap)
+      self.__pos_view = self.__memory_view[offset_int:offset_int + site_int * 4].cast('I')
+      offset_int += site_bytes_int
+      self.__allele_id_view = self.__memory_view[offset_int:offset_int + site_int * 4].cast('I')
+      offset_int += site_bytes_int
+      self.__offset_view = self.__memory_view[offset_int:offset_int + (allele_set_int + 1) * 8].cast('Q')
+      offset_int += (allele_set_int + 1) * 8
+      self.__allele_view = self.__memory_view[offset_int:offset_int + allele_length_int]
+      self.__site_int = site_int
+      self.__allele_cache_dict = {}  # {allele组合序号: [allele, ...]}, 解码过的allele组合
+
+   def __len__(self) -> int:
+      return self.__site_int
+
+   def __contains__(self, key: tuple[str, int]) -> bool:
+      return self.__find(*key) is not None
+
+   def __getitem__(self, key: tuple[str, int]) -> list[str, ...]:
+      i = self.__find(*key)
+      if i is None:
+         return []
+
+      j = self.__allele_id_view[i]
+      try:
+         allele_lst = self.__allele_cache_dict[j]
+      except KeyError:
+         allele_str = bytes(self.__allele_view[self.__offset_view[j]:self.__offset_view[j + 1]]).decode()
+         allele_lst = allele_str.split('\t') if allele_str != '' else []
+         self.__allele_cache_dict[j] = allele_lst
+
+      return list(allele_lst)
+
+   # 返回site序号，不存在时返回None
+   def __find(self, chrom: str, pos: int):
+      try:
+         start_int, site_int = self.__contig_dict[chrom]
+      except KeyError:
+         return None
+
+      i = bisect.bisect_left(self.__pos_view, pos, start_int, start_int + site_int)
+      if i < start_int + site_int and self.__pos_view[i] == pos:
+         return i
+
+      return None
+
+   def close(self) -> None:
+      self.__pos_view.release()
+      self.__allele_id_view.release()
+      self.__offset_view.release()
+      self.__allele_view.release()
+      self.__memory_view.release()
+      self.__mmap.close()
+      return None
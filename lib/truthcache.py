@@ -0,0 +1,198 @@
+# 标准位点的编译缓存：vcf（或realsite）文件编译得到的二进制索引（见realsite.py）保存在缓存目录中，之后的运行直接使用
+# 缓存键为输入文件、解析参数（pass_only, qual）和索引格式版本的sha1，输入文件或参数改变时键随之改变，一定重新编译
+# 输入文件有两种标识方式（key_mode）：
+# stat      路径、大小和修改时间（默认，不需要读取文件）
+# content   文件内容的sha1，文件移动、复制或者touch后仍然命中，但每次运行都要读一遍文件
+#
+# 缓存目录中每个缓存为两个文件：<键>.realsite.bin 索引文件，<键>.json 输入文件和参数（只用于查看）
+# 写入时先写本次写入独有的临时文件，fsync后再改名，多个运行同时编译同一个键是安全的
+# 命中时更新索引文件的修改时间；写入新的缓存后，总大小超过上限时按修改时间从旧到新删除，直到不超过上限
+import os
+import os.path as path
+import json
+import time
+import hashlib
+import tempfile
+
+try:
+   from . import realsite
+except ImportError:
+   import realsite
+
+DEFAULT_CACHE_DIR = os.environ.get('GET_POSITION_INFO_CACHE', path.join(path.expanduser('~'), '.cache', 'get_position_info', 'realsite'))
+DEFAULT_MAX_SIZE = 10 * 1024 ** 3
+KEY_MODES = ('stat', 'content')
+SIZE_UNIT_DICT = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+STALE_TEMP_SECONDS = 24 * 3600
+
+
+# '500M', '10G', '1048576' -> 字节数。0表示不限制大小
+def parse_size(size_str: str) -> int:
+   size_str = str(size_str).strip().upper().rstrip('B')
+   try:
+      if size_str != '' and size_str[-1] in SIZE_UNIT_DICT:
+         return int(float(size_str[:-1]) * SIZE_UNIT_DICT[size_str[-1]])
+      return int(size_str)
+   except ValueError:
+      message = f'parse_size: 无法解析大小 {size_str}，例如 500M, 10G'
+      raise ValueError(message)
+
+
+def __file_identity(file_str: str, key_mode: str) -> dict:
+   if key_mode == 'content':
+      sha1 = hashlib.sha1()
+      with open(file_str, 'rb') as in_f:
+         for block in iter(lambda: in_f.read(HASH_BLOCK_SIZE), b''):
+            sha1.update(block)
+      return {'sha1': sha1.hexdigest()}
+
+   stat = os.stat(file_str)
+   return {'path': file_str, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def cache_key(input_file: str, param_dict: dict, key_mode: str = 'stat') -> tuple[str, dict]:
+   '''
+   计算输入文件和解析参数的缓存键
+
+   Parameters:
+      **input_file**: str
+         vcf文件或者realsite文件
+
+      **param_dict**: dict
+         解析参数，例如{'pass_only': True, 'qual': 0}
+
+      **key_mode**: str
+         'stat'或者'content'
+
+   Returns:
+      **key_str**: str
+         缓存键
+
+      **key_dict**: dict
+         参与计算缓存键的全部信息，写入<键>.json
+
+   Raises:
+      ValueError: key_mode不是KEY_MODES之一
+   '''
+
+   if key_mode not in KEY_MODES:
+      message = f'cache_key: 不支持的缓存键方式 {key_mode}，可选 {", ".join(KEY_MODES)}'
+      raise ValueError(message)
+
+   file_str = path.realpath(path.expanduser(input_file))
+   key_dict = {'input': __file_identity(file_str, key_mode), 'params': param_dict, 'index_version': realsite.VERSION}
+   key_str = hashlib.sha1(json.dumps(key_dict, sort_keys = True).encode()).hexdigest()
+   key_dict['source'] = file_str
+   return key_str, key_dict
+
+
+def index_file_for(cache_dir: str, key_str: str) -> str:
+   return path.join(cache_dir, key_str + realsite.SUFFIX)
+
+
+# 缓存中存在时更新修改时间（用于按最近使用删除）并返回索引文件，否则返回None
+def lookup(cache_dir: str, key_str: str):
+   index_file = index_file_for(cache_dir, key_str)
+   try:
+      os.utime(index_file)
+   except FileNotFoundError:
+      return None
+   except OSError:  # 缓存目录只读时仍然可以使用
+      pass
+
+   return index_file
+
+
+def store(cache_dir: str, key_str: str, key_dict: dict, real_site_dict: dict) -> str:
+   '''
+   将标准位点字典写入缓存，返回索引文件。
+   索引和.json都先写入本次写入独有的临时文件再改名（见realsite.write_real_site_index），多个进程同时编译同一个键时，
+   先完成的写入缓存，之后完成的发现缓存已经存在时直接使用（与命中缓存相同），读取者不会看到不完整的文件
+
+   Raises:
+      OSError: 缓存目录不能创建或者不可写
+   '''
+
+   os.makedirs(cache_dir, exist_ok = True)
+   index_file = lookup(cache_dir, key_str)
+   if index_file is not None:
+      return index_file
+
+   index_file = index_file_for(cache_dir, key_str)
+   site_int = realsite.write_real_site_index(real_site_dict, index_file)
+
+   key_dict = dict(key_dict, sites = site_int, created = time.strftime('%Y-%m-%dT%H:%M:%S%z'))
+   handle, temp_file = tempfile.mkstemp(dir = cache_dir, prefix = key_str + '.json.', suffix = realsite.TEMP_SUFFIX)
+   try:
+      with os.fdopen(handle, 'w') as out_f:
+         json.dump(key_dict, out_f, indent = 2)
+      os.chmod(temp_file, 0o644)
+      os.replace(temp_file, path.join(cache_dir, key_str + '.json'))
+   except BaseException:
+      try:
+         os.remove(temp_file)
+      except FileNotFoundError:
+         pass
+      raise
+
+   return index_file
+
+
+def evict(cache_dir: str, max_size: int, keep_key: str = '') -> list[str, ...]:
+   '''
+   缓存目录中索引文件的总大小超过max_size时，按修改时间从旧到新删除索引文件（和对应的.json），keep_key不删除。
+   同时删除被中断的写入留下的临时文件
+
+   Parameters:
+      **cache_dir**: str
+         缓存目录
+
+      **max_size**: int
+         总大小的上限（字节），0表示不限制
+
+      **keep_key**: str
+         不删除的缓存键，通常是刚刚写入的缓存
+
+   Returns:
+      **removed_lst**: list[str, ...]
+         删除的索引文件
+   '''
+
+   entry_lst = []  # [(修改时间, 大小, 缓存键), ...]
+   for name in os.listdir(cache_dir):
+      # 被中断的写入留下的临时文件，超过STALE_TEMP_SECONDS时删除（正在写入的临时文件不会这么旧）
+      if name.endswith(realsite.TEMP_SUFFIX):
+         try:
+            if time.time() - os.stat(path.join(cache_dir, name)).st_mtime > STALE_TEMP_SECONDS:
+               os.remove(path.join(cache_dir, name))
+         except FileNotFoundError:
+            pass
+         continue
+
+      if max_size <= 0 or not name.endswith(realsite.SUFFIX):
+         continue
+      try:
+         stat = os.stat(path.join(cache_dir, name))
+      except FileNotFoundError:  # 其他进程同时删除
+         continue
+      entry_lst.append((stat.st_mtime, stat.st_size, name[:-len(realsite.SUFFIX)]))
+
+   total_int = sum([x[1] for x in entry_lst])
+   removed_lst = []
+   for _, size_int, key_str in sorted(entry_lst):
+      if total_int <= max_size:
+         break
+      if key_str == keep_key:
+         continue
+
+      index_file = index_file_for(cache_dir, key_str)
+      for file_str in [index_file, path.join(cache_dir, key_str + '.json')]:
+         try:
+            os.remove(file_str)
+         except FileNotFoundError:
+            pass
+      total_int -= size_int
+      removed_lst.append(index_file)
+
+   return removed_lst
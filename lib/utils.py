@@ -5,11 +5,19 @@ import os.path as path
 import gzip
 import pysam
 import math
+import mmap
+import heapq
+import contextlib
+import collections
 from collections.abc import Iterator
+from dataclasses import dataclass, field
 
 
 BASES = ['A', 'T', 'C', 'G']
 
+# BED记录的end小于start时作为格式错误的行跳过，--keep-locus-order（__parse_bed）和标准化（scan_locus_file）使用同一规则
+BED_REVERSED_MESSAGE = 'end小于start'
+
 # 所有的__parse_*函数都接受一个文件，并且返回一个包含染色体，位置和本行其他信息的Iterator
 def __parse_vcf(vcf_file: str, pass_only: bool = True, qual = 0) -> Iterator[str, int, str]:
    '''
@@ -33,7 +41,7 @@ def __parse_vcf(vcf_file: str, pass_only: bool = True, qual = 0) -> Iterator[str
             chrom = line_lst[0]
             pos = int(line_lst[1])
 
-            qual_int = int(line_lst[5])
+            qual_int = float(line_lst[5])
             filter_str = line_lst[6]
 
             if pass_only and filter_str != 'PASS':
@@ -71,6 +79,8 @@ def __parse_bed(bed_file: str) -> Iterator[str, int, str]:
             chrom = line_lst[0]
             start = int(line_lst[1])
             end = int(line_lst[2])
+            if end < start:
+               raise ValueError(BED_REVERSED_MESSAGE)
 
             other = '\t'.join(line_lst[3:])
          except Exception as ex:
@@ -78,7 +88,7 @@ def __parse_bed(bed_file: str) -> Iterator[str, int, str]:
             print(message)
             continue
 
-         for pos in range(start, end + 1, 1 if end + 1 > start else -1):
+         for pos in range(start, end + 1):
             yield chrom, pos, other
 
    return None
@@ -141,6 +151,126 @@ def parse_locus(locus_file: str, file_format: str) -> Iterator[str, int, str]:
    message = f'parse_locus: 文件格式错误{file_format}，文件格式必须为POS，BED，VCF之一'
    sys.exit(message)
 
+# 统计位置文件中的位点数，与parse_locus产生的位点数相同，但不生成位点，格式错误的行不打印信息，用于显示进度的总数
+# locus_int = count_loci(locus_file, 'BED')
+def count_loci(locus_file: str, file_format: str) -> int:
+   '''
+   统计位置文件中的位点数：POS格式为有效的行数，BED格式为每个区间的位点数之和，VCF格式为PASS的记录数（见__parse_vcf）
+
+   Parameter:
+      **locus_file**: str
+         位置文件
+
+      **file_format**: str
+         位置文件的格式, 'POS'，'BED'，'VCF'
+
+   Return:
+      **locus_int**: int
+         位点数
+   '''
+
+   locus_file_str = path.realpath(path.expanduser(locus_file))
+   locus_int = 0
+   with open(locus_file_str, 'rb') if not locus_file_str.endswith('.gz') else gzip.open(locus_file_str) as in_f:
+      for line in in_f:
+         if line.startswith(b'#') or line.strip() == b'':
+            continue
+
+         line_lst = line.split()
+         try:
+            if file_format == 'BED':
+               start = int(line_lst[1])
+               end = int(line_lst[2])
+               if end >= start:
+                  locus_int += end - start + 1
+            elif file_format == 'VCF':
+               int(line_lst[1])
+               float(line_lst[5])
+               if line_lst[6] == b'PASS':
+                  locus_int += 1
+            else:
+               int(line_lst[1])
+               locus_int += 1
+         except (IndexError, ValueError):
+            continue
+
+   return locus_int
+
+BAM_SUFFIXES = ('.bam', '.cram', '.sam')
+
+# 解析命令行中的比对文件，返回样本名和比对文件
+# sample_lst = parse_bam_list(['a.bam', 'b.bam']) 或者 parse_bam_list(['bam.list'])
+def parse_bam_list(bam_lst: list[str, ...]) -> list[tuple[str, str], ...]:
+   '''
+   后缀为.bam, .cram, .sam的参数直接作为比对文件，样本名为去掉后缀的文件名；
+   其他参数作为比对文件列表，每行为 比对文件[\t样本名]，空行和以#开头的行被忽略，相对路径相对于列表文件所在的目录
+
+   Parameters:
+      **bam_lst**: list[str, ...]
+         比对文件或比对文件列表
+
+   Returns:
+      **sample_lst**: list[tuple[str, str], ...]
+         样本名, 比对文件。按输入的顺序
+
+   Raises:
+      ValueError: 没有比对文件，或者样本名重复
+   '''
+
+   sample_lst = []
+   for bam_str in bam_lst:
+      if bam_str.endswith(BAM_SUFFIXES):
+         sample_lst.append((path.splitext(path.split(bam_str)[-1])[0], bam_str))
+         continue
+
+      list_dir_str = path.dirname(path.realpath(path.expanduser(bam_str)))
+      with open(path.expanduser(bam_str)) as in_f:
+         for line_str in in_f:
+            line_lst = line_str.strip().split('\t')
+            if line_lst[0] == '' or line_lst[0].startswith('#'):
+               continue
+
+            file_str = path.join(list_dir_str, path.expanduser(line_lst[0].strip()))
+            sample_str = line_lst[1].strip() if len(line_lst) > 1 and line_lst[1].strip() != '' else path.splitext(path.split(file_str)[-1])[0]
+            sample_lst.append((sample_str, file_str))
+
+   if sample_lst == []:
+      message = f'parse_bam_list: {bam_lst} 中没有比对文件'
+      raise ValueError(message)
+
+   counter = collections.Counter([sample_str for sample_str, _ in sample_lst])
+   duplicate_lst = [sample_str for sample_str, count in counter.items() if count > 1]
+   if duplicate_lst != []:
+      message = f'parse_bam_list: 样本名重复 {", ".join(duplicate_lst)}，请在比对文件列表的第二列指定不同的样本名'
+      raise ValueError(message)
+
+   return sample_lst
+
+# 打开比对文件。CRAM文件使用reference_file解码，reference_file为''时htslib根据header中的UR/M5和REF_PATH, REF_CACHE环境变量查找参考基因组
+# bam_af = open_alignment('sample.cram', 'ref.fa', threads = 2)
+def open_alignment(bam_file: str, reference_file: str = '', threads: int = 0) -> pysam.AlignmentFile:
+   '''
+   Parameters:
+      **bam_file**: str
+         比对文件，BAM, CRAM或者SAM
+
+      **reference_file**: str
+         faidx indexed参考基因组文件，只用于CRAM
+
+      **threads**: int
+         该文件句柄的htslib解压线程数，小于2时在当前线程中解压
+
+   Returns:
+      **bam_af**: pysam.AlignmentFile
+   '''
+
+   bam_file_str = path.realpath(path.expanduser(bam_file))
+   kwargs_dict = {'threads': max(threads, 1)}
+   if bam_file_str.endswith('.cram') and reference_file != '':
+      kwargs_dict['reference_filename'] = path.realpath(path.expanduser(reference_file))
+
+   return pysam.AlignmentFile(bam_file_str, **kwargs_dict)
+
 # 根据segment的flag （f1， f2, r1, r2）返回0,1,2,3. 或者返回None（任何错误或者无法判断）
 def get_index(segment: pysam.AlignedSegment):
 
@@ -168,26 +298,69 @@ def get_index(segment: pysam.AlignedSegment):
    return None
 
 
-# 提取基因组特定序列
-# genome_reference_file_handle, index_dict = read_reference('/share/home/yaotianran/data/ecoli_genome/ecoli_total_2982.fasta')
-# seq = get_base_fast(genome_reference_file_handle, index_dict, '1', 60000, 65000)
-def read_reference(reference: str) -> tuple:
+# SAM flag的名称，与samtools view -f/-F相同
+FLAG_DICT = {'PAIRED': 0x1, 'PROPER_PAIR': 0x2, 'UNMAP': 0x4, 'MUNMAP': 0x8, 'REVERSE': 0x10, 'MREVERSE': 0x20, 'READ1': 0x40, 'READ2': 0x80,
+             'SECONDARY': 0x100, 'QCFAIL': 0x200, 'DUP': 0x400, 'SUPPLEMENTARY': 0x800}
+
+# 解析flag字符串，可以是十进制整数，0x开头的十六进制整数，或者以,分割的flag名称
+# parse_flags('UNMAP,SECONDARY,QCFAIL,DUP') == parse_flags('0x704') == 1796
+def parse_flags(flag_str: str) -> int:
    '''
-   This function is the helper of function get_base_fast. Input a genome fasta reference, return a handle and and index dictionary
+   Parameters:
+      **flag_str**: str
+         例如'1796', '0x704', 'UNMAP,SECONDARY,QCFAIL,DUP'
 
-       Parameter:
-       **reference**:
-           a genome reference fasta file
+   Returns:
+      **flag_int**: int
 
-   Return:
-       genome_reference_file_handle: File IO
-       index_dict: Dictionary
+   Raises:
+      ValueError: 无法解析的flag
+   '''
+
+   flag_str = flag_str.strip()
+   if flag_str == '':
+      return 0
+
+   try:
+      return int(flag_str, 0)
+   except ValueError:
+      pass
+
+   flag_int = 0
+   for name_str in flag_str.split(','):
+      try:
+         flag_int |= FLAG_DICT[name_str.strip().upper()]
+      except KeyError:
+         message = f'parse_flags: 无法解析的flag {name_str}，可以是整数或者{", ".join(FLAG_DICT.keys())}'
+         raise ValueError(message)
 
+   return flag_int
+
+
+# 检查参考基因组和faidx索引（<ref.fasta>.fai）可读，读取索引
+# refer_str, index_dict = read_fasta_index('/share/data/reference/human/b37/Homo_sapiens_assembly19.fasta')
+def read_fasta_index(reference: str, is_quiet: bool = True) -> tuple[str, dict]:
+   '''
+   Parameters:
+      **reference**: str
+         参考基因组fasta文件
+
+      **is_quiet**: bool
+         为False时打印索引中格式错误的行和读取的染色体数
+
+   Returns:
+      **refer_str**: str
+         参考基因组的绝对路径
+
+      **index_dict**: dict
+         {chrom: [长度, 偏移, 每行碱基数, 每行字节数]}
+
+   Raises:
+      FileNotFoundError: 参考基因组或者索引文件不存在或不可读
    '''
-   import os.path as path
 
    refer_str = path.realpath(path.expanduser(reference))
-   indexfile = reference + '.fai'
+   indexfile = path.expanduser(reference) + '.fai'
 
    if not os.access(refer_str, os.R_OK):
       message = 'Reference file {} not found or not readable'.format(refer_str)
@@ -197,19 +370,42 @@ def read_reference(reference: str) -> tuple:
       message = 'Index file {} not found or not readable'.format(indexfile)
       raise FileNotFoundError(message)
 
-   hanel = open(refer_str, 'rt')
-
    index_dict = {}
    with open(file = indexfile, mode = 'rt') as index_f:
       for i, line in enumerate(index_f):
          line_lst = line.strip().split()
          try:
-            index_dict[line_lst[0]] = list(map(int, line_lst[1:]))
+            index_dict[line_lst[0]] = list(map(int, line_lst[1:5]))
          except Exception:
-            message = 'File {0} is corrupted at line {1}. Position query may raise an IndexError.'.format(indexfile, i + 1)
-            print(message)
+            if not is_quiet:
+               message = 'File {0} is corrupted at line {1}. Position query may raise an IndexError.'.format(indexfile, i + 1)
+               print(message)
             continue
-   print('Read', len(index_dict), 'chromosomes')
+   if not is_quiet:
+      print('Read', len(index_dict), 'chromosomes')
+
+   return refer_str, index_dict
+
+
+# 提取基因组特定序列
+# genome_reference_file_handle, index_dict = read_reference('/share/home/yaotianran/data/ecoli_genome/ecoli_total_2982.fasta')
+# seq = get_base_fast(genome_reference_file_handle, index_dict, '1', 60000, 65000)
+def read_reference(reference: str) -> tuple:
+   '''
+   This function is the helper of function get_base_fast. Input a genome fasta reference, return a handle and and index dictionary
+
+       Parameter:
+       **reference**:
+           a genome reference fasta file
+
+   Return:
+       genome_reference_file_handle: File IO
+       index_dict: Dictionary
+
+   '''
+
+   refer_str, index_dict = read_fasta_index(reference, is_quiet = False)
+   hanel = open(refer_str, 'rt')
 
    return hanel, index_dict
 
@@ -274,7 +470,488 @@ def get_base_fast(genome_reference_file_handle, index_dict, chrom, start, end=0)
    return(seq_str.upper())
 
 
-# 将数组分成N等份
-def slice_list(in_list: list, chunk_num: int):
-   return [in_list[x::chunk_num] for x in range(chunk_num)]
+# 用mmap只读打开faidx索引的参考基因组，按窗口一次切片获取多个位点的碱基和上下游序列，查询时不需要seek和read系统调用
+# 多个进程打开同一个文件时共享同一份page cache
+# reference_genome = ReferenceGenome('/share/data/reference/human/b37/Homo_sapiens_assembly19.fasta')
+# reference_genome.fetch('1', 60000, 65000)
+# reference_genome.fetch_loci('1', [60000, 60003, 60100], flank = 5)  # [('A', 'CCTAGATTTAC'), ...]
+class ReferenceGenome:
+   '''
+   mmap打开的faidx索引参考基因组（samtools faidx <ref.fasta>）
+
+   结果与get_base_fast相同（大写，1-based，包含end），但超出染色体两端的部分会被截去，而不会读到相邻染色体的序列
+   '''
+
+   def __init__(self, reference: str, is_quiet: bool = True):
+
+      # 每个工作进程都会打开一次，所以默认不打印，见read_fasta_index
+      refer_str, self.__index_dict = read_fasta_index(reference, is_quiet)  # {chrom: [长度, 偏移, 每行碱基数, 每行字节数]}
+      with open(refer_str, 'rb') as in_f:
+         self.__mmap = mmap.mmap(in_f.fileno(), 0, access = mmap.ACCESS_READ)
+
+   def __contains__(self, chrom: str) -> bool:
+      return chrom in self.__index_dict
+
+   def length(self, chrom: str) -> int:
+      return self.__index_dict[chrom][0]
+
+   def fetch(self, chrom: str, start: int, end: int = 0) -> str:
+      '''
+      获取start至end（1-based，包含end）的序列，end为0时只获取start位置的碱基。超出染色体两端的部分被截去。染色体不存在时抛出KeyError
+      '''
+
+      length_int, offset_int, line_bases_int, line_width_int = self.__index_dict[chrom]
+      if end == 0:
+         end = start
+      start = max(start, 1)
+      end = min(end, length_int)
+      if start > end:
+         return ''
+
+      # 0-based位置i在文件中的偏移为 offset + i // 每行碱基数 * 每行字节数 + i % 每行碱基数
+      start_offset_int = offset_int + (start - 1) // line_bases_int * line_width_int + (start - 1) % line_bases_int
+      end_offset_int = offset_int + (end - 1) // line_bases_int * line_width_int + (end - 1) % line_bases_int
+      return self.__mmap[start_offset_int:end_offset_int + 1].translate(None, b'\r\n').decode().upper()
+
+   def fetch_loci(self, chrom: str, pos_lst: list[int, ...], flank: int = 5, need_base: bool = True, need_context: bool = True) -> list[tuple[str, str]]:
+      '''
+      获取同一染色体上多个位点的碱基和上下游序列，整个窗口只读取一次
+
+      Parameters:
+         **chrom**: str
+            染色体，不存在时抛出KeyError
+
+         **pos_lst**: list[int, ...]
+            位置（1-based），不需要排序
+
+         **flank**: int
+            上下游各取flank个碱基，与get_base_fast(chrom, pos - flank, end = pos + flank)相同
+
+         **need_base, need_context**: bool
+            不需要的结果为''
+
+      Returns:
+         **result_lst**: list[tuple[str, str]]
+            与pos_lst一一对应的(碱基, 上下游序列)
+      '''
+
+      if pos_lst == [] or not (need_base or need_context):
+         return [('', '')] * len(pos_lst)
+
+      length_int = self.__index_dict[chrom][0]
+      flank = max(flank, 0) if need_context else 0
+      window_start_int = max(min(pos_lst) - flank, 1)
+      window_str = self.fetch(chrom, window_start_int, max(pos_lst) + flank)
+
+      result_lst = []
+      for pos in pos_lst:
+         base_str = window_str[pos - window_start_int] if need_base and 1 <= pos <= length_int else ''
+         if need_context:
+            context_start_int = max(pos - flank, 1)
+            context_str = window_str[context_start_int - window_start_int:min(pos + flank, length_int) - window_start_int + 1]
+         else:
+            context_str = ''
+         result_lst.append((base_str, context_str))
+
+      return result_lst
+
+   def close(self) -> None:
+      self.__mmap.close()
+      return None
+
+
+
+# 将已经排序的位点按照染色体和相邻距离合并成窗口，每个窗口只需要做一次pileup
+# for chrom, window_lst in group_loci_windows(loci_lst, max_gap = 500):
+def group_loci_windows(loci_lst: list, max_gap: int = 500) -> Iterator[tuple[str, list]]:
+   '''
+   将已经按染色体和位置排序的位点合并成窗口，同一染色体上相邻位点的距离不超过max_gap时属于同一个窗口
+
+   Parameters:
+      **loci_lst**: list[tuple[str, int, str], ...]
+         chrom, pos, other, 必须已按染色体和位置排序
+
+      **max_gap**: int
+         相邻两个位点的最大距离
+
+   Returns:
+      **window_iter**: Iterator[tuple[str, list[tuple[str, int, str], ...]]]
+         染色体名称和该窗口内的位点
+   '''
+
+   window_lst = []
+   for locus in loci_lst:
+      if window_lst != [] and (locus[0] != window_lst[-1][0] or not 0 <= locus[1] - window_lst[-1][1] <= max_gap):
+         yield window_lst[0][0], window_lst
+         window_lst = []
+
+      window_lst.append(locus)
+
+   if window_lst != []:
+      yield window_lst[0][0], window_lst
+
+   return None
+
+# 将位点流按顺序分割成连续的基因组区块，用于多进程的任务队列。每次只保存一个区块，不需要把全部位点读入内存
+# for chunk_lst in chunk_loci(utils.parse_locus(locus_file, 'BED'), chunk_size = 2000):
+def chunk_loci(locus_iter: Iterator[tuple[str, int, str]], chunk_size: int) -> Iterator[list]:
+   '''
+   将位点流按输入顺序分割成区块。区块尽量在窗口（见group_loci_windows）的边界处分割，
+   超过chunk_size的单个窗口（例如很长的BED区间）会被切开。输入已按染色体和位置排序时，每个区块都是一段连续的基因组区域
+
+   Parameters:
+      **locus_iter**: Iterator[tuple[str, int, str]]
+         chrom, pos, other
+
+      **chunk_size**: int
+         每个区块的最大位点数
+
+   Returns:
+      **chunk_iter**: Iterator[list[tuple[str, int, str], ...]]
+         区块
+   '''
+
+   chunk_size = max(chunk_size, 1)
+
+   current_lst = []
+   for _, window_lst in group_loci_windows(locus_iter):
+      if current_lst != [] and len(current_lst) + len(window_lst) > chunk_size:
+         yield current_lst
+         current_lst = []
+
+      while len(window_lst) > chunk_size:
+         yield window_lst[:chunk_size]
+         window_lst = window_lst[chunk_size:]
+
+      current_lst.extend(window_lst)
+
+   if current_lst != []:
+      yield current_lst
+
+   return None
+
+# 位点的密度：平均每个窗口（见group_loci_windows）的位点数。稀疏的位点（例如VCF中的变异位点）约为1，长BED区间展开的位点接近区块大小
+def loci_per_window(loci_lst: list) -> float:
+   if loci_lst == []:
+      return 0.0
+
+   window_int = sum([1 for _ in group_loci_windows(sorted(loci_lst, key = lambda x: (x[0], x[1])))])
+   return len(loci_lst) / window_int
+
+# 超过DENSE_LOCI_PER_WINDOW时认为位点是密集的
+DENSE_LOCI_PER_WINDOW = 32
+
+# 将CPU分配为 进程数 × 每个进程的线程数（1 + htslib解压线程数）
+# process_int, io_thread_int = split_threads(8, loci_per_window(chunk_lst), is_cram = True, task_int = 3)
+def split_threads(thread_int: int, loci_density: float, is_cram: bool = False, task_int: int = 0) -> tuple[int, int]:
+   '''
+   工作进程的大部分时间在Python中统计reads（--profile中的read_loop），htslib解码（pileup）只占很小一部分，
+   所以每个CPU一个进程，不为解压线程减少进程数。只有任务数少于CPU数时，多出的CPU没有任务可做，才作为解压线程分给各个进程：
+   位点稀疏时每次pileup只解压少数几个BGZF块，解压线程没有作用；位点密集或者输入为CRAM时才使用
+
+   Parameters:
+      **thread_int**: int
+         可以使用的CPU数
+
+      **loci_density**: float
+         位点密度，见loci_per_window
+
+      **is_cram**: bool
+         比对文件中是否有CRAM
+
+      **task_int**: int
+         任务数（区块数 × 样本数）的下限，0表示未知（按任务足够多处理）
+
+   Returns:
+      **process_int**: int
+         进程数
+
+      **io_thread_int**: int
+         每个文件句柄的htslib解压线程数，0表示不使用解压线程
+   '''
+
+   thread_int = max(thread_int, 1)
+   process_int = min(thread_int, task_int) if task_int > 0 else thread_int
+   if loci_density < DENSE_LOCI_PER_WINDOW and not is_cram:
+      return process_int, 0
+
+   # 解压线程数小于2时htslib不会创建线程池
+   io_thread_int = (thread_int - process_int) // process_int
+   if io_thread_int < 2:
+      io_thread_int = 0
+
+   return process_int, io_thread_int
+
+# 将区间按染色体排序并合并重叠或相邻的区间
+# region_dict = merge_regions((chrom, pos, pos) for chrom, pos, _ in loci_lst)
+def merge_regions(region_iter: Iterator[tuple[str, int, int]]) -> dict[str, list[tuple[int, int], ...]]:
+   '''
+   Parameters:
+      **region_iter**: Iterator[tuple[str, int, int]]
+         chrom, start, end, 1-based闭区间
+
+   Returns:
+      **region_dict**: dict
+         {chrom: [(start, end), ...]}，每个染色体的区间已排序且互不重叠
+   '''
+
+   raw_dict = {}
+   for chrom, start, end in region_iter:
+      start, end = min(start, end), max(start, end)
+      region_lst = raw_dict.setdefault(chrom, [])
+
+      # 输入已排序时（例如由BED展开的位置）直接与上一个区间合并，内存只与合并后的区间数有关
+      if region_lst != [] and region_lst[-1][0] <= start <= region_lst[-1][1] + 1:
+         region_lst[-1] = (region_lst[-1][0], max(end, region_lst[-1][1]))
+      else:
+         region_lst.append((start, end))
+
+   region_dict = {}
+   for chrom, region_lst in raw_dict.items():
+      region_lst.sort()
+      merged_lst = [region_lst[0]]
+      for start, end in region_lst[1:]:
+         if start <= merged_lst[-1][1] + 1:
+            merged_lst[-1] = (merged_lst[-1][0], max(end, merged_lst[-1][1]))
+         else:
+            merged_lst.append((start, end))
+      region_dict[chrom] = merged_lst
+
+   return region_dict
+
+
+# = = = = = = = = = = = = = = = = = = 位点的标准化 = = = = = = = = = = = = = = = = = =
+# 按比对文件header中染色体的顺序和位置排序，合并重叠的区间，去掉重复的位点，跳过header中没有的染色体
+# 先预扫描一遍位置文件（scan_locus_file），记录每个染色体中按位置排序的连续记录段（run）在文件中的偏移量，
+# 之后按header的顺序逐个染色体从文件中读取它的记录段：只有一段时直接流式处理，有多段时归并（heapq.merge），
+# 记录段超过MAX_MERGE_RUNS时（位置文件基本没有排序）才把该染色体的记录读入内存排序
+MAX_MERGE_RUNS = 64
+
+# 位置文件中的一行 -> (chrom, start, end, other)。规则与__parse_vcf（PASS，QUAL >= 0），__parse_pos，__parse_bed相同
+# 空行、注释行和被过滤的VCF记录返回None，格式错误时抛出异常
+def __parse_locus_line(line_str: str, file_format: str):
+   if line_str.strip() == '' or line_str.startswith('#'):
+      return None
+
+   line_lst = line_str.split()
+   chrom = line_lst[0]
+   if file_format == 'BED':
+      start = int(line_lst[1])
+      end = int(line_lst[2])
+      if end < start:
+         raise ValueError(BED_REVERSED_MESSAGE)
+      return chrom, start, end, '\t'.join(line_lst[3:])
+
+   pos = int(line_lst[1])
+   if file_format == 'VCF':
+      qual = float(line_lst[5])
+      if line_lst[6] != 'PASS' or qual < 0:
+         return None
+   elif file_format != 'POS':
+      message = f'文件格式错误{file_format}，文件格式必须为POS，BED，VCF之一'
+      raise ValueError(message)
+
+   return chrom, pos, pos, '\t'.join(line_lst[2:])
+
+def __open_locus_file(locus_file: str):
+   locus_file_str = path.realpath(path.expanduser(locus_file))
+   return gzip.open(locus_file_str) if locus_file_str.endswith('.gz') else open(locus_file_str, 'rb')
+
+# 从in_f的当前位置读取记录，直到偏移量end_offset（None为文件末尾）。返回 (行的偏移量, 下一行的偏移量, (chrom, start, end, other))
+def __read_locus_records(in_f, file_format: str, end_offset: int = None, is_quiet: bool = True) -> Iterator[tuple[int, int, tuple]]:
+   offset = in_f.tell()
+   while end_offset is None or offset < end_offset:
+      line = in_f.readline()
+      if line == b'':
+         break
+
+      line_offset, offset = offset, offset + len(line)
+      try:
+         record = __parse_locus_line(line.decode(), file_format)
+      except (IndexError, ValueError) as ex:
+         if not is_quiet:
+            message = f'__parse_{file_format.lower()}: {ex} {line.split()} 格式错误。 跳过'
+            print(message)
+         continue
+
+      if record is not None:
+         yield line_offset, offset, record
+
+   return None
+
+@dataclass
+class LocusScan:
+   '''
+   位置文件的预扫描结果，见scan_locus_file
+
+   run_dict:      {chrom: [[起始偏移量, 结束偏移量, 第一个记录的序号], ...]}，每一段为同一个染色体中按start排序的连续记录（中间可以有header中没有的染色体的记录）
+   locus_dict:    {chrom: 位点数}，header中有的染色体，BED为区间长度之和，重复的位点重复计数
+   unknown_dict:  {chrom: 位点数}，header中没有的染色体
+   region_dict:   {chrom: [(start, end), ...]}，合并后的区间（见merge_regions），scan_locus_file的is_region为False时为None
+   '''
+
+   run_dict: dict = field(default_factory = dict)
+   locus_dict: dict = field(default_factory = dict)
+   unknown_dict: dict = field(default_factory = dict)
+   region_dict: dict = None
+
+# 位置文件的预扫描，供normalize_loci使用。格式错误的行在这里打印，normalize_loci不再打印
+# locus_scan = scan_locus_file(locus_file, 'BED', bam_af.references)
+def scan_locus_file(locus_file: str, file_format: str, contig_lst: list[str, ...], is_region: bool = False) -> LocusScan:
+   '''
+   Parameters:
+      **locus_file**: str
+         位置文件, 可以是POS格式，BED格式，或VCF格式（可以是.gz）
+
+      **file_format**: str
+         位置文件的格式, 'POS'，'BED'，'VCF'
+
+      **contig_lst**: list[str, ...]
+         比对文件header中的染色体
+
+      **is_region**: bool
+         同时合并位点所在的区间（用于--truth-by-locus），不需要再读一遍位置文件
+
+   Returns:
+      **locus_scan**: LocusScan
+   '''
+
+   contig_set = set(contig_lst)
+   locus_scan = LocusScan()
+   locus_dict = collections.Counter()
+   unknown_dict = collections.Counter()
+   raw_region_dict = {}
+   last_chrom, last_start = None, 0
+   with __open_locus_file(locus_file) as in_f:
+      for i, (line_offset, next_offset, (chrom, start, end, _)) in enumerate(__read_locus_records(in_f, file_format, is_quiet = False)):
+         if chrom not in contig_set:
+            unknown_dict[chrom] += end - start + 1
+            continue
+
+         locus_dict[chrom] += end - start + 1
+         if chrom == last_chrom and start >= last_start:
+            run[1] = next_offset
+         else:
+            run = [line_offset, next_offset, i]
+            locus_scan.run_dict.setdefault(chrom, []).append(run)
+         last_chrom, last_start = chrom, start
+
+         if is_region:  # 与上一个区间重叠或相邻时直接合并，输入已排序时内存只与合并后的区间数有关
+            region_lst = raw_region_dict.setdefault(chrom, [])
+            if region_lst != [] and region_lst[-1][0] <= start <= region_lst[-1][1] + 1:
+               region_lst[-1] = (region_lst[-1][0], max(end, region_lst[-1][1]))
+            else:
+               region_lst.append((start, end))
+
+   locus_scan.locus_dict = dict(locus_dict)
+   locus_scan.unknown_dict = dict(unknown_dict)
+   if is_region:
+      locus_scan.region_dict = merge_regions((chrom, start, end) for chrom, region_lst in raw_region_dict.items() for start, end in region_lst)
+
+   return locus_scan
+
+# 一个记录段中chrom的记录 (start, end, 序号, other)，按start排序
+def __run_records(in_f, file_format: str, chrom: str, run: list) -> Iterator[tuple[int, int, int, str]]:
+   in_f.seek(run[0])
+   for i, (_, _, (record_chrom, start, end, other)) in enumerate(__read_locus_records(in_f, file_format, run[1]), run[2]):
+      if record_chrom == chrom:
+         yield start, end, i, other
+
+   return None
+
+# 一组互相重叠的区间展开成位点。同一个位置上other不同的区间各输出一次（按输入顺序），other相同的只输出一次
+def __expand_region_group(chrom: str, group_lst: list) -> Iterator[tuple[str, int, str]]:
+   other = group_lst[0][3]
+   if all([region[3] == other for region in group_lst]):
+      for pos in range(group_lst[0][0], max([region[1] for region in group_lst]) + 1):
+         yield chrom, pos, other
+      return None
+
+   # 区间的端点把整组分成若干段，每一段被同一批区间覆盖
+   boundary_lst = sorted({region[0] for region in group_lst} | {region[1] + 1 for region in group_lst})
+   group_lst = sorted(group_lst, key = lambda x: x[2])
+   for segment_start, segment_end in zip(boundary_lst, boundary_lst[1:]):
+      other_lst = list(dict.fromkeys([region[3] for region in group_lst if region[0] <= segment_start <= region[1]]))
+      for pos in range(segment_start, segment_end):
+         for other in other_lst:
+            yield chrom, pos, other
+
+   return None
+
+# 一个染色体上按start排序的区间流，合并重叠的区间后展开成位点。只保存当前一组互相重叠的区间
+def __normalize_contig(chrom: str, region_iter: Iterator[tuple[int, int, int, str]]) -> Iterator[tuple[str, int, str]]:
+   group_lst = []
+   group_end = 0
+   for region in region_iter:
+      if group_lst != [] and region[0] > group_end:
+         yield from __expand_region_group(chrom, group_lst)
+         group_lst = []
+
+      group_end = region[1] if group_lst == [] else max(group_end, region[1])
+      group_lst.append(region)
+
+   if group_lst != []:
+      yield from __expand_region_group(chrom, group_lst)
+
+   return None
 
+# 位点的标准化，见本节开头
+# for chrom, pos, other in normalize_loci(locus_file, 'BED', bam_af.references, scan_locus_file(locus_file, 'BED', bam_af.references)): ...
+def normalize_loci(locus_file: str, file_format: str, contig_lst: list[str, ...], locus_scan: LocusScan, drop_callback = None) -> Iterator[tuple[str, int, str]]:
+   '''
+   同一个位置出现多次时只输出一次，other不同时每个other各输出一次（相邻，按输入顺序），结果行与之前一样一个other一行
+
+   Parameters:
+      **locus_file, file_format**:
+         位置文件和格式，必须与scan_locus_file读取的相同
+
+      **contig_lst**: list[str, ...]
+         比对文件header中的染色体，按header的顺序
+
+      **locus_scan**: LocusScan
+         scan_locus_file的返回值
+
+      **drop_callback**:
+         可选, 每个染色体结束时以该染色体中被合并掉的重复位点数调用，例如用于修正进度的总数
+
+   Returns:
+      **locus_iter**: Iterator[tuple[str, int, str]]
+         chrom, pos, other，与parse_locus相同
+   '''
+
+   buffer_dict = None  # 记录段太多的染色体的全部记录 {chrom: [(start, end, 序号, other), ...]}，第一次用到时读一遍文件
+   with contextlib.ExitStack() as stack:
+      in_f = None  # 只有一个记录段的染色体共用一个文件句柄，位置文件按header的顺序排列时只需要顺序读一遍
+      for chrom in contig_lst:
+         run_lst = locus_scan.run_dict.get(chrom, [])
+         if run_lst == []:
+            continue
+
+         with contextlib.ExitStack() as run_stack:
+            if len(run_lst) == 1:
+               if in_f is None:
+                  in_f = stack.enter_context(__open_locus_file(locus_file))
+               region_iter = __run_records(in_f, file_format, chrom, run_lst[0])
+            elif len(run_lst) <= MAX_MERGE_RUNS:
+               # 每个记录段一个文件句柄，归并后仍按start排序。序号不重复，所以不会比较到other
+               region_iter = heapq.merge(*[__run_records(run_stack.enter_context(__open_locus_file(locus_file)), file_format, chrom, run) for run in run_lst])
+            else:
+               if buffer_dict is None:
+                  buffer_dict = {x: [] for x, y in locus_scan.run_dict.items() if len(y) > MAX_MERGE_RUNS}
+                  with __open_locus_file(locus_file) as buffer_f:
+                     for i, (_, _, (record_chrom, start, end, other)) in enumerate(__read_locus_records(buffer_f, file_format)):
+                        if record_chrom in buffer_dict:
+                           buffer_dict[record_chrom].append((start, end, i, other))
+               region_lst = buffer_dict.pop(chrom)
+               region_lst.sort()
+               region_iter = iter(region_lst)
+
+            locus_int = 0
+            for locus in __normalize_contig(chrom, region_iter):
+               locus_int += 1
+               yield locus
+
+         if drop_callback is not None and locus_int < locus_scan.locus_dict[chrom]:
+            drop_callback(locus_scan.locus_dict[chrom] - locus_int)
+
+   return None
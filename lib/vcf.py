@@ -1,11 +1,22 @@
 #!/usr/bin/env python3
 # 处理位点vcf文件的函数
-# 也可以直接运行: vcf.py XXXX.vcf.gz 生成realsite文件 XXXX.vcf.realsite
+# 也可以直接运行: vcf.py XXXX.vcf.gz [缓存目录] 将vcf文件编译为二进制索引文件，保存在缓存目录中（见truthcache.py）
+# 或者 vcf.py XXXX.vcf.realsite [缓存目录] 将已有的realsite文件编译为二进制索引文件
 import os
 import sys
 import os.path as path
 import collections
 import gzip
+import bisect
+import multiprocessing as mp
+import pysam
+
+try:
+   from . import realsite
+   from . import truthcache
+except ImportError:  # 直接运行vcf.py
+   import realsite
+   import truthcache
 
 BASES = ['A', 'T', 'C', 'G']
 
@@ -54,6 +65,82 @@ def __indel_ref_and_alt(pos: int, ref: str, alt: str) -> tuple[int, str]:
 
    return pos_correct_int, samtools_style_str
 
+# 解析金标准位点VCF文件的一行（非header），返回 chrom, pos, ref, alt, gt_lst
+# gt_lst 为排序后的genotype序号，在双倍体中，形如 [0, 1] （杂合）或者 [1, 2]（双alt杂合），或者 [1]（纯合）
+# 不符合pass_only，qual条件或者格式错误的行返回None。QUAL可以是浮点数
+def __parse_golden_line(line_str: str, pass_only = True, qual = 0) -> tuple:
+
+   try:
+      line_lst = line_str.split()
+      chrom = line_lst[0]
+      pos = int(line_lst[1])
+      ref = line_lst[3]
+      alt = line_lst[4]
+      qual_int = float(line_lst[5])
+      filter_str = line_lst[6]
+      format_str = line_lst[8]
+      sample_str = line_lst[9]
+
+      if pass_only and filter_str != 'PASS':
+         raise ValueError('FILTER is not PASS.')
+
+      if qual_int < qual:
+         raise ValueError('QUAL is less than {}'.format(qual))
+
+      if 'GT' not in format_str:
+         raise TypeError('FORMAT string does not have GT tag.')
+
+   except Exception as ex:
+      message = '跳过该条目'
+      print(ex, message, line_str.strip())
+      return None
+
+   gt_index = format_str.split(':').index('GT')
+   gt_str = sample_str.split(':')[gt_index]
+   if '/' in gt_str:
+      gt_lst = gt_str.split('/')
+   elif '|' in gt_str:
+      gt_lst = gt_str.split('|')
+   else:
+      return None
+
+   gt_lst = list(set(gt_lst))
+   gt_lst.sort()
+   gt_lst = [int(x) for x in gt_lst]
+
+   return chrom, pos, ref, alt, gt_lst
+
+# 一条VCF记录衍生的全部真实位点，返回 [(pos, variant_str), ...]，位置都在 [pos, pos + len(ref) - 1] 之内
+def __golden_record_sites(pos: int, ref: str, alt: str, gt_lst: list[int, ...]) -> list[tuple[int, str], ...]:
+
+   # 单碱基的SNP（最常见的记录）不需要补齐和比较InDel，结果与下面的通用方法相同
+   if len(ref) == 1:
+      genotype_lst = [ref] + alt.split(',')
+      if all([len(x) == 1 for x in genotype_lst]):
+         return [(pos, genotype_lst[j]) for j in gt_lst]
+
+   site_lst = []
+   # 添加点突变 (直接将可能的碱基或者'*'(无论是ref还是alt)添加至相应位置)
+   genotype_lst = __pad_alt(ref, alt, pad = True)  #  genotype_lst 形如 ['TACACAC', 'TACACACACAC', 'T      '] 第一个元素为ref
+   ref_length_int = len(genotype_lst[0])
+   for i in range(ref_length_int):
+      for j in gt_lst:
+         variant_str = genotype_lst[j][i] if genotype_lst[j][i] != ' ' else '*'
+         site_lst.append((pos + i, variant_str))
+
+   # 添加InDel （将alt与ref的比较值添加至相应位置）
+   genotype_lst = __pad_alt(ref, alt, pad = False)  #  genotype_lst 形如 ['TACACACACACACAC', 'TACACACACAC', 'T'] 第一个元素为ref
+   for j in gt_lst:
+      if j == 0:
+         continue
+
+      pos_shift, indel_str = __indel_ref_and_alt(pos, ref = genotype_lst[0], alt = genotype_lst[j])
+
+      if pos_shift is not None:
+         site_lst.append((pos_shift, indel_str))
+
+   return site_lst
+
 # 读入realsite文件
 def get_real_variants_from_realsite(real_site_file: str) -> dict:
 
@@ -74,11 +161,10 @@ def get_real_variants_from_realsite(real_site_file: str) -> dict:
    print(message)
    return real_site_dict
 
-# 将金标准位点VCF文件，转换为真实位点文件，并读入
-# 输出为一个字典 {(chrom, pos):[variant_1, variant_2, ....]}
-# 真实位点文件为一个tsv文本文件，chrom pos variant_1 variant_2 ....
+# 读入金标准位点VCF文件，转换为真实位点
+# 输出为一个字典 {(chrom, pos):[variant_1, variant_2, ....]}，每次调用都解析vcf文件，编译结果的缓存见compile_real_site_index
 # variant的格式为samtools风格， 例如'A', 'T', '*', ‘+2AC’， ‘-3NNN’等
-def get_real_variants_from_vcf(vcf_file: str, pass_only = True, qual = 0) -> dict:
+def get_real_variants_from_vcf(vcf_file: str, pass_only = True, qual = 0, processes: int = 1) -> dict:
    '''
    读取vcf文件中特定位置的pos，genotype ref和alt信息
    返回一个字典，格式为 {(chrom, pos):[variant_1, variant_2, ....]}。用来作为对比pysam输出的结果是否match
@@ -101,6 +187,9 @@ def get_real_variants_from_vcf(vcf_file: str, pass_only = True, qual = 0) -> dic
       **qual**: int
          只读入QUAL字段大于等于该值的位点
 
+      **processes**: int
+         解析vcf文件的进程数。vcf文件经过bgzip压缩并且有tabix索引时，各条染色体并行解析，结果与单进程相同
+
    Return:
       **real_site_dict**: dict
          {(chrom, pos):[..., ...], }
@@ -108,113 +197,234 @@ def get_real_variants_from_vcf(vcf_file: str, pass_only = True, qual = 0) -> dic
    '''
 
    vcf_file_str = path.realpath(path.expanduser(vcf_file))
-   if vcf_file_str.endswith('.gz'):
-      real_site_str = vcf_file_str[:-3]+ '.realsite'
-   else:
-      real_site_str = vcf_file_str + '.realsite'
 
    # real_site_dict = {('chr1', 1314235):['A', 'T', '-3NNN']}
    real_site_dict = collections.defaultdict(list)
 
-   # read the real site file
-   if os.access(real_site_str, os.R_OK):
-      message = 'read {}'.format(real_site_str)
-      print(message)
-      real_site_dict = get_real_variants_from_realsite(real_site_str)
-      return real_site_dict
+   # bgzip压缩并且有tabix索引时，各条染色体在多个进程中并行解析；否则顺序读取整个文件
+   contig_lst = __tabix_contigs(vcf_file_str) if processes > 1 else []
+   if len(contig_lst) > 1:
+      task_lst = [(vcf_file_str, chrom, pass_only, qual) for chrom in contig_lst]
+      record_int = 0
+      with mp.Pool(min(processes, len(contig_lst))) as pool:
+         for contig_item_lst, contig_record_int in pool.imap(__compile_contig, task_lst):  # 按染色体顺序合并
+            real_site_dict.update(contig_item_lst)
+            record_int += contig_record_int
+   else:
+      with open(vcf_file_str, 'rb') if not vcf_file_str.endswith('.gz') else gzip.open(vcf_file_str) as in_f:
+         record_int = __compile_lines(real_site_dict, in_f, pass_only, qual)
 
-   n = 1
-   with open(vcf_file_str) if not vcf_file_str.endswith('.gz') else gzip.open(vcf_file_str) as in_f, open(real_site_str, 'wt') as out_f:
-      for line in in_f:
+   print('read', record_int, 'sites.                 ')
+   return real_site_dict
 
-         if isinstance(line, bytes):
-            line_str = line.decode().strip()
-         else:
-            line_str = line.strip()
+# 解析vcf文件的各行，将衍生的真实位点加入real_site_dict，返回解析成功的记录数。line_iter的每一项可以是str或者bytes
+def __compile_lines(real_site_dict: dict, line_iter, pass_only = True, qual = 0) -> int:
 
-         if line_str.startswith('#'):
-            continue
+   record_int = 0
+   for line in line_iter:
+      line_str = line.decode() if isinstance(line, bytes) else line
+      if line_str.startswith('#') or line_str.strip() == '':
+         continue
 
-         try:
-            line_lst = line_str.split()
-            chrom = line_lst[0]
-            pos = int(line_lst[1])
-            ref = line_lst[3]
-            alt = line_lst[4]
-            qual_int = int(line_lst[5])
-            filter_str = line_lst[6]
-            format_str = line_lst[8]
-            sample_str = line_lst[9]
-
-            if pass_only and filter_str != 'PASS':
-               raise ValueError('FILTER is not PASS.')
-
-            if qual_int < qual:
-               raise ValueError('QUAL is less than {}'.format(qual))
-
-            if 'GT' not in format_str:
-               raise TypeError('FORMAT string does not have GT tag.')
-
-         except Exception as ex:
-            message = '跳过该条目'
-            print(ex, message, line_str.strip())
-            continue
+      record_tup = __parse_golden_line(line_str, pass_only, qual)
+      if record_tup is None:
+         continue
+      chrom, pos, ref, alt, gt_lst = record_tup
 
-         if n % 100000 == 0:
-            print(n, chrom, pos, ref, alt, '                            ', end = '\r')
+      for site_pos, variant_str in __golden_record_sites(pos, ref, alt, gt_lst):
+         real_site_dict[(chrom, site_pos)].append(variant_str)
+      record_int += 1
 
-         gt_index = format_str.split(':').index('GT')
-         gt_str = sample_str.split(':')[gt_index]
-         if '/' in gt_str:
-            gt_lst = gt_str.split('/')
-         elif '|' in gt_str:
-            gt_lst = gt_str.split('|')
-         else:
-            continue
+   return record_int
 
-         gt_lst = list(set(gt_lst))
-         gt_lst.sort()
-         gt_lst = [int(x) for x in gt_lst] #  在双倍体中，形如 [0, 1] （杂合）或者 [1, 2]（双alt杂合），或者 [1]（纯合）
-
-
-         pos_in_this_loop_lst = []  # 记录每一行vcf文件衍生的真实位点，用于写入realsite文件
-         # 添加点突变 (直接将可能的碱基或者'*'(无论是ref还是alt)添加至相应位置)
-         genotype_lst = __pad_alt(ref, alt, pad = True)  #  genotype_lst 形如 ['TACACAC', 'TACACACACAC', 'T      '] 第一个元素为ref
-         ref_length_int = len(genotype_lst[0])
-         for i in range(ref_length_int):
-            for j in gt_lst:
-               variant_str = genotype_lst[j][i] if genotype_lst[j][i] != ' ' else '*'
-               real_site_dict[(chrom, pos + i)].append(variant_str)
-               pos_in_this_loop_lst.append(pos + i)
-
-         # 添加InDel （将alt与ref的比较值添加至相应位置）
-         genotype_lst = __pad_alt(ref, alt, pad = False)  #  genotype_lst 形如 ['TACACACACACACAC', 'TACACACACAC', 'T'] 第一个元素为ref
-         for j in gt_lst:
-            if j == 0:
-               continue
+# bgzip压缩并且有tabix索引（.tbi或.csi）的vcf文件返回索引中的染色体，否则返回[]
+def __tabix_contigs(vcf_file_str: str) -> list[str, ...]:
+
+   if not vcf_file_str.endswith('.gz') or not (os.access(vcf_file_str + '.tbi', os.R_OK) or os.access(vcf_file_str + '.csi', os.R_OK)):
+      return []
+
+   try:
+      with pysam.TabixFile(vcf_file_str) as tabix_file:
+         return list(tabix_file.contigs)
+   except (OSError, ValueError):
+      return []
 
-            pos_shift, indel_str = __indel_ref_and_alt(pos, ref = genotype_lst[0], alt = genotype_lst[j])
+# 并行编译时在子进程中运行：解析一条染色体上的全部记录，返回 ([((chrom, pos), [variant, ...]), ...], 记录数)
+# 一条记录衍生的真实位点都在同一条染色体上，所以按染色体分割不改变结果
+def __compile_contig(task: tuple[str, str, bool, int]) -> tuple[list, int]:
 
-            if pos_shift is not None:
-               real_site_dict[(chrom, pos_shift)].append(indel_str)
-               pos_in_this_loop_lst.append(pos_shift)
+   vcf_file_str, chrom, pass_only, qual = task
+   real_site_dict = collections.defaultdict(list)
+   with pysam.TabixFile(vcf_file_str) as tabix_file:
+      record_int = __compile_lines(real_site_dict, tabix_file.fetch(chrom), pass_only, qual)
+
+   return list(real_site_dict.items()), record_int
+
+# 只读取金标准位点VCF文件中与查询区间重叠的记录，输出格式与get_real_variants_from_vcf相同，但只包含区间内的位点
+# 用于小panel对比全基因组标准位点的情况
+def get_real_variants_for_regions(vcf_file: str, region_dict: dict, pass_only = True, qual = 0) -> dict:
+   '''
+   读取vcf文件中与region_dict重叠的记录，包括InDel修正后的位置（见__indel_ref_and_alt）落在区间内的记录
+   如果vcf文件经过bgzip压缩并且有tabix索引（.tbi或.csi），只读取各个区间内的记录；
+   否则顺序读取整个文件，跳过与区间不重叠的记录，只有重叠的记录才会完整解析
 
+   Parameter:
+      **vcf_file**: string
+         vcf文件，可以zip压缩
 
-         # 写入realsite文件
-         for pos_to_write in set(pos_in_this_loop_lst):
-            temp_str =  '\t'.join(real_site_dict[(chrom, pos_to_write)])
-            out_f.writelines(f'{chrom}\t{pos_to_write}\t{temp_str}\n')
+      **region_dict**: dict
+         {chrom: [(start, end), ...]}，1-based闭区间，已排序且互不重叠（见utils.merge_regions）
 
+      **pass_only, qual**:
+         见get_real_variants_from_vcf
 
-         # 累加计数器
-         n += 1
+   Return:
+      **real_site_dict**: dict
+         {(chrom, pos):[..., ...], }，只包含区间内的位点
+   '''
 
-   print('read', n - 1, 'sites.                 ')
+   vcf_file_str = path.realpath(path.expanduser(vcf_file))
+   real_site_dict = collections.defaultdict(list)
+   start_dict = {chrom: [x[0] for x in region_lst] for chrom, region_lst in region_dict.items()}  # 用于二分查找
+
+   # 区间 [start, end] 是否与region_dict中的区间重叠
+   def is_overlapped(chrom: str, start: int, end: int) -> bool:
+      try:
+         i = bisect.bisect_right(start_dict[chrom], end) - 1
+      except KeyError:
+         return False
+      return i >= 0 and region_dict[chrom][i][1] >= start
+
+   def add_record(line_str: str) -> None:
+      record_tup = __parse_golden_line(line_str, pass_only, qual)
+      if record_tup is None:
+         return None
+
+      chrom, pos, ref, alt, gt_lst = record_tup
+      for site_pos, variant_str in __golden_record_sites(pos, ref, alt, gt_lst):
+         if is_overlapped(chrom, site_pos, site_pos):
+            real_site_dict[(chrom, site_pos)].append(variant_str)
+      return None
+
+   if vcf_file_str.endswith('.gz') and (os.access(vcf_file_str + '.tbi', os.R_OK) or os.access(vcf_file_str + '.csi', os.R_OK)):
+      message = 'read {} by tabix index'.format(vcf_file_str)
+      print(message)
+      with pysam.TabixFile(vcf_file_str) as tabix_file:
+         contig_set = set(tabix_file.contigs)
+         for chrom, region_lst in region_dict.items():
+            if chrom not in contig_set:
+               continue
+
+            previous_end_int = 0
+            for start, end in region_lst:
+               for line_str in tabix_file.fetch(chrom, start - 1, end):
+                  # 起始位置在上一个区间之内或之前的记录，已经在上一个区间读取过
+                  if int(line_str.split(None, 2)[1]) <= previous_end_int:
+                     continue
+                  add_record(line_str)
+               previous_end_int = end
+
+   else:
+      with open(vcf_file_str) if not vcf_file_str.endswith('.gz') else gzip.open(vcf_file_str) as in_f:
+         for line in in_f:
+            if isinstance(line, bytes):
+               line_str = line.decode().strip()
+            else:
+               line_str = line.strip()
+
+            if line_str.startswith('#') or line_str == '':
+               continue
+
+            # 只拆分前几列，判断 [pos, pos + len(ref) - 1] 是否与查询区间重叠
+            try:
+               line_lst = line_str.split(None, 4)
+               if not is_overlapped(line_lst[0], int(line_lst[1]), int(line_lst[1]) + len(line_lst[3]) - 1):
+                  continue
+            except (IndexError, ValueError):
+               pass  # 交给__parse_golden_line报告格式错误
+
+            add_record(line_str)
+
+   message = f'read {len(real_site_dict)} sites in {sum(len(x) for x in region_dict.values())} regions. Done.'
+   print(message)
    return real_site_dict
 
+# 将金标准位点VCF文件或realsite文件编译为二进制索引文件（见realsite.py），返回索引文件名
+# 索引文件保存在缓存目录中，输入文件和解析参数都相同时直接使用（见truthcache.py）
+def compile_real_site_index(golden_file: str, pass_only = True, qual = 0, processes: int = 1, cache_dir: str = '', max_cache_size: int = truthcache.DEFAULT_MAX_SIZE, key_mode: str = 'stat') -> tuple[str, bool]:
+   '''
+   将标准位点文件编译为二进制索引文件，之后可以用realsite.RealSiteIndex打开
+
+   Parameter:
+      **golden_file**: string
+         标准位点文件，可以是vcf文件（可以zip压缩），realsite文件，或者已经编译好的.realsite.bin文件
+
+      **pass_only, qual, processes**:
+         见get_real_variants_from_vcf
+
+      **cache_dir**: str
+         缓存目录，为''时使用truthcache.DEFAULT_CACHE_DIR（环境变量GET_POSITION_INFO_CACHE，默认为~/.cache/get_position_info/realsite）
+
+      **max_cache_size**: int
+         缓存目录的大小上限（字节），写入新的缓存后超过上限时删除最久没有使用的缓存，0表示不限制
+
+      **key_mode**: str
+         输入文件的标识方式，'stat'（路径、大小和修改时间）或者'content'（文件内容的sha1），见truthcache.py
+
+   Return:
+      **index_file**: str
+         索引文件
+
+      **is_temporary**: bool
+         如果缓存目录不可写，索引文件会写在临时目录中，此时为True，调用者负责在使用完毕后删除该文件
+
+   Raises:
+      ValueError: key_mode不是truthcache.KEY_MODES之一
+   '''
+
+   golden_file_str = path.realpath(path.expanduser(golden_file))
+   if golden_file_str.endswith(realsite.SUFFIX):
+      return golden_file_str, False
+
+   if cache_dir == '':
+      cache_dir = truthcache.DEFAULT_CACHE_DIR
+   cache_dir = path.realpath(path.expanduser(cache_dir))
+
+   param_dict = {} if golden_file_str.endswith('.realsite') else {'pass_only': bool(pass_only), 'qual': qual}
+   key_str, key_dict = truthcache.cache_key(golden_file_str, param_dict, key_mode)
+   index_file_str = truthcache.lookup(cache_dir, key_str)
+   if index_file_str is not None:
+      message = 'read {}'.format(index_file_str)
+      print(message)
+      return index_file_str, False
+
+   if golden_file_str.endswith('.realsite'):
+      real_site_dict = get_real_variants_from_realsite(golden_file_str)
+   else:
+      real_site_dict = get_real_variants_from_vcf(golden_file_str, pass_only = pass_only, qual = qual, processes = processes)
+
+   try:
+      index_file_str = truthcache.store(cache_dir, key_str, key_dict, real_site_dict)
+   except OSError as ex:
+      message = f'compile_real_site_index: 无法写入缓存目录{cache_dir}（{ex}），使用临时文件'
+      print(message)
+      return realsite.make_temporary_index(real_site_dict), True
+
+   message = 'write {}'.format(index_file_str)
+   print(message)
+
+   try:
+      for removed_file in truthcache.evict(cache_dir, max_cache_size, key_str):
+         message = f'compile_real_site_index: 缓存目录超过大小上限，删除{removed_file}'
+         print(message)
+   except OSError as ex:
+      message = f'compile_real_site_index: 清理缓存目录{cache_dir}失败（{ex}）'
+      print(message)
+
+   return index_file_str, False
+
 if __name__ == '__main__':
-   real_site_dict = get_real_variants_from_vcf(sys.argv[1])
-   i = 1
+   index_file, _ = compile_real_site_index(sys.argv[1], processes = os.cpu_count() or 1, cache_dir = sys.argv[2] if len(sys.argv) > 2 else '')
 
 
 
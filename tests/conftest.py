@@ -0,0 +1,17 @@
+# 测试共用的合成数据集，由bench/synthetic.py生成：2条20kb的染色体，深度10，POS/BED/VCF位置文件，标准位点vcf（.vcf和.vcf.gz）
+import sys
+import os.path as path
+
+import pytest
+
+ROOT_DIR = path.dirname(path.dirname(path.realpath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, path.join(ROOT_DIR, 'bench'))
+
+import synthetic
+
+
+@pytest.fixture(scope = 'session')
+def dataset(tmp_path_factory) -> dict:
+   parameters = synthetic.SyntheticParameters(contig_length = 20000, depth = 10, bed_region_number = 8, bed_region_length = 200)
+   return synthetic.generate(str(tmp_path_factory.mktemp('synthetic')), parameters)
@@ -0,0 +1,319 @@
+# lib/info.py：位点信息的统计（pileup、降采样）
+import sys
+import os.path as path
+import math
+import collections
+import statistics
+
+import pysam
+import pytest
+
+ROOT_DIR = path.dirname(path.dirname(path.realpath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import lib.utils as utils
+import lib.info as info
+import lib.vcf as vcf
+
+# 全部属性，包括每个read的原始数值
+ALL_PLAN = info.compile_format_plan(list(info.PositionInfo.__dataclass_fields__))
+
+
+# 测试的位点：位置文件中的位置加上标准位点的位置（有matched和unmatched的reads），以及染色体两端没有reads覆盖的位置
+# 返回{chrom: [(pos, (real_allele_snp, real_allele_indel)), ...]}，位置排序且不重复，allele的拆分方式与get_position_info.py相同
+def __test_loci(dataset: dict) -> dict:
+   real_site_dict = vcf.get_real_variants_from_vcf(dataset['truth_vcf'])
+   pos_dict = collections.defaultdict(set)
+   with open(dataset['locus_pos']) as in_f:
+      for line_str in in_f:
+         chrom, pos = line_str.split()[:2]
+         pos_dict[chrom].add(int(pos))
+   for chrom, pos in real_site_dict:
+      pos_dict[chrom].update([pos, pos + 1])
+   for chrom in pos_dict:
+      pos_dict[chrom].update([1, dataset['parameters']['contig_length'] + 1])
+
+   loci_dict = {}
+   for chrom, pos_set in sorted(pos_dict.items()):
+      loci_dict[chrom] = []
+      for pos in sorted(pos_set):
+         allele_lst = real_site_dict.get((chrom, pos), [])
+         real_allele_indel = [x for x in allele_lst if '+' in x or '-' in x]
+         real_allele_snp = [x for x in allele_lst if x not in real_allele_indel]
+         loci_dict[chrom].append((pos, (real_allele_snp, real_allele_indel)))
+
+   return loci_dict
+
+
+# read是否通过read_filter中的MAPQ、flag和测序质量条件（deletion按下一个碱基的测序质量）
+def __is_kept_read(pileup_read: pysam.PileupRead, read_filter: info.ReadFilter) -> bool:
+   segment = pileup_read.alignment
+   if segment.mapping_quality < read_filter.min_mapq or segment.flag & read_filter.exclude_flags or segment.flag & read_filter.include_flags != read_filter.include_flags:
+      return False
+   return segment.query_qualities[pileup_read.query_position_or_next] >= read_filter.min_base_quality
+
+
+# 逐个read统计一个pileupcolumn的参考实现（向量化之前get_pos_info中的循环），返回{属性: 计数列表或原始数值列表}
+# 指定read_filter时只统计通过过滤条件的reads
+def __per_read_attributes(pileupcolumn: pysam.PileupColumn, real_allele_snp: list, real_allele_indel: list, read_filter: info.ReadFilter = None) -> dict:
+   attr_dict = collections.defaultdict(list)
+   for attr_str in info.PositionInfo.__dataclass_fields__:
+      if attr_str.endswith('_count'):
+         attr_dict[attr_str] = [0, 0, 0, 0]
+
+   query_indel_lst = [x.upper()[1:] for x in pileupcolumn.get_query_sequences(add_indels = True)]
+   for i, pileup_read in enumerate(pileupcolumn.pileups):
+      if read_filter is not None and not __is_kept_read(pileup_read, read_filter):
+         continue
+
+      segment = pileup_read.alignment
+      flag_index_int = utils.get_index(segment)
+      mapq_int = segment.mapping_quality
+      if segment.is_forward:
+         cycle_int = pileup_read.query_position_or_next + 1
+      else:
+         cycle_int = segment.infer_read_length() - pileup_read.query_position_or_next
+
+      attr_dict['background_count'][flag_index_int] += 1
+      attr_dict['indel_length'].append(pileup_read.indel)
+      if pileup_read.query_position is not None:
+         base = segment.query_sequence[pileup_read.query_position].upper()
+         attr_dict['query_snp'].append(base)
+         seq_quality_int = segment.get_forward_qualities()[pileup_read.query_position]
+         attr_dict[base + '_seq_quality'].append(seq_quality_int)
+      else:
+         base = 'miss'
+         attr_dict['query_snp'].append('*')
+      attr_dict[base + '_count'][flag_index_int] += 1
+      attr_dict[base + '_MAPQ'].append(mapq_int)
+      attr_dict[base + '_cycle'].append(cycle_int)
+
+      if real_allele_snp is not None:
+         prefix = 'matched_snp' if base in real_allele_snp else 'unmatched_snp'
+         attr_dict[prefix + '_count'][flag_index_int] += 1
+         attr_dict[prefix + '_MAPQ'].append(mapq_int)
+         attr_dict[prefix + '_cycle'].append(cycle_int)
+         if base != 'miss':
+            attr_dict[prefix + '_seq_quality'].append(seq_quality_int)
+
+      if pileup_read.indel == 0:
+         continue
+
+      indel_alt_str = query_indel_lst[i]
+      attr_dict['query_indel'].append(indel_alt_str)
+      kind_str = 'ins' if pileup_read.indel > 0 else 'del'
+      seq_quality_lst = list(segment.query_qualities)[pileup_read.query_position + 1:pileup_read.query_position + pileup_read.indel + 1] if kind_str == 'ins' else []
+      attr_dict[kind_str + '_count'][flag_index_int] += 1
+      attr_dict[kind_str + '_MAPQ'].append(mapq_int)
+      attr_dict[kind_str + '_cycle'].append(cycle_int)
+      attr_dict['ins_seq_quality'].extend(seq_quality_lst)
+      if real_allele_indel is not None:
+         prefix = 'matched' if indel_alt_str in real_allele_indel else 'unmatched'
+         attr_dict[prefix + '_indel_count'][flag_index_int] += 1
+         attr_dict[prefix + '_ins_seq_quality'].extend(seq_quality_lst)
+         attr_dict[prefix + '_indel_MAPQ'].append(mapq_int)
+         attr_dict[prefix + '_indel_cycle'].append(cycle_int)
+
+   return attr_dict
+
+
+# 逐个属性格式化的参考实现（编译格式化函数之前的__output_attr），字符串列表按排序后的种类输出，只有*_count的四个0输出为空
+def __output_value(attr_str: str, value) -> str:
+   if isinstance(value, info.Accumulator):
+      value = value.values
+   if isinstance(value, collections.Counter):
+      return str(value)[9:-2].replace("'", '')
+   if isinstance(value, list):
+      if value == []:
+         return ''
+      if isinstance(value[0], int):
+         return '' if attr_str.endswith('_count') and value == [0, 0, 0, 0] else str(value)[1:-1]
+      return str(sorted(set(value)))[1:-1].replace("'", '')
+   if isinstance(value, float):
+      return str(round(value, 1))
+   if value is None:
+      return ''
+   return str(value)
+
+
+# 降采样时逐条生成的query字符串与整列的get_query_sequences(add_indels = True)相同（不区分大小写）
+def test_query_string_matches_pileup_column(dataset):
+   query_int = 0
+   with pysam.AlignmentFile(dataset['bam']) as bam_af:
+      for pileupcolumn in bam_af.pileup(stepper = 'nofilter', max_depth = 999999999, ignore_orphans = False, ignore_overlaps = False, min_base_quality = 0):
+         query_seq_lst = pileupcolumn.get_query_sequences(add_indels = True)
+         for pileup_read, query_str in zip(pileupcolumn.pileups, query_seq_lst):
+            assert info.__query_string(pileup_read, pileup_read.alignment) == query_str.upper()
+            query_int += 1
+   assert query_int > 0
+
+
+# 一次pileup扫过整个染色体的结果与逐个位置调用get_pos_info相同，包括没有reads覆盖的位置
+def test_sweep_matches_get_pos_info(dataset):
+   row_int = 0
+   with pysam.AlignmentFile(dataset['bam']) as bam_af:
+      for chrom, locus_lst in __test_loci(dataset).items():
+         pos_lst = [pos for pos, _ in locus_lst]
+         real_allele_lst = [real_allele for _, real_allele in locus_lst]
+         sweep_lst = list(info.sweep_pos_info(bam_af, chrom, pos_lst, real_allele_lst))
+         assert [x.pos for x in sweep_lst] == pos_lst
+
+         for (pos, real_allele), sweep_pos_info in zip(locus_lst, sweep_lst):
+            pos_info = info.get_pos_info(bam_af, chrom, pos, *real_allele)
+            for x in (sweep_pos_info, pos_info):
+               info.add_attributes_pos_info(x)
+            assert info.format_row(sweep_pos_info, info.FULL_PLAN.row_formatter) == info.format_row(pos_info, info.FULL_PLAN.row_formatter)
+            row_int += sweep_pos_info.coverage is not None
+
+   assert row_int > 0
+
+
+# 用numpy按碱基和flag序号汇总的计数和原始数值，与逐个read统计的结果相同
+def test_vectorized_column_matches_per_read(dataset):
+   column_int = 0
+   with pysam.AlignmentFile(dataset['bam']) as bam_af:
+      for chrom, locus_lst in __test_loci(dataset).items():
+         for pos, real_allele in locus_lst:
+            pos_info = info.get_pos_info(bam_af, chrom, pos, *real_allele, plan = ALL_PLAN)
+            for pileupcolumn in bam_af.pileup(chrom, pos - 1, pos, truncate = True, max_depth = 999999999, ignore_orphans = False, **info.NO_FILTER_KWARGS):
+               attr_dict = __per_read_attributes(pileupcolumn, *real_allele)
+               for attr_str in info.PositionInfo.__dataclass_fields__:
+                  if attr_str.endswith('_count'):
+                     assert getattr(pos_info, attr_str) == attr_dict[attr_str], attr_str
+                  elif attr_str in info.ACCUMULATOR_FIELDS:
+                     assert getattr(pos_info, attr_str).values == attr_dict[attr_str], attr_str
+               for attr_str in ('indel_length', 'query_snp', 'query_indel'):
+                  assert getattr(pos_info, attr_str) == attr_dict[attr_str], attr_str
+               assert pos_info.query_snp_counter == collections.Counter(attr_dict['query_snp'])
+               assert pos_info.query_indel_counter == collections.Counter(attr_dict['query_indel'])
+               assert pos_info.indel_length_counter == collections.Counter(attr_dict['indel_length'])
+               column_int += 1
+
+   assert column_int > 0
+
+
+# Accumulator的累加统计（均值、中位数和分位数）与由每个read的原始数值计算的结果相同，不需要原始数值时不保存
+def test_accumulator_statistics_match_raw_values(dataset):
+   value_int = 0
+   with pysam.AlignmentFile(dataset['bam']) as bam_af:
+      for chrom, locus_lst in __test_loci(dataset).items():
+         for pos, real_allele in locus_lst:
+            raw_pos_info = info.get_pos_info(bam_af, chrom, pos, *real_allele, plan = ALL_PLAN)
+            pos_info = info.get_pos_info(bam_af, chrom, pos, *real_allele)
+            info.add_attributes_pos_info(pos_info)
+            for attr_str in info.ACCUMULATOR_FIELDS:
+               value_lst = sorted(getattr(raw_pos_info, attr_str).values)
+               accumulator = getattr(pos_info, attr_str)
+               assert accumulator.values is None
+               assert accumulator.count == len(value_lst)
+               if value_lst != []:
+                  assert (accumulator.sum, accumulator.min, accumulator.max) == (sum(value_lst), value_lst[0], value_lst[-1])
+               value_int += len(value_lst)
+
+            for mean_attr_str, attr_str in info.MEAN_FIELDS.items():
+               value_lst = getattr(raw_pos_info, attr_str).values
+               assert getattr(pos_info, mean_attr_str) == (statistics.mean(value_lst) if value_lst != [] else None), mean_attr_str
+            for percentile_attr_str, (attr_str, percent_int) in info.PERCENTILE_FIELDS.items():
+               value_lst = sorted(getattr(raw_pos_info, attr_str).values)
+               if value_lst == []:
+                  expected = None
+               elif percent_int == 50:
+                  expected = statistics.median(value_lst)
+               else:
+                  expected = value_lst[max(math.ceil(percent_int * len(value_lst) / 100), 1) - 1]
+               assert getattr(pos_info, percentile_attr_str) == expected, percentile_attr_str
+
+   assert value_int > 0
+
+
+# 编译的格式化函数与逐个属性格式化的结果相同，包括原始数值列表、计数器、均值和分位数
+def test_row_formatter_matches_output_attr(dataset):
+   attribute_lst = list(ALL_PLAN.attributes)
+   with pysam.AlignmentFile(dataset['bam']) as bam_af:
+      for chrom, locus_lst in __test_loci(dataset).items():
+         for i, pos_info in enumerate(info.sweep_pos_info(bam_af, chrom, [pos for pos, _ in locus_lst], [x for _, x in locus_lst], ALL_PLAN)):
+            info.add_attributes_pos_info(pos_info, ALL_PLAN)
+            pos_info.reference, pos_info.context = 'A', 'ACGTAAGTCA'
+            pos_info.other = f'locus_{i}' if i % 2 else None
+            expected_str = '\t'.join([__output_value(x, getattr(pos_info, x)) for x in attribute_lst]).strip()
+            assert info.format_row(pos_info, ALL_PLAN.row_formatter) == expected_str
+            assert info.output_attributes_pos_info(pos_info, [' ' + x for x in attribute_lst]) == expected_str
+
+   with pytest.raises(ValueError):
+      info.compile_row_formatter(('chrom', 'A_MAPQ_median'))
+
+
+# pileup中的过滤与在全部reads中逐个过滤的结果相同，被过滤的reads不计入coverage
+@pytest.mark.parametrize('read_filter', [info.ReadFilter(min_mapq = 30), info.ReadFilter(exclude_flags = 0x400), info.ReadFilter(include_flags = 0x40),
+                                         info.ReadFilter(min_base_quality = 20), info.ReadFilter(min_mapq = 20, min_base_quality = 30, exclude_flags = 0x410)])
+def test_read_filter_matches_per_read(dataset, read_filter):
+   assert read_filter.is_active
+   read_int = 0
+   with pysam.AlignmentFile(dataset['bam']) as bam_af:
+      for chrom, locus_lst in __test_loci(dataset).items():
+         for pos, real_allele in locus_lst:
+            pos_info = info.get_pos_info(bam_af, chrom, pos, *real_allele, plan = ALL_PLAN, read_filter = read_filter)
+            attr_dict = None
+            for pileupcolumn in bam_af.pileup(chrom, pos - 1, pos, truncate = True, max_depth = 999999999, ignore_orphans = False, **info.NO_FILTER_KWARGS):
+               attr_dict = __per_read_attributes(pileupcolumn, *real_allele, read_filter = read_filter)
+            if attr_dict is None or sum(attr_dict['background_count']) == 0:
+               assert pos_info.coverage in (None, 0)
+               continue
+
+            assert pos_info.coverage == pos_info.sampled_coverage == sum(attr_dict['background_count'])
+            for attr_str in info.PositionInfo.__dataclass_fields__:
+               if attr_str.endswith('_count'):
+                  assert getattr(pos_info, attr_str) == attr_dict[attr_str], attr_str
+               elif attr_str in info.ACCUMULATOR_FIELDS:
+                  assert getattr(pos_info, attr_str).values == attr_dict[attr_str], attr_str
+            read_int += pos_info.coverage
+
+   assert read_int > 0
+
+
+# 各层（F1/F2/R1/R2）按reads数的比例分配max_depth个名额，余数最大的层多分配一个，余数相同时按层的序号
+def __stratum_quota(count_lst: list[int, ...], max_depth: int) -> list[int, ...]:
+   read_int = sum(count_lst)
+   quota_lst = [x * max_depth // read_int for x in count_lst]
+   order_lst = sorted(range(4), key = lambda i: (-(count_lst[i] * max_depth - quota_lst[i] * read_int), i))
+   for i in order_lst[:max_depth - sum(quota_lst)]:
+      quota_lst[i] += 1
+   return quota_lst
+
+
+# 降采样：sampled_coverage为max_depth，coverage仍为全部reads数，各层的reads数按比例分配，统计结果是全部reads的子集
+# 相同的seed结果相同，与逐个位置或者一次扫过整个窗口无关；不超过max_depth的位点与不降采样时相同
+@pytest.mark.parametrize('max_depth', [1, 4, 7])
+def test_max_depth_sampling(dataset, max_depth):
+   sampled_int = 0
+   seed_changed_bool = False
+   with pysam.AlignmentFile(dataset['bam']) as bam_af:
+      for chrom, locus_lst in __test_loci(dataset).items():
+         pos_lst = [pos for pos, _ in locus_lst]
+         real_allele_lst = [x for _, x in locus_lst]
+         sweep_lst = list(info.sweep_pos_info(bam_af, chrom, pos_lst, real_allele_lst, read_filter = info.ReadFilter(max_depth = max_depth)))
+         for (pos, real_allele), sweep_pos_info in zip(locus_lst, sweep_lst):
+            full_pos_info = info.get_pos_info(bam_af, chrom, pos, *real_allele)
+            pos_info = info.get_pos_info(bam_af, chrom, pos, *real_allele, read_filter = info.ReadFilter(max_depth = max_depth))
+            other_pos_info = info.get_pos_info(bam_af, chrom, pos, *real_allele, read_filter = info.ReadFilter(max_depth = max_depth, seed = 7))
+            for x in (full_pos_info, pos_info, other_pos_info, sweep_pos_info):
+               info.add_attributes_pos_info(x)
+            row_str = info.format_row(pos_info, info.FULL_PLAN.row_formatter)
+            assert info.format_row(sweep_pos_info, info.FULL_PLAN.row_formatter) == row_str
+            assert pos_info.coverage == other_pos_info.coverage == full_pos_info.coverage
+
+            if full_pos_info.coverage is None or full_pos_info.coverage <= max_depth:
+               assert row_str == info.format_row(full_pos_info, info.FULL_PLAN.row_formatter)
+               assert pos_info.sampled_coverage == full_pos_info.coverage
+               continue
+
+            for x in (pos_info, other_pos_info):
+               assert x.sampled_coverage == max_depth
+               assert x.background_count == __stratum_quota(full_pos_info.background_count, max_depth)
+               for attr_str in ('A_count', 'T_count', 'C_count', 'G_count', 'N_count', 'miss_count', 'ins_count', 'del_count'):
+                  assert all([y <= z for y, z in zip(getattr(x, attr_str), getattr(full_pos_info, attr_str))]), attr_str
+            seed_changed_bool |= row_str != info.format_row(other_pos_info, info.FULL_PLAN.row_formatter)
+            sampled_int += 1
+
+   assert sampled_int > 0
+   assert seed_changed_bool
@@ -0,0 +1,582 @@
+# 使用bench/synthetic.py生成的小数据集（见conftest.py）测试位点的标准化、断点续跑、列式输出、标准位点索引和缓存，以及进程数的分配和分位数统计
+#
+# python3 -m pytest -q tests
+import os
+import sys
+import os.path as path
+import math
+import random
+import shutil
+import statistics
+import subprocess
+
+import numpy as np
+import pysam
+import pytest
+
+ROOT_DIR = path.dirname(path.dirname(path.realpath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import lib.utils as utils
+import lib.info as info
+import lib.vcf as vcf
+import lib.realsite as realsite
+import lib.truthcache as truthcache
+import lib.columnar as columnar
+
+MAIN_SCRIPT = path.join(ROOT_DIR, 'get_position_info.py')
+CONTIG_LST = ['chr1', 'chr2']
+
+# 端到端运行get_position_info.py。第一个参数为区块大小（使小数据集也有多个区块），第二个参数为运行方式：
+# finish       正常运行
+# interrupt    不合并检查点目录，相当于全部区块完成后、合并前被中断
+# fail         每个工作进程第3次发送结果时抛出异常，模拟任务出错
+RUNNER = '''
+import sys
+import get_position_info
+get_position_info.CHUNK_SIZE = int(sys.argv.pop(1))
+mode = sys.argv.pop(1)
+if mode == 'interrupt':
+   get_position_info.checkpoint.assemble = lambda *args, **kwargs: None
+elif mode == 'fail':
+   send_rows = get_position_info.send_rows
+   call_lst = []
+   def failing_send_rows(*args, **kwargs):
+      call_lst.append(None)
+      if len(call_lst) == 3:
+         raise RuntimeError('injected failure')
+      return send_rows(*args, **kwargs)
+   get_position_info.send_rows = failing_send_rows
+get_position_info.get_arguments()
+get_position_info.main()
+'''
+CHUNK_SIZE = 50
+
+
+# 位点标准化的参考实现：全部读入内存，同一个位置的other按第一次出现的顺序去重，按contig_lst的顺序和位置排序
+def __brute_force_normalize(locus_file: str, file_format: str, contig_lst: list[str, ...]) -> list[tuple[str, int, str]]:
+   other_dict = {}  # {(chrom, pos): {other: None}}
+   for chrom, pos, other in utils.parse_locus(locus_file, file_format):
+      if chrom in contig_lst:
+         other_dict.setdefault((chrom, pos), {})[other] = None
+
+   key_lst = sorted(other_dict, key = lambda x: (contig_lst.index(x[0]), x[1]))
+   return [(chrom, pos, other) for chrom, pos in key_lst for other in other_dict[(chrom, pos)]]
+
+
+def __normalize(locus_file: str, file_format: str, contig_lst: list[str, ...]) -> tuple[list, int, utils.LocusScan]:
+   drop_lst = []
+   locus_scan = utils.scan_locus_file(locus_file, file_format, contig_lst, is_region = True)
+   locus_lst = list(utils.normalize_loci(locus_file, file_format, contig_lst, locus_scan, drop_lst.append))
+   return locus_lst, sum(drop_lst), locus_scan
+
+
+def __run_main(argument_lst: list[str, ...], chunk_size: int = CHUNK_SIZE, mode: str = 'finish') -> subprocess.CompletedProcess:
+   command_lst = [sys.executable, '-c', RUNNER, str(chunk_size), mode] + argument_lst
+   result = subprocess.run(command_lst, cwd = ROOT_DIR, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, text = True, timeout = 120)
+   if mode != 'fail':
+      assert result.returncode == 0, result.stdout
+   return result
+
+
+def __main_arguments(dataset: dict, locus_file: str, output_file: str, cache_dir: str) -> list[str, ...]:
+   return [dataset['bam'], locus_file, '-l', 'POS', '-o', output_file, '-r', dataset['reference'], '-v', dataset['truth_vcf'],
+           '--truth-cache-dir', cache_dir, '-t', '2']
+
+
+def __read_bytes(file_str: str) -> bytes:
+   with open(file_str, 'rb') as in_f:
+      return in_f.read()
+
+
+# tsv输出中的一列转换成与列式输出比较的数值
+def __tsv_value(attr_str: str, value_str: str):
+   kind_str = info.column_kind(attr_str)
+   if kind_str == 'count':
+      return tuple([int(x) for x in value_str.split(', ')]) if value_str else (0, 0, 0, 0)
+   if kind_str == 'int':
+      return int(value_str) if value_str else None
+   if kind_str == 'float':
+      return float(value_str) if value_str else None
+   if kind_str == 'int_list':
+      return [int(x) for x in value_str.split(', ')] if value_str else []
+   if kind_str == 'str_list':
+      return value_str.split(', ') if value_str else []
+   if kind_str == 'counter':
+      pair_lst = [x.rsplit(': ', 1) for x in value_str.split(', ')] if value_str else []
+      return [(int(key) if attr_str == 'indel_length_counter' else key, int(count)) for key, count in pair_lst]
+   return value_str
+
+
+# 列式输出的一列转换成与tsv输出比较的数值：浮点数保留一位小数，没有数值的字符串为''
+def __columnar_value(attr_str: str, value):
+   kind_str = info.column_kind(attr_str)
+   if kind_str == 'count':
+      return tuple(value)
+   if kind_str == 'float':
+      return round(value, 1) if value is not None else None
+   if kind_str == 'str':
+      return value if value is not None else ''
+   if kind_str == 'counter':
+      return [tuple(x) for x in value]
+   return value
+
+
+def __split_ragged(value_lst: list, offset_lst: list[int, ...]) -> list[list, ...]:
+   return [value_lst[offset_lst[i]:offset_lst[i + 1]] for i in range(len(offset_lst) - 1)]
+
+
+# 按lib/columnar.py中的格式读取npz文件，返回每列的数值 {属性: [每行的数值, ...]}
+def __read_npz(npz_file: str, attribute_lst: list[str, ...]) -> dict:
+   column_dict = {}
+   with np.load(npz_file) as npz:
+      for attr_str in attribute_lst:
+         kind_str = info.column_kind(attr_str)
+         if kind_str == 'count':
+            column_dict[attr_str] = npz[attr_str].tolist()
+         elif kind_str == 'int':
+            column_dict[attr_str] = [x if x != -1 else None for x in npz[attr_str].tolist()]
+         elif kind_str == 'float':
+            column_dict[attr_str] = [x if not math.isnan(x) else None for x in npz[attr_str].tolist()]
+         elif kind_str == 'int_list':
+            column_dict[attr_str] = __split_ragged(npz[attr_str].tolist(), npz[attr_str + '.offsets'].tolist())
+         elif kind_str == 'str':
+            column_dict[attr_str] = columnar.decode_strings(npz[attr_str], npz[attr_str + '.offsets']).tolist()
+         elif kind_str == 'str_list':
+            column_dict[attr_str] = [x.split(',') if x else [] for x in columnar.decode_strings(npz[attr_str], npz[attr_str + '.offsets']).tolist()]
+         elif kind_str == 'counter':
+            if attr_str == 'indel_length_counter':
+               key_lst = __split_ragged(npz[attr_str + '.keys'].tolist(), npz[attr_str + '.keys.offsets'].tolist())
+            else:
+               key_lst = [x.split(',') if x else [] for x in columnar.decode_strings(npz[attr_str + '.keys'], npz[attr_str + '.keys.offsets']).tolist()]
+            count_lst = __split_ragged(npz[attr_str + '.counts'].tolist(), npz[attr_str + '.counts.offsets'].tolist())
+            column_dict[attr_str] = [list(zip(x, y)) for x, y in zip(key_lst, count_lst)]
+
+   return column_dict
+
+
+# = = = = = = = = = = = = = = = = = = 位点的标准化 = = = = = = = = = = = = = = = = = =
+@pytest.mark.parametrize('max_merge_runs', [1, 4, 64])
+def test_normalize_loci_shuffled_pos(dataset, tmp_path, monkeypatch, max_merge_runs):
+   # 打乱顺序，加入重复的位点、other不同的重复位点，以及比对文件中没有的染色体
+   with open(dataset['locus_pos']) as in_f:
+      line_lst = in_f.readlines()
+   rng = random.Random(max_merge_runs)
+   line_lst += rng.sample(line_lst, 20)
+   line_lst += [line_str.rstrip('\n') + '\tx\n' for line_str in rng.sample(line_lst, 10)]
+   line_lst += ['chrUn\t100\n', 'chrUn\t5\n']
+   rng.shuffle(line_lst)
+   locus_file = str(tmp_path / 'shuffled.pos')
+   with open(locus_file, 'w') as out_f:
+      out_f.writelines(line_lst)
+
+   monkeypatch.setattr(utils, 'MAX_MERGE_RUNS', max_merge_runs)
+   locus_lst, drop_int, locus_scan = __normalize(locus_file, 'POS', CONTIG_LST)
+   assert locus_lst == __brute_force_normalize(locus_file, 'POS', CONTIG_LST)
+   assert locus_scan.unknown_dict == {'chrUn': 2}
+   assert sum(locus_scan.locus_dict.values()) == len(line_lst) - 2
+   assert drop_int == len(line_lst) - 2 - len(locus_lst)
+   assert locus_scan.region_dict == utils.merge_regions((chrom, pos, pos) for chrom, pos, _ in locus_lst)
+
+
+def test_normalize_loci_overlapping_bed(dataset):
+   # 合成的BED区间是随机的，有重叠的区间；位置文件已排序时每个染色体只有一个记录段
+   locus_lst, drop_int, locus_scan = __normalize(dataset['locus_bed'], 'BED', CONTIG_LST)
+   expected_lst = __brute_force_normalize(dataset['locus_bed'], 'BED', CONTIG_LST)
+   assert locus_lst == expected_lst
+   assert all([len(run_lst) == 1 for run_lst in locus_scan.run_dict.values()])
+   assert drop_int == sum(1 for _ in utils.parse_locus(dataset['locus_bed'], 'BED')) - len(expected_lst)
+
+
+def test_reversed_bed_record_is_skipped_in_both_modes(tmp_path, capsys):
+   # end小于start的BED记录在标准化和--keep-locus-order（parse_locus）中都作为格式错误跳过，两种方式的位点和总数相同
+   locus_file = str(tmp_path / 'reversed.bed')
+   with open(locus_file, 'w') as out_f:
+      out_f.write('chr1\t10\t12\ta\nchr1\t30\t25\tb\nchr1\t40\t40\tc\n')
+
+   parsed_lst = list(utils.parse_locus(locus_file, 'BED'))
+   assert parsed_lst == [('chr1', 10, 'a'), ('chr1', 11, 'a'), ('chr1', 12, 'a'), ('chr1', 40, 'c')]
+   assert 'end小于start' in capsys.readouterr().out
+   assert utils.count_loci(locus_file, 'BED') == len(parsed_lst)
+
+   locus_lst, drop_int, locus_scan = __normalize(locus_file, 'BED', CONTIG_LST)
+   assert locus_lst == parsed_lst
+   assert drop_int == 0
+   assert locus_scan.locus_dict == {'chr1': len(parsed_lst)}
+   assert 'end小于start' in capsys.readouterr().out
+
+
+def test_normalize_loci_gz_vcf(dataset):
+   contig_lst = list(reversed(CONTIG_LST))  # 按header中染色体的顺序输出，而不是位置文件中的顺序
+   locus_lst, drop_int, _ = __normalize(dataset['truth_vcf_gz'], 'VCF', contig_lst)
+   assert locus_lst == __brute_force_normalize(dataset['truth_vcf'], 'VCF', contig_lst)  # 内容相同的未压缩文件
+   assert drop_int == 0
+
+
+# = = = = = = = = = = = = = = = = = = 端到端运行 = = = = = = = = = = = = = = = = = =
+def test_keep_locus_order_matches_normalized(dataset, tmp_path):
+   # 位置文件已排序且没有重复时，标准化不改变位点，与--keep-locus-order（原来的行为）的输出完全相同
+   cache_dir = str(tmp_path / 'cache')
+   normalized_file = str(tmp_path / 'normalized.tsv')
+   keep_order_file = str(tmp_path / 'keep_order.tsv')
+   __run_main(__main_arguments(dataset, dataset['locus_pos'], normalized_file, cache_dir))
+   __run_main(__main_arguments(dataset, dataset['locus_pos'], keep_order_file, cache_dir) + ['--keep-locus-order'])
+   assert __read_bytes(normalized_file) == __read_bytes(keep_order_file)
+   assert len(__read_bytes(normalized_file).splitlines()) == dataset['locus_pos_number'] + 1
+
+   # 打乱顺序并加入重复位点后，标准化的输出不变
+   with open(dataset['locus_pos']) as in_f:
+      line_lst = in_f.readlines()
+   line_lst += line_lst[:30]
+   random.Random(1).shuffle(line_lst)
+   shuffled_file = str(tmp_path / 'shuffled.pos')
+   with open(shuffled_file, 'w') as out_f:
+      out_f.writelines(line_lst)
+   shuffled_output_file = str(tmp_path / 'shuffled.tsv')
+   __run_main(__main_arguments(dataset, shuffled_file, shuffled_output_file, cache_dir))
+   assert __read_bytes(shuffled_output_file) == __read_bytes(normalized_file)
+
+
+def test_keep_locus_order_follows_file_order(dataset, tmp_path):
+   # 打乱顺序并加入重复位点：--keep-locus-order按位置文件中的顺序输出，重复的位点重复输出，区块内也不排序
+   cache_dir = str(tmp_path / 'cache')
+   normalized_file = str(tmp_path / 'normalized.tsv')
+   __run_main(__main_arguments(dataset, dataset['locus_pos'], normalized_file, cache_dir))
+   with open(normalized_file) as in_f:
+      header_str, *row_lst = in_f.readlines()
+   row_dict = {tuple(row_str.split('\t')[:2]): row_str for row_str in row_lst}
+
+   with open(dataset['locus_pos']) as in_f:
+      line_lst = in_f.readlines()
+   line_lst += line_lst[:30]
+   random.Random(2).shuffle(line_lst)
+   shuffled_file = str(tmp_path / 'shuffled.pos')
+   with open(shuffled_file, 'w') as out_f:
+      out_f.writelines(line_lst)
+
+   keep_order_file = str(tmp_path / 'keep_order.tsv')
+   __run_main(__main_arguments(dataset, shuffled_file, keep_order_file, cache_dir) + ['--keep-locus-order'])
+   with open(keep_order_file) as in_f:
+      assert in_f.readlines() == [header_str] + [row_dict[tuple(line_str.split())] for line_str in line_lst]
+
+
+def test_resume_is_byte_identical(dataset, tmp_path):
+   cache_dir = str(tmp_path / 'cache')
+   expected_file = str(tmp_path / 'expected.tsv')
+   __run_main(__main_arguments(dataset, dataset['locus_pos'], expected_file, cache_dir))
+
+   # 模拟中断：保留前一半已完成的区块，后一半的区块和manifest中的记录去掉，并留下一个未完成区块的临时文件
+   output_file = str(tmp_path / 'resumed.tsv')
+   __run_main(__main_arguments(dataset, dataset['locus_pos'], output_file, cache_dir), mode = 'interrupt')
+   checkpoint_dir = output_file + '.chunks'
+   manifest_file = path.join(checkpoint_dir, 'manifest.tsv')
+   with open(manifest_file) as in_f:
+      fingerprint_str, *chunk_line_lst = in_f.readlines()
+   assert len(chunk_line_lst) >= 4
+   keep_int = len(chunk_line_lst) // 2
+   for line_str in chunk_line_lst[keep_int:]:
+      part_file = path.join(checkpoint_dir, 'chunk_{:08d}.part'.format(int(line_str.split('\t')[0])))
+      if line_str is chunk_line_lst[-1]:
+         os.replace(part_file, part_file + '.tmp')
+      else:
+         os.remove(part_file)
+   with open(manifest_file, 'w') as out_f:
+      out_f.writelines([fingerprint_str] + chunk_line_lst[:keep_int] + ['3\t'])  # 最后一行没有写完
+
+   __run_main(__main_arguments(dataset, dataset['locus_pos'], output_file, cache_dir) + ['--resume'])
+   assert __read_bytes(output_file) == __read_bytes(expected_file)
+   assert not path.exists(checkpoint_dir)
+
+
+def test_task_failure_exits_with_resume_message(dataset, tmp_path):
+   # 区块很小时任务线程在pending_semaphore上等待，任务出错后主进程仍然必须退出，而不是卡在pool.terminate()
+   output_file = str(tmp_path / 'failed.tsv')
+   result = __run_main(__main_arguments(dataset, dataset['locus_pos'], output_file, str(tmp_path / 'cache')), chunk_size = 5, mode = 'fail')
+   assert result.returncode == 1, result.stdout
+   assert 'injected failure' in result.stdout
+   assert '--resume' in result.stdout
+   assert not path.exists(output_file)
+   assert path.exists(output_file + '.chunks')
+
+
+def test_read_filter_header(dataset, tmp_path):
+   # 有过滤条件时，tsv的第一行为'##read_filter=...'，列式输出保存在元数据中；没有过滤条件时不输出
+   cache_dir = str(tmp_path / 'cache')
+   filter_lst = ['--min-mapq', '30', '--exclude-flags', 'DUP', '--min-base-quality', '10']
+   filter_str = info.ReadFilter(min_mapq = 30, min_base_quality = 10, exclude_flags = 0x400).header_str()
+
+   unfiltered_file = str(tmp_path / 'unfiltered.tsv')
+   filtered_file = str(tmp_path / 'filtered.tsv')
+   __run_main(__main_arguments(dataset, dataset['locus_pos'], unfiltered_file, cache_dir))
+   __run_main(__main_arguments(dataset, dataset['locus_pos'], filtered_file, cache_dir) + filter_lst)
+   with open(unfiltered_file) as in_f:
+      unfiltered_lst = in_f.read().splitlines()
+   with open(filtered_file) as in_f:
+      filtered_lst = in_f.read().splitlines()
+   assert not unfiltered_lst[0].startswith('##')
+   assert filtered_lst[0] == '##read_filter=' + filter_str
+   assert filtered_lst[1] == unfiltered_lst[0]
+   assert len(filtered_lst) == len(unfiltered_lst) + 1
+
+   # 过滤后每个位点的coverage不增加，并且至少有一个位点减少
+   coverage_index = unfiltered_lst[0].split('\t').index('coverage')
+   coverage_lst = [(int(x.split('\t')[coverage_index] or 0), int(y.split('\t')[coverage_index] or 0)) for x, y in zip(unfiltered_lst[1:], filtered_lst[2:])]
+   assert all([x >= y for x, y in coverage_lst])
+   assert any([x > y for x, y in coverage_lst])
+
+   npz_file = str(tmp_path / 'filtered.npz')
+   __run_main(__main_arguments(dataset, dataset['locus_pos'], npz_file, cache_dir) + filter_lst + ['--output-format', 'npz'])
+   with np.load(npz_file) as npz:
+      assert str(npz['##read_filter']) == filter_str
+
+
+@pytest.mark.parametrize('output_format', ['parquet', 'npz'])
+def test_columnar_output_matches_tsv(dataset, tmp_path, output_format):
+   if output_format == 'parquet' and columnar.pa is None:
+      pytest.skip('parquet输出需要安装pyarrow')
+
+   # 默认的列之外加上浮点数、整数列表和整数为key的计数器
+   cache_dir = str(tmp_path / 'cache')
+   format_lst = ['-f', 'A_mean_MAPQ,T_median_seq_quality,C_p90_cycle,indel_length,indel_length_counter,query_snp']
+   tsv_file = str(tmp_path / 'output.tsv')
+   columnar_file = str(tmp_path / ('output' + columnar.SUFFIX_DICT[output_format]))
+   __run_main(__main_arguments(dataset, dataset['locus_pos'], tsv_file, cache_dir) + format_lst)
+   __run_main(__main_arguments(dataset, dataset['locus_pos'], columnar_file, cache_dir) + format_lst + ['--output-format', output_format])
+
+   with open(tsv_file) as in_f:
+      header_str, *line_lst = in_f.read().splitlines()
+   attribute_lst = header_str.split('\t')
+   expected_lst = []
+   for line_str in line_lst:
+      value_lst = line_str.split('\t')
+      value_lst += [''] * (len(attribute_lst) - len(value_lst))  # 每行末尾的空列在tsv中被去掉
+      expected_lst.append(tuple([__tsv_value(x, y) for x, y in zip(attribute_lst, value_lst)]))
+
+   if output_format == 'parquet':
+      table = columnar.pq.read_table(columnar_file)
+      assert table.column_names == attribute_lst
+      column_dict = table.to_pydict()
+   else:
+      column_dict = __read_npz(columnar_file, attribute_lst)
+   row_lst = list(zip(*[[__columnar_value(x, y) for y in column_dict[x]] for x in attribute_lst]))
+   assert len(row_lst) == dataset['locus_pos_number']
+   assert row_lst == expected_lst
+
+
+# = = = = = = = = = = = = = = = = = = 标准位点索引和缓存 = = = = = = = = = = = = = = = = = =
+def test_real_site_index_round_trip(dataset, tmp_path):
+   real_site_dict = vcf.get_real_variants_from_vcf(dataset['truth_vcf'])
+   assert real_site_dict == vcf.get_real_variants_from_vcf(dataset['truth_vcf_gz'])
+   assert len(real_site_dict) > 0
+
+   index_file = str(tmp_path / ('truth' + realsite.SUFFIX))
+   assert realsite.write_real_site_index(real_site_dict, index_file) == len(real_site_dict)
+   real_site_index = realsite.RealSiteIndex(index_file)
+   try:
+      assert len(real_site_index) == len(real_site_dict)
+      for key, allele_lst in real_site_dict.items():
+         assert key in real_site_index
+         assert real_site_index[key] == allele_lst
+      assert real_site_index[('chr1', 0)] == []
+      assert ('chrUn', 100) not in real_site_index
+   finally:
+      real_site_index.close()
+   assert [x for x in os.listdir(tmp_path) if x.endswith(realsite.TEMP_SUFFIX)] == []
+
+   # 不完整的索引文件在打开时报错
+   truncated_file = str(tmp_path / ('truncated' + realsite.SUFFIX))
+   with open(truncated_file, 'wb') as out_f:
+      out_f.write(__read_bytes(index_file)[:-8])
+   with pytest.raises(ValueError):
+      realsite.RealSiteIndex(truncated_file)
+
+
+# InDel修正后的位置与POS不同的记录：插入TG -> AGTAAATTAT的位置为101，缺失的位置为210，缺失的碱基（*）在211-214
+SHIFTED_INDEL_VCF = '''##fileformat=VCFv4.2
+##contig=<ID=chr1,length=20000>
+#CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO	FORMAT	SAMPLE
+chr1	100	.	TG	AGTAAATTAT	50	PASS	.	GT	0/1
+chr1	200	.	TACACACACACACAC	TACACACACAC	50	PASS	.	GT	1/1
+chr1	300	.	CAT	C,CATAT	50	PASS	.	GT	1/2
+'''
+
+
+@pytest.mark.parametrize('vcf_key', ['truth_vcf', 'truth_vcf_gz', 'shifted_vcf', 'shifted_vcf_gz'])
+def test_truth_by_locus_matches_full_truth(dataset, tmp_path, vcf_key):
+   # 只读取与区间重叠的记录，与读取整个文件后只保留区间内的位点相同，包括POS在区间之外、修正后的位置在区间之内的InDel
+   if vcf_key.startswith('shifted'):
+      vcf_file = str(tmp_path / 'shifted.vcf')
+      with open(vcf_file, 'w') as out_f:
+         out_f.write(SHIFTED_INDEL_VCF)
+      if vcf_key.endswith('_gz'):
+         vcf_file = pysam.tabix_index(vcf_file, preset = 'vcf', force = True)
+      region_dict = {'chr1': [(101, 101), (210, 212), (301, 301)]}
+   else:
+      vcf_file = dataset[vcf_key]
+      key_lst = sorted(vcf.get_real_variants_from_vcf(dataset['truth_vcf']))
+      region_dict = utils.merge_regions((chrom, pos, pos + i % 3) for i, (chrom, pos) in enumerate(key_lst[1::2]))
+
+   expected_dict = {(chrom, pos): allele_lst for (chrom, pos), allele_lst in vcf.get_real_variants_from_vcf(vcf_file).items()
+                    if any([start <= pos <= end for start, end in region_dict.get(chrom, [])])}
+   real_site_dict = vcf.get_real_variants_for_regions(vcf_file, region_dict)
+   assert dict(real_site_dict) == expected_dict
+   assert any(['+' in x or '-' in x for allele_lst in expected_dict.values() for x in allele_lst])
+   if vcf_key.startswith('shifted'):
+      assert '+8TAAATTAT' in expected_dict[('chr1', 101)]
+      assert '-4NNNN' in expected_dict[('chr1', 210)]
+      assert '*' in expected_dict[('chr1', 212)]
+
+
+def test_truth_by_locus_output(dataset, tmp_path):
+   # 位点包括标准位点的全部位置（InDel修正后的位置和缺失的碱基），--truth-by-locus的输出与编译整个标准位点文件相同
+   locus_file = str(tmp_path / 'truth_sites.pos')
+   with open(locus_file, 'w') as out_f:
+      for chrom, pos in sorted(vcf.get_real_variants_from_vcf(dataset['truth_vcf'])):
+         out_f.write(f'{chrom}\t{pos}\n')
+
+   cache_dir = str(tmp_path / 'cache')
+   expected_file = str(tmp_path / 'expected.tsv')
+   __run_main(__main_arguments(dataset, locus_file, expected_file, cache_dir))
+   for vcf_key in ['truth_vcf', 'truth_vcf_gz']:
+      output_file = str(tmp_path / (vcf_key + '.tsv'))
+      argument_lst = __main_arguments(dataset, locus_file, output_file, cache_dir) + ['--truth-by-locus']
+      argument_lst[argument_lst.index('-v') + 1] = dataset[vcf_key]
+      __run_main(argument_lst)
+      assert __read_bytes(output_file) == __read_bytes(expected_file)
+
+
+@pytest.mark.parametrize('pass_only, qual', [(True, 0), (True, 40), (False, 40)])
+def test_parallel_truth_compile_matches_serial(dataset, tmp_path, pass_only, qual):
+   # 部分记录改为浮点数QUAL和非PASS，tabix索引的vcf.gz按染色体并行解析，结果（包括顺序）与单进程和未压缩的文件相同
+   vcf_file = str(tmp_path / 'truth.vcf')
+   with open(dataset['truth_vcf']) as in_f, open(vcf_file, 'w') as out_f:
+      for i, line_str in enumerate(in_f):
+         if not line_str.startswith('#'):
+            line_lst = line_str.split('\t')
+            line_lst[5] = ['50', '37.5', '42.25'][i % 3]
+            line_lst[6] = 'LowQual' if i % 5 == 0 else 'PASS'
+            line_str = '\t'.join(line_lst)
+         out_f.write(line_str)
+   vcf_gz_file = pysam.tabix_index(vcf_file, preset = 'vcf', force = True, keep_original = True)
+
+   serial_dict = vcf.get_real_variants_from_vcf(vcf_gz_file, pass_only = pass_only, qual = qual, processes = 1)
+   parallel_dict = vcf.get_real_variants_from_vcf(vcf_gz_file, pass_only = pass_only, qual = qual, processes = 2)
+   assert list(parallel_dict.items()) == list(serial_dict.items())
+   assert list(vcf.get_real_variants_from_vcf(vcf_file, pass_only = pass_only, qual = qual, processes = 2).items()) == list(serial_dict.items())
+   assert 0 < len(serial_dict) < len(vcf.get_real_variants_from_vcf(dataset['truth_vcf']))
+
+   index_lst = []
+   for processes in [1, 2]:
+      index_file, is_temporary = vcf.compile_real_site_index(vcf_gz_file, pass_only = pass_only, qual = qual, processes = processes, cache_dir = str(tmp_path / f'cache_{processes}'))
+      assert not is_temporary
+      index_lst.append(__read_bytes(index_file))
+   assert index_lst[0] == index_lst[1]
+
+
+def test_truth_cache_key(dataset, tmp_path):
+   param_dict = {'pass_only': True, 'qual': 0}
+   key_str, key_dict = truthcache.cache_key(dataset['truth_vcf'], param_dict)
+   assert truthcache.cache_key(dataset['truth_vcf'], dict(param_dict))[0] == key_str
+   assert truthcache.cache_key(dataset['truth_vcf'], {'pass_only': False, 'qual': 0})[0] != key_str
+   assert key_dict['source'] == path.realpath(dataset['truth_vcf'])
+
+   # 复制后的文件：stat方式的键改变，content方式的键不变
+   copy_file = str(tmp_path / 'truth_copy.vcf')
+   shutil.copy(dataset['truth_vcf'], copy_file)
+   assert truthcache.cache_key(copy_file, param_dict)[0] != key_str
+   assert truthcache.cache_key(copy_file, param_dict, 'content')[0] == truthcache.cache_key(dataset['truth_vcf'], param_dict, 'content')[0]
+
+   with pytest.raises(ValueError):
+      truthcache.cache_key(dataset['truth_vcf'], param_dict, 'mtime')
+
+
+def test_truth_cache_store_and_evict(dataset, tmp_path):
+   cache_dir = str(tmp_path / 'cache')
+   real_site_dict = vcf.get_real_variants_from_vcf(dataset['truth_vcf'])
+   key_lst = []
+   for qual in [0, 10, 20]:
+      key_str, key_dict = truthcache.cache_key(dataset['truth_vcf'], {'pass_only': True, 'qual': qual})
+      assert truthcache.lookup(cache_dir, key_str) is None
+      index_file = truthcache.store(cache_dir, key_str, key_dict, real_site_dict)
+      assert truthcache.lookup(cache_dir, key_str) == index_file
+      assert truthcache.store(cache_dir, key_str, key_dict, {}) == index_file  # 已经存在时不重新写入
+      key_lst.append(key_str)
+
+   real_site_index = realsite.RealSiteIndex(truthcache.index_file_for(cache_dir, key_lst[0]))
+   try:
+      assert len(real_site_index) == len(real_site_dict)
+   finally:
+      real_site_index.close()
+
+   # 修改时间从旧到新为key_lst的顺序，最旧的为keep_key；中断的写入留下的临时文件只删除旧的
+   for i, key_str in enumerate(key_lst):
+      os.utime(truthcache.index_file_for(cache_dir, key_str), (1000 + i, 1000 + i))
+   stale_file = path.join(cache_dir, key_lst[0] + '.json.stale' + realsite.TEMP_SUFFIX)
+   fresh_file = path.join(cache_dir, key_lst[0] + '.json.fresh' + realsite.TEMP_SUFFIX)
+   for temp_file in [stale_file, fresh_file]:
+      with open(temp_file, 'w') as out_f:
+         out_f.write('{')
+   os.utime(stale_file, (1000, 1000))
+
+   size_int = os.path.getsize(truthcache.index_file_for(cache_dir, key_lst[0]))
+   removed_lst = truthcache.evict(cache_dir, size_int * 2, keep_key = key_lst[0])
+   assert removed_lst == [truthcache.index_file_for(cache_dir, key_lst[1])]
+   assert not path.exists(path.join(cache_dir, key_lst[1] + '.json'))
+   assert truthcache.lookup(cache_dir, key_lst[0]) is not None
+   assert truthcache.lookup(cache_dir, key_lst[2]) is not None
+   assert not path.exists(stale_file)
+   assert path.exists(fresh_file)
+
+   assert truthcache.evict(cache_dir, 0) == []
+
+
+# = = = = = = = = = = = = = = = = = = 进程数和分位数 = = = = = = = = = = = = = = = = = =
+def test_split_threads():
+   dense = utils.DENSE_LOCI_PER_WINDOW
+   assert utils.split_threads(8, 1.0) == (8, 0)
+   assert utils.split_threads(8, dense) == (8, 0)
+   assert utils.split_threads(8, 1.0, is_cram = True) == (8, 0)
+   assert utils.split_threads(8, 1.0, task_int = 2) == (2, 0)
+   assert utils.split_threads(8, dense, task_int = 2) == (2, 3)
+   assert utils.split_threads(8, 1.0, is_cram = True, task_int = 4) == (4, 0)  # 每个进程只多出1个CPU，不使用解压线程
+   assert utils.split_threads(0, dense) == (1, 0)
+
+   # 进程数从不因为解压线程而减少，进程和解压线程的总数不超过CPU数
+   for thread_int in range(1, 17):
+      for task_int in range(0, 21):
+         for loci_density in [1.0, dense]:
+            process_int, io_thread_int = utils.split_threads(thread_int, loci_density, task_int = task_int)
+            assert process_int == (min(thread_int, task_int) if task_int > 0 else thread_int)
+            assert io_thread_int == 0 or io_thread_int >= 2
+            assert process_int * (1 + io_thread_int) <= thread_int
+
+
+@pytest.mark.parametrize('histogram_size', [0, 64])
+def test_accumulator_percentiles(histogram_size):
+   rng = np.random.default_rng(1)
+   accumulator = info.Accumulator(keep_histogram = True, histogram_size = histogram_size)
+   assert accumulator.median is None
+   assert accumulator.percentile(50) is None
+   assert accumulator.mean is None
+
+   value_lst = []
+   for size_int in [0, 1, 7, 100, 31]:
+      value_array = rng.integers(0, 60, size_int)
+      accumulator.add(value_array)
+      value_lst.extend(value_array.tolist())
+
+   value_lst.sort()
+   assert accumulator.count == len(value_lst)
+   assert (accumulator.min, accumulator.max) == (value_lst[0], value_lst[-1])
+   assert accumulator.median == statistics.median(value_lst)
+   assert accumulator.mean == statistics.mean(value_lst)
+   for percent in range(0, 101):
+      assert accumulator.percentile(percent) == value_lst[max(math.ceil(percent * len(value_lst) / 100), 1) - 1]
+
+   # 数值个数为偶数时为中间两个数值的平均
+   accumulator = info.Accumulator(keep_histogram = True, histogram_size = histogram_size)
+   accumulator.add(np.array([3, 1, 4, 8]))
+   assert accumulator.median == 3.5
+   accumulator.add(np.array([100]))  # histogram_size为64时计入最后一格
+   assert accumulator.percentile(100) == (100 if histogram_size == 0 else histogram_size - 1)
+   assert accumulator.max == 100
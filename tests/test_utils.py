@@ -0,0 +1,65 @@
+# lib/utils.py：mmap读取的参考基因组
+import sys
+import os.path as path
+
+import pysam
+import pytest
+
+ROOT_DIR = path.dirname(path.dirname(path.realpath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import lib.utils as utils
+
+
+# start至end（1-based，包含end）截去染色体两端后的序列
+def __clipped_fetch(fasta: pysam.FastaFile, chrom: str, start: int, end: int) -> str:
+   start = max(start, 1)
+   end = min(end, fasta.get_reference_length(chrom))
+   return fasta.fetch(chrom, start - 1, end).upper() if start <= end else ''
+
+
+# 染色体两端、跨行和超出染色体的序列与pysam.FastaFile截去两端后的结果相同，不会读到相邻染色体的序列
+def test_reference_genome_fetch_at_contig_edges(dataset):
+   reference_genome = utils.ReferenceGenome(dataset['reference'])
+   try:
+      with pysam.FastaFile(dataset['reference']) as fasta:
+         assert 'chr1' in reference_genome and 'chrUn' not in reference_genome
+         for chrom in fasta.references:
+            length_int = fasta.get_reference_length(chrom)
+            assert reference_genome.length(chrom) == length_int
+            for start, end in [(1, 0), (1, 1), (-3, 4), (55, 125), (60, 61), (length_int, 0), (length_int - 2, length_int + 5), (length_int + 1, 0), (10, 5)]:
+               assert reference_genome.fetch(chrom, start, end) == __clipped_fetch(fasta, chrom, start, end if end != 0 else start), (chrom, start, end)
+
+         # 染色体内部与get_base_fast相同
+         handle, index_dict = utils.read_reference(dataset['reference'])
+         try:
+            for start, end in [(1, 0), (58, 130), (19990, 20000)]:
+               assert reference_genome.fetch('chr2', start, end) == utils.get_base_fast(handle, index_dict, 'chr2', start, end)
+         finally:
+            handle.close()
+
+      with pytest.raises(KeyError):
+         reference_genome.fetch('chrUn', 1)
+   finally:
+      reference_genome.close()
+
+
+# 一个窗口的碱基和上下游序列与逐个位点截去两端的结果相同，位点不需要排序
+@pytest.mark.parametrize('flank', [0, 5, 70])
+def test_reference_genome_fetch_loci_flank(dataset, flank):
+   reference_genome = utils.ReferenceGenome(dataset['reference'])
+   try:
+      with pysam.FastaFile(dataset['reference']) as fasta:
+         length_int = fasta.get_reference_length('chr1')
+         pos_lst = [61, 1, 2, 60, 120, length_int, length_int - 3, 0, length_int + 1, 300]
+         expected_lst = []
+         for pos in pos_lst:
+            expected_lst.append((__clipped_fetch(fasta, 'chr1', pos, pos), __clipped_fetch(fasta, 'chr1', pos - flank, pos + flank)))
+
+      assert reference_genome.fetch_loci('chr1', pos_lst, flank) == expected_lst
+      assert reference_genome.fetch_loci('chr1', pos_lst, flank, need_context = False) == [(x, '') for x, _ in expected_lst]
+      assert reference_genome.fetch_loci('chr1', pos_lst, flank, need_base = False) == [('', y) for _, y in expected_lst]
+      assert reference_genome.fetch_loci('chr1', pos_lst, flank, need_base = False, need_context = False) == [('', '')] * len(pos_lst)
+      assert reference_genome.fetch_loci('chr1', [], flank) == []
+   finally:
+      reference_genome.close()